@@ -19,16 +19,17 @@ app_folder, _src = os.path.split(os.path.split(os.path.split(os.path.abspath(__f
 set_versions(config, app_folder)
 biothings.config_for_app(config)
 
-import biothings.hub.databuild.builder as builder
 import biothings.utils.mongo as mongo
 from biothings.hub import HubServer
-from biothings.hub.databuild.syncer import (
-    SyncerManager,
-    ThrottledESJsonDiffSelfContainedSyncer,
-    ThrottledESJsonDiffSyncer,
-)
-from hub.databuild.builder import MyGeneDataBuilder
+from biothings.hub.databuild.differ import DifferManager
+from biothings.hub.databuild.syncer import SyncerManager
+from hub.databuild.builder import MyGeneBuilderManager, MyGeneDataBuilder
+from hub.databuild.differ import HashedJsonDiffer, HashedSelfContainedJsonDiffer
 from hub.databuild.mapper import Ensembl2Entrez, EntrezRetired2Current
+from hub.databuild.syncer import (
+    AdaptiveThrottledESJsonDiffSelfContainedSyncer,
+    AdaptiveThrottledESJsonDiffSyncer,
+)
 
 
 class MyGeneHubServer(HubServer):
@@ -36,7 +37,7 @@ class MyGeneHubServer(HubServer):
     def configure_build_manager(self):
         retired2current = EntrezRetired2Current(convert_func=int, db_provider=mongo.get_src_db)
         ensembl2entrez = Ensembl2Entrez(db_provider=mongo.get_src_db, retired2current=retired2current)
-        build_manager = builder.BuilderManager(
+        build_manager = MyGeneBuilderManager(
             builder_class=partial(MyGeneDataBuilder, mappers=[ensembl2entrez]),
             job_manager=self.managers["job_manager"],
         )
@@ -45,13 +46,24 @@ class MyGeneHubServer(HubServer):
         self.managers["build_manager"] = build_manager
         self.logger.info("Using custom builder %s" % MyGeneDataBuilder)
 
+    def configure_diff_manager(self):
+        # same as default, with differs skipping documents whose content hash didn't change
+        args = self.mixargs("diff")
+        diff_manager = DifferManager(job_manager=self.managers["job_manager"], poll_schedule="* * * * * */10", **args)
+        diff_manager.configure([HashedJsonDiffer, HashedSelfContainedJsonDiffer])
+        diff_manager.poll(
+            "diff",
+            lambda doc: diff_manager.diff("jsondiff-selfcontained", old=None, new=doc["_id"]),
+        )
+        self.managers["diff_manager"] = diff_manager
+
     def configure_sync_manager(self):
         # prod
         sync_manager_prod = SyncerManager(job_manager=self.managers["job_manager"])
         sync_manager_prod.configure(
             klasses=[
-                partial(ThrottledESJsonDiffSyncer, config.MAX_SYNC_WORKERS),
-                partial(ThrottledESJsonDiffSelfContainedSyncer, config.MAX_SYNC_WORKERS),
+                partial(AdaptiveThrottledESJsonDiffSyncer, config.MAX_SYNC_WORKERS, config.SYNC_THROTTLE),
+                partial(AdaptiveThrottledESJsonDiffSelfContainedSyncer, config.MAX_SYNC_WORKERS, config.SYNC_THROTTLE),
             ]
         )
         self.managers["sync_manager"] = sync_manager_prod
@@ -41,6 +41,8 @@ INDEX_CONFIG = {
                     "retry_on_timeout": True,
                     "max_retries": 10,
                 },
+                # index each TAXONOMY species in its own index, see GeneIndexer
+                "species_indices": False,
             },
             "index": [
                 {"index": "genedoc_mygene_allspecies_current", "doc_type": "gene"}
@@ -61,6 +63,20 @@ INDEX_CONFIG = {
 }
 
 
+# Adaptive throttling of prod ES syncs, see hub.databuild.syncer.SyncThrottle.
+# Sync workers range from min_workers to MAX_SYNC_WORKERS.
+SYNC_THROTTLE = {
+    "min_workers": 1,
+    "min_batch_size": 500,
+    "max_batch_size": 10000,
+    # max seconds per bulk request
+    "bulk_latency": 5.0,
+    # max milliseconds per live search query
+    "search_latency": 100.0,
+    # seconds to wait after rejected (429) bulk requests
+    "backoff": 30,
+}
+
 # Snapshot environment configuration
 SNAPSHOT_CONFIG = {
     "env": {
@@ -14,6 +14,10 @@ from biothings.web.settings.default import ANNOTATION_KWARGS, APP_LIST, QUERY_KW
 ES_HOST = "http://localhost:9200"
 ES_INDEX = "mygene_current"
 ES_DOC_TYPE = "gene"
+# queries only on model organisms of TAXONOMY search their own indices,
+# when the hub indexed them separately ("species_indices" indexer option),
+# for example "mygene_current_{species}", None searches ES_INDEX only.
+ES_SPECIES_INDEX = None
 
 # *****************************************************************************
 # Web Application
@@ -23,6 +27,7 @@ TAX_REDIRECT = "http://t.biothings.io/v1/taxon/{0}?include_children=1"
 APP_LIST += [
     (r"/{ver}/species/(\d+)/?", "tornado.web.RedirectHandler", {"url": TAX_REDIRECT}),
     (r"/{ver}/taxon/(\d+)/?", "tornado.web.RedirectHandler", {"url": TAX_REDIRECT}),
+    (r"/{pre}/{ver}/{typ}(?:/([^/]+))?/?", "web.handlers.MygeneAnnotationHandler"),
     (r"/{ver}/query/?", "web.handlers.MygeneQueryHandler"),
     (r"/{ver}/metadata/?", "web.handlers.MygeneSourceHandler"),
     (r"/metadata/?", "web.handlers.MygeneSourceHandler"),
@@ -147,13 +152,36 @@ QUERY_KWARGS["POST"]["scopes"]["default"] = [
     "retired",
 ]
 QUERY_KWARGS["POST"]["q"]["jsoninput"] = True
+# streaming exports of all the matches, see web.export
+QUERY_KWARGS["GET"]["format"] = copy.deepcopy(QUERY_KWARGS["*"]["format"])
+QUERY_KWARGS["GET"]["format"]["enum"] += ("ndjson", "tsv")
 
 
 # *****************************************************************************
 # Elasticsearch Query Pipeline
 # *****************************************************************************
 ES_QUERY_BUILDER = "web.pipeline.MygeneQueryBuilder"
-AVAILABLE_FIELDS_EXCLUDED = ["all", "accession_agg", "refseq_agg"]
+# batch lookups of identifiers on exact scopes (POST /query) use terms queries
+# instead of a multisearch, "biothings.web.query.AsyncESQueryPipeline" to disable
+ES_QUERY_PIPELINE = "web.pipeline.MygeneQueryPipeline"
+ES_QUERY_BACKEND = "web.pipeline.MygeneQueryBackend"
+AVAILABLE_FIELDS_EXCLUDED = [
+    "all", "accession_agg", "refseq_agg",
+    "genomic_pos_range", "genomic_pos_hg19_range", "genomic_pos_mm9_range",
+]
+
+# *****************************************************************************
+# Response Cache
+# *****************************************************************************
+# query and annotation responses cached per web worker, keyed on the request
+# arguments and the index build_version (0 to disable the cache)
+RESPONSE_CACHE_SIZE = 10000
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+# seconds between two reads of the index build_version
+RESPONSE_CACHE_VERSION_CHECK = 60
+# optional cache shared by all web workers, like "redis://localhost:6379/0",
+# requires the "redis" package
+RESPONSE_CACHE_REDIS = None
 
 # *****************************************************************************
 # Endpoints Specifics & Others
@@ -196,3 +224,11 @@ DOCS_STATIC_PATH = "docs/_build/html"
 
 # url template to redirect for 'include_tax_tree' parameter
 INCLUDE_TAX_TREE_REDIRECT_ENDPOINT = "http://t.biothings.io/v1/taxon"
+# expanded species lists are cached per web worker (LRU, expiring after TTL seconds)
+INCLUDE_TAX_TREE_CACHE_SIZE = 1024
+INCLUDE_TAX_TREE_CACHE_TTL = 24 * 60 * 60
+INCLUDE_TAX_TREE_TIMEOUT = 10
+# offline mode: expand from a local taxonomy index instead of the endpoint above,
+# either the memory-mapped "taxonomy_index.bin" built by the hub "taxonomy" dumper,
+# or a text tree file (NCBI nodes.dmp, or "taxid<TAB>parent_taxid" lines)
+INCLUDE_TAX_TREE_FILE = None
@@ -1,12 +1,88 @@
+import asyncio
+import zlib
+from functools import partial
+
 import biothings.hub.databuild.builder as builder
 import biothings.utils.mongo as mongo
-from biothings.hub import BUILDER_CATEGORY
+from biothings.hub.databuild.mapper import TransparentMapper
+from biothings.utils.common import iter_n
+
+import config
+from hub.databuild.differ import HASH_COLLECTION_PREFIX, hash_collection_name, hash_worker
+from hub.databuild.mapper import Ensembl2Entrez
+
+# default number of _id ranges merged concurrently, see merge_source_server_side
+SERVER_SIDE_MERGE_PARTITIONS = 8
+# default number of partitions of ensembl sources merged concurrently, see merge_source_partitioned
+ENSEMBL_MERGE_PARTITIONS = 8
+
+
+# number of ensembl genes in a document: the size of the "ensembl" list,
+# or one for an "ensembl" object, or one for an orphan ensembl root doc.
+# Historical counters matched {"ensembl": {"$type": "object"}}, which also
+# matches lists holding objects: such lists count one more, keeping the
+# published totals comparable from build to build.
+_ENSEMBL_TYPE = {"$type": "$ensembl"}
+_HAS_ENSEMBL_OBJECT = {
+    "$cond": [
+        {"$anyElementTrue": [{"$map": {"input": "$ensembl", "in": {"$eq": [{"$type": "$$this"}, "object"]}}}]},
+        1,
+        0,
+    ]
+}
+_ENSEMBL_GENES = {
+    "$switch": {
+        "branches": [
+            {"case": {"$eq": [_ENSEMBL_TYPE, "array"]}, "then": {"$add": [{"$size": "$ensembl"}, _HAS_ENSEMBL_OBJECT]}},
+            {"case": {"$in": [_ENSEMBL_TYPE, ["object", "missing"]]}, "then": 1},
+        ],
+        "default": 0,
+    }
+}
+_HAS_ENTREZ = {"$ne": [{"$type": "$entrezgene"}, "missing"]}
+
+# every mygene specific counter, in one pass over the merged collection
+GENE_STATS_PIPELINE = [
+    {
+        "$group": {
+            "_id": None,
+            "entrez": {"$sum": {"$cond": [_HAS_ENTREZ, 1, 0]}},
+            "ensembl": {"$sum": _ENSEMBL_GENES},
+            "ensembl_mapped": {
+                "$sum": {
+                    "$cond": [
+                        {"$and": [_HAS_ENTREZ, {"$in": [_ENSEMBL_TYPE, ["array", "object"]]}]},
+                        _ENSEMBL_GENES,
+                        0,
+                    ]
+                }
+            },
+            # non-digit _id, not an entrez gene
+            "ensembl_only": {
+                "$sum": {"$cond": [{"$regexMatch": {"input": {"$toString": "$_id"}, "regex": "\\D"}}, 1, 0]}
+            },
+            "taxids": {"$addToSet": "$taxid"},
+        }
+    }
+]
 
 
 class MyGeneDataBuilder(builder.DataBuilder):
     """
     MyGene.info specific data builder, computing custom statistics
     about Ensembl-to-Entrez mapping.
+
+    With "server_side_merge" set in the build configuration, sources only
+    needing their documents merged as is (no mapper, default merger, taxid
+    dropped) are merged by MongoDB itself, see merge_source_server_side.
+    "server_side_merge_partitions" sets the number of concurrent _id ranges.
+
+    Sources converted with the ensembl2entrez mapper are merged in
+    partitions of their converted _ids, see merge_source_partitioned.
+    "ensembl_merge_partitions" sets the number of partitions.
+
+    Once merged, the content hash of every document is stored for
+    differs, see hash_documents and hub.databuild.differ.
     """
 
     def merge_order(self, other_sources):
@@ -22,35 +98,6 @@ class MyGeneDataBuilder(builder.DataBuilder):
         self.logger.info("This is the merge order: %s", other_sources)
         return other_sources
 
-    def get_predicates(self):
-        def no_other_merge_job_for_ensembl_gene(job_manager):
-            """
-            ensembl to entrez ID conversion can produce duplicates
-            which are not handled by mongo as upserts and produce duplicated
-            errors. For this datasource in particular, we allow only one merge job
-            """
-            return (
-                len(
-                    [
-                        j
-                        for j in job_manager.jobs.values()
-                        if j["category"] == BUILDER_CATEGORY
-                        and (
-                            j["step"] == "ensembl_gene"
-                            or j["step"] == "ensembl_metazoa_gene"
-                            or j["step"] == "ensembl_protists_gene"
-                            or j["step"] == "ensembl_fungi_gene"
-                            or j["step"] == "ensembl_plant_gene"
-                        )
-                    ]
-                )
-                == 0
-            )
-
-        preds = super().get_predicates()
-        preds.append(no_other_merge_job_for_ensembl_gene)
-        return preds
-
     def generate_document_query(self, src_name):
         """Root documents are created according to species list"""
         _query = None
@@ -72,6 +119,166 @@ class MyGeneDataBuilder(builder.DataBuilder):
         else:
             return cleaner
 
+    def server_side_mergeable(self, src_name):
+        """
+        Whether documents of the source can be merged by MongoDB: non-root
+        sources without a mapper, merged with the default "upsert" merger,
+        when source and target databases are on the same server.
+        """
+        if not self.build_config.get("server_side_merge"):
+            return False
+        if src_name in self.get_root_document_sources():
+            return False
+        if (config.DATA_SRC_SERVER, config.DATA_SRC_PORT) != (config.DATA_TARGET_SERVER, config.DATA_TARGET_PORT):
+            self.logger.warning("Source and target databases are on different servers, can't merge server-side")
+            return False
+        if not isinstance(self.get_mapper_for_source(src_name, init=False), TransparentMapper):
+            return False
+        meta = self.source_backend.master.find_one({"_id": src_name}) or {}
+        return meta.get("merger", "upsert") == "upsert"
+
+    async def merge_source(self, src_name, batch_size=100000, ids=None, job_manager=None):
+        if isinstance(self.get_mapper_for_source(src_name, init=False), Ensembl2Entrez):
+            return await self.merge_source_partitioned(src_name, batch_size, ids, job_manager)
+        if ids is None and self.server_side_mergeable(src_name):
+            partitions = id_partitions(
+                self.source_backend[src_name],
+                self.build_config.get("server_side_merge_partitions", SERVER_SIDE_MERGE_PARTITIONS),
+            )
+            if partitions is not None:
+                return await self.merge_source_server_side(src_name, partitions, job_manager)
+            self.logger.warning("Source '%s' has _ids of different types, merging documents one by one", src_name)
+        return await super().merge_source(src_name, batch_size=batch_size, ids=ids, job_manager=job_manager)
+
+    async def merge_source_server_side(self, src_name, partitions, job_manager):
+        """
+        Merge the source with one $merge aggregation per _id range, run
+        concurrently. Like the default merger (and cleaner), top-level fields
+        but taxid are set on existing root documents, others are ignored.
+        """
+        assert job_manager
+        col_name = self.source_backend[src_name].name
+        target_db = self.target_backend.target_collection.database.name
+        target_name = self.target_backend.target_name
+        # like the default merger, only update root documents, if any
+        upsert = not self.get_root_document_sources()
+        self.logger.info("Merging '%s' server-side, in %d partitions", src_name, len(partitions))
+        jobs = []
+        for num, (lower, upper, count) in enumerate(partitions, start=1):
+            pinfo = self.get_pinfo()
+            pinfo["step"] = src_name
+            pinfo["description"] = "partition #%d/%d (server-side)" % (num, len(partitions))
+            job = await job_manager.defer_to_thread(
+                pinfo, partial(merge_partition, col_name, target_db, target_name, lower, upper, upsert)
+            )
+            jobs.append(job)
+            await asyncio.sleep(0.0)
+        await asyncio.gather(*jobs)
+        return {"%s" % src_name: sum(count for _, _, count in partitions)}
+
+    async def merge_source_partitioned(self, src_name, batch_size, ids, job_manager):
+        """
+        ensembl to entrez ID conversion can produce duplicates, documents
+        converted to the same _id, which are not handled by mongo as
+        concurrent upserts and produce duplicated errors. Source _ids are
+        hash-partitioned on their converted _id: duplicates are always
+        in the same partition, whose batches are merged one after the
+        other by a single job, while partitions are merged concurrently.
+        """
+        assert job_manager
+        col = self.source_backend[src_name]
+        mapper = self.get_mapper_for_source(src_name)
+        num_partitions = self.build_config.get("ensembl_merge_partitions", ENSEMBL_MERGE_PARTITIONS)
+        _query = self.generate_document_query(src_name)
+        if ids is not None:
+            id_provider = [ids]
+        elif _query:
+            id_provider = (
+                [d["_id"] for d in docs]
+                for docs in mongo.doc_feeder(
+                    col, query=_query, step=batch_size, inbatch=True, fields={"_id": 1}, logger=self.logger
+                )
+            )
+        else:
+            id_provider = mongo.id_feeder(col, batch_size=batch_size * 10, logger=self.logger)
+        partitions = [[] for _ in range(num_partitions)]
+        for big_doc_ids in id_provider:
+            for _id in big_doc_ids:
+                partitions[partition_of(mapper.translate(_id, transparent=True), num_partitions)].append(_id)
+            await asyncio.sleep(0.0)
+
+        # same as default merge_source()
+        upsert = not self.get_root_document_sources() or src_name in self.get_root_document_sources()
+        meta = self.source_backend.master.find_one({"_id": src_name}) or {}
+        merger = meta.get("merger", "upsert")
+        merger_kwargs = meta.get("merger_kwargs")
+        doc_cleaner = self.document_cleaner(src_name)
+        self.logger.info("Merging '%s' in %d partitions of converted _ids, using %s", src_name, num_partitions, merger)
+        jobs = []
+        for num, part_ids in enumerate(partitions, start=1):
+            if not part_ids:
+                continue
+            pinfo = self.get_pinfo()
+            pinfo["step"] = src_name
+            pinfo["description"] = "partition #%d/%d (%d documents)" % (num, num_partitions, len(part_ids))
+            job = await job_manager.defer_to_process(
+                pinfo,
+                partial(
+                    partition_merger_worker,
+                    col.name,
+                    self.target_backend.target_name,
+                    part_ids,
+                    batch_size,
+                    mapper,
+                    doc_cleaner,
+                    upsert,
+                    merger,
+                    num,
+                    merger_kwargs,
+                ),
+            )
+            jobs.append(job)
+        await asyncio.gather(*jobs)
+        return {"%s" % src_name: sum(len(part_ids) for part_ids in partitions)}
+
+    async def merge_sources(self, source_names, steps=("merge", "post"), batch_size=100000, ids=None, job_manager=None):
+        merge_stats = await super().merge_sources(
+            source_names, steps=steps, batch_size=batch_size, ids=ids, job_manager=job_manager
+        )
+        if "post" in steps:
+            await self.hash_documents(batch_size, job_manager)
+        return merge_stats
+
+    async def hash_documents(self, batch_size, job_manager):
+        """
+        Store the content hash of every merged document, in a side collection
+        differs use to only compare documents which changed between builds.
+        """
+        self.register_status("building", transient=True, init=True, job={"step": "hash"})
+        tgt_db = mongo.get_target_db()
+        tgt_db[hash_collection_name(self.target_name)].drop()
+        jobs = []
+        id_provider = mongo.id_feeder(tgt_db[self.target_name], batch_size=batch_size, logger=self.logger)
+        for num, doc_ids in enumerate(id_provider, start=1):
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "hash"
+            pinfo["description"] = "batch #%d" % num
+            job = await job_manager.defer_to_process(pinfo, partial(hash_worker, self.target_name, doc_ids))
+            jobs.append(job)
+        cnt = sum(await asyncio.gather(*jobs))
+        self.logger.info("Stored content hashes of %d documents", cnt)
+        self.register_status("success", job={"step": "hash"})
+
+    def clean_old_collections(self):
+        super(MyGeneDataBuilder, self).clean_old_collections()
+        # content hashes of the archived builds just dropped, see hash_documents
+        db = mongo.get_target_db()
+        col_names = set(db.collection_names())
+        for col_name in col_names:
+            if col_name.startswith(HASH_COLLECTION_PREFIX) and col_name[len(HASH_COLLECTION_PREFIX):] not in col_names:
+                self.logger.info("Cleaning content hashes collection '%s'", col_name)
+                db[col_name].drop()
+
     def post_merge(self, source_names, batch_size, job_manager):
         tgt = mongo.get_target_db()[self.target_name]
         # background=true or it'll lock the whole database...
@@ -85,66 +292,115 @@ class MyGeneDataBuilder(builder.DataBuilder):
         # enrich with some specific mygene counts, specially regarding ensembl vs. entrez
         tgt = mongo.get_target_db()[self.target_name]
         self.stats["total_genes"] = tgt.estimated_document_count()
-        # entrez genes are digits only (also, don't count entrez_gene collection,
-        # because tgt can be a subset, we have to work with the merged collection)
-        self.logger.debug("Counting 'total_entrez_genes'")
-        entrez_cnt = tgt.count_documents({"entrezgene": {"$exists": 1}})
-        self.stats["total_entrez_genes"] = entrez_cnt
-        # ensembl genes aount are taken from :
-        # 1. "ensembl" field, but it can a list => use aggregation.
-        #    Note: "ensembl.0" means first element of the list, so it implicitely
-        #    select doc with a list. Finally, filtering with {$type:"array"} doesn't work because
-        #    mongo filters this on the most inner field (that's weird, but it is what is it...)
-        # 2. when document is root doc coming from ensembl_gene collection without a "ensembl" key ("orphan")
-        # Note: we can't create a sparce or conditional index to help querying "ensembl"
-        # because data is too long for an index key, and "hashed" mode doesn't work because list aren't supported
-        # Queries are gonna use colscan strategy...
-        self.logger.debug("Counting 'total_ensembl_genes'")
-        res = tgt.aggregate(
-            [
-                {"$match": {"ensembl.0": {"$exists": True}}},
-                {"$project": {"num_gene": {"$size": "$ensembl"}}},
-                {"$group": {"_id": None, "sum": {"$sum": "$num_gene"}}},
-            ]
-        )
+        # all the other counters are computed in a single collection scan
+        # (also, don't count entrez_gene collection, because tgt can be
+        # a subset, we have to work with the merged collection)
+        self.logger.debug("Counting ensembl and entrez genes, and species")
         try:
-            list_count = next(res)["sum"]
+            counts = next(tgt.aggregate(GENE_STATS_PIPELINE, allowDiskUse=True))
         except StopIteration:
-            list_count = 0
-        object_count = tgt.count_documents({"ensembl": {"$type": "object"}})
-        orphan_count = tgt.count_documents({"_id": {"$regex": """\\w"""}, "ensembl": {"$exists": 0}})
-        total_ensembl_genes = list_count + object_count + orphan_count
-        self.stats["total_ensembl_genes"] = total_ensembl_genes
+            counts = {}
+        # entrez genes are docs with an "entrezgene" field
+        self.stats["total_entrez_genes"] = counts.get("entrez", 0)
+        # ensembl genes are taken from the "ensembl" field, a list or an object,
+        # and from root docs without a "ensembl" key ("orphan")
+        self.stats["total_ensembl_genes"] = counts.get("ensembl", 0)
         # this one can't be computed from merged collection, and is only valid when build
         # involves all data (no filter, no subset)
-        self.logger.debug("Counting 'total_ensembl_genes_mapped_to_entrez'")
-        # this one is similar to total_ensembl_genes except we cross with entrezgene (ie. so they're mapped)
-        try:
-            list_count = next(
-                tgt.aggregate(
-                    [
-                        {"$match": {"$and": [{"ensembl.0": {"$exists": True}}, {"entrezgene": {"$exists": 1}}]}},
-                        {"$project": {"num_gene": {"$size": "$ensembl"}}},
-                        {"$group": {"_id": None, "sum": {"$sum": "$num_gene"}}},
-                    ]
-                )
-            )["sum"]
-        except StopIteration:
-            list_count = 0
-        object_count = tgt.count_documents({"$and": [{"ensembl": {"$type": "object"}}, {"entrezgene": {"$exists": 1}}]})
-        mapped = list_count + object_count
-        self.stats["total_ensembl_genes_mapped_to_entrez"] = mapped
+        self.stats["total_ensembl_genes_mapped_to_entrez"] = counts.get("ensembl_mapped", 0)
         # ensembl gene contains letters (if it wasn't, it means it would only contain digits
-        # so it would be an entrez gene (\\D = non-digits, can't use \\w as a digit *is* a letter)
-        self.logger.debug("Counting 'total_ensembl_only_genes'")
-        ensembl_unmapped = tgt.count_documents({"_id": {"$regex": """\\D"""}})
-        self.stats["total_ensembl_only_genes"] = ensembl_unmapped
-        self.logger.debug("Counting 'total_species'")
-        self.stats["total_species"] = len(tgt.distinct("taxid"))
+        # so it would be an entrez gene
+        self.stats["total_ensembl_only_genes"] = counts.get("ensembl_only", 0)
+        self.stats["total_species"] = len([taxid for taxid in counts.get("taxids", []) if taxid is not None])
 
         return self.stats
 
 
+class MyGeneBuilderManager(builder.BuilderManager):
+
+    def delete_merged_data(self, merge_name):
+        super(MyGeneBuilderManager, self).delete_merged_data(merge_name)
+        # content hashes, see MyGeneDataBuilder.hash_documents
+        mongo.get_target_db()[hash_collection_name(merge_name)].drop()
+
+
 def cleaner(doc):
     doc.pop("taxid", None)
     return doc
+
+
+def partition_of(_id, num_partitions):
+    """Partition of a converted _id, the same in every process"""
+    return zlib.crc32(str(_id).encode()) % num_partitions
+
+
+def partition_merger_worker(
+    col_name, dest_name, ids, batch_size, mapper, cleaner, upsert, merger, partition_num, merger_kwargs=None
+):
+    """Merge the _ids of a partition, batch after batch, see merger_worker"""
+    cnt = 0
+    for batch_num, doc_ids in enumerate(iter_n(ids, batch_size), start=1):
+        batch_id = "%s.%s" % (partition_num, batch_num)
+        res = builder.merger_worker(
+            col_name, dest_name, doc_ids, mapper, cleaner, upsert, merger, batch_id, merger_kwargs
+        )
+        # like merge_source's batch_merged, errors are logged by merger_worker, only reported here
+        if type(res) != int:
+            raise builder.BuilderException(
+                "Batch #%s of partition #%s failed while merging source '%s' [%s]"
+                % (batch_num, partition_num, col_name, res)
+            )
+        cnt += res
+    return cnt
+
+
+def id_partitions(col, num):
+    """
+    Split a collection in about 'num' _id ranges of the same size, return
+    (lower, upper, count) tuples, the lower bound included and the upper
+    excluded, None when unbounded. Range queries only match values of the
+    bounds type, so None is returned when _ids have different types.
+    """
+    buckets = list(
+        col.aggregate(
+            [
+                {
+                    "$bucketAuto": {
+                        "groupBy": "$_id",
+                        "buckets": num,
+                        "output": {"count": {"$sum": 1}, "types": {"$addToSet": {"$type": "$_id"}}},
+                    }
+                }
+            ],
+            allowDiskUse=True,
+        )
+    )
+    if len({_type for bucket in buckets for _type in bucket["types"]}) > 1:
+        return None
+    bounds = [None] + [bucket["_id"]["min"] for bucket in buckets[1:]] + [None]
+    return [(bounds[i], bounds[i + 1], bucket["count"]) for i, bucket in enumerate(buckets)]
+
+
+def merge_partition(col_name, target_db, target_name, lower, upper, upsert=False):
+    id_range = {}
+    if lower is not None:
+        id_range["$gte"] = lower
+    if upper is not None:
+        id_range["$lt"] = upper
+    pipeline = [
+        {"$match": {"_id": id_range} if id_range else {}},
+        # same as cleaner()
+        {"$project": {"taxid": 0}},
+        # whenMatched "merge" sets top-level fields, like the default merger's $set,
+        # documents without a root document are discarded, unless upserting
+        {
+            "$merge": {
+                "into": {"db": target_db, "coll": target_name},
+                "on": "_id",
+                "whenMatched": "merge",
+                "whenNotMatched": "insert" if upsert else "discard",
+            }
+        },
+    ]
+    mongo.get_src_db()[col_name].aggregate(pipeline, allowDiskUse=True)
+    return True
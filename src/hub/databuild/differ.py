@@ -0,0 +1,241 @@
+"""
+    Content hashes of merged documents, for cheap diffs.
+
+    Once sources are merged, MyGeneDataBuilder stores a hash of each
+    document in a side collection, named after the merged collection
+    (see hash_collection_name). Its prefix never matches a build name,
+    so that builders don't count it as an archived build:
+
+        {"_id": <document _id>, "h": <blake2b of the document canonical JSON>}
+
+    Differs tell added, deleted and changed documents apart from the
+    hashes of both builds, only added and changed documents are loaded.
+    Builds without hashes are diffed as usual.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from functools import partial
+
+import biothings.utils.mongo as mongo
+from biothings import config as btconfig
+from biothings.hub.databuild.backend import create_backend, generate_folder
+from biothings.hub.databuild.differ import JsonDiffer
+from biothings.utils.backend import DocMongoBackend
+from biothings.utils.common import dump, get_timestamp, md5sum, rmdashfr
+from biothings.utils.diff import diff_docs_jsonpatch
+from biothings.utils.hub_db import get_src_build
+from biothings.utils.serializer import to_json_file
+
+HASH_COLLECTION_PREFIX = "hashes_"
+
+
+def hash_collection_name(col_name):
+    return HASH_COLLECTION_PREFIX + col_name
+
+
+def doc_hash(doc):
+    """
+    Stable hash of a document, whatever its keys order.
+    """
+    data = json.dumps(doc, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(data.encode(), digest_size=16).digest()
+
+
+def hash_worker(col_name, ids):
+    """
+    Store the hashes of these documents of a target collection.
+    """
+    db = mongo.get_target_db()
+    hashes = [{"_id": doc["_id"], "h": doc_hash(doc)} for doc in db[col_name].find({"_id": {"$in": list(ids)}})]
+    if hashes:
+        db[hash_collection_name(col_name)].insert_many(hashes, ordered=False)
+    return len(hashes)
+
+
+def get_hashes(backend, ids):
+    col = backend.target_collection
+    hashes = col.database[hash_collection_name(col.name)]
+    return {doc["_id"]: doc["h"] for doc in hashes.find({"_id": {"$in": ids}})}
+
+
+def has_hashes(backend):
+    """
+    Whether every document of a merged collection has its hash stored.
+    """
+    if not isinstance(backend, DocMongoBackend):
+        return False
+    col = backend.target_collection
+    count = col.count_documents({})
+    return count > 0 and col.database[hash_collection_name(col.name)].count_documents({}) == count
+
+
+def dump_diff_file(result, diff_folder, batch_num):
+    file_name = os.path.join(diff_folder, "%s.pyobj" % str(batch_num))
+    dump(result, file_name)
+    # compute md5 so when downloaded, users can check integreity
+    return {"name": os.path.basename(file_name), "md5sum": md5sum(file_name), "size": os.stat(file_name).st_size}
+
+
+def diff_worker_hashed_new_vs_old(
+    id_list_new, old_db_col_names, new_db_col_names, batch_num, diff_folder, exclude=None, selfcontained=False
+):
+    """
+    Like biothings' diff_worker_new_vs_old, but added and common documents
+    are told apart from their hashes: old documents are only loaded when
+    their hash changed, new ones when added or changed.
+    """
+    new = create_backend(new_db_col_names, follow_ref=True)
+    old = create_backend(old_db_col_names, follow_ref=True)
+    hashes_old = get_hashes(old, id_list_new)
+    hashes_new = get_hashes(new, id_list_new)
+    id_in_new = [_id for _id in id_list_new if _id not in hashes_old]
+    changed = [_id for _id in id_list_new if _id in hashes_old and hashes_old[_id] != hashes_new.get(_id)]
+    _updates = []
+    if changed:
+        _updates = diff_docs_jsonpatch(old, new, changed, exclude_attrs=exclude or [])
+    _result = {
+        "add": id_in_new,
+        "update": _updates,
+        "delete": [],
+        "source": new.target_name,
+        "timestamp": get_timestamp(),
+    }
+    if selfcontained:
+        # consume generator as result will be pickled
+        _result["add"] = [d for d in new.mget_from_ids(id_in_new)]
+    summary = {"add": len(id_in_new), "update": len(_updates), "delete": 0}
+    if _updates or id_in_new:
+        summary["diff_file"] = dump_diff_file(_result, diff_folder, batch_num)
+    return summary
+
+
+def diff_worker_hashed_old_vs_new(id_list_old, new_db_col_names, batch_num, diff_folder):
+    """
+    Like biothings' diff_worker_old_vs_new, deleted documents
+    are found from hashes, no document is loaded.
+    """
+    new = create_backend(new_db_col_names, follow_ref=True)
+    hashes_new = get_hashes(new, id_list_old)
+    id_in_old = [_id for _id in id_list_old if _id not in hashes_new]
+    _result = {
+        "delete": id_in_old,
+        "add": [],
+        "update": [],
+        "source": new.target_name,
+        "timestamp": get_timestamp(),
+    }
+    summary = {"add": 0, "update": 0, "delete": len(id_in_old)}
+    if id_in_old:
+        summary["diff_file"] = dump_diff_file(_result, diff_folder, batch_num)
+    return summary
+
+
+class HashedJsonDiffer(JsonDiffer):
+    """
+    JsonDiffer whose "content" step diffs builds from their hashes,
+    when both have them, see diff_content_hashed.
+    """
+
+    async def diff_cols(self, old_db_col_names, new_db_col_names, batch_size, steps, mode=None, exclude=None):
+        if isinstance(steps, tuple):
+            steps = list(steps)
+        elif isinstance(steps, str):
+            steps = [steps]
+        content_new = create_backend(new_db_col_names, follow_ref=True)
+        content_old = create_backend(old_db_col_names, follow_ref=True)
+        if (
+            "content" not in steps
+            or content_old == content_new
+            or not (has_hashes(content_old) and has_hashes(content_new))
+        ):
+            return await super().diff_cols(old_db_col_names, new_db_col_names, batch_size, steps, mode, exclude)
+
+        diff_folder = generate_folder(btconfig.DIFF_PATH, old_db_col_names, new_db_col_names)
+        if mode != "force" and os.path.exists(diff_folder):
+            if mode == "purge":
+                rmdashfr(diff_folder)
+            elif mode != "resume":
+                raise FileExistsError(f"Found existing files in '{diff_folder}', use mode='purge'")
+        # the "mapping" step (if any) also initializes self.metadata, the content
+        # step is then done here, and the following steps by BaseDiffer again
+        await super().diff_cols(
+            old_db_col_names, new_db_col_names, batch_size, [step for step in steps if step == "mapping"],
+            mode, exclude,
+        )
+        # restore what diff_cols removes once done
+        self.metadata.pop("diff_folder", None)
+        if self.new.target_collection.database.name == btconfig.DATA_TARGET_DATABASE:
+            self.metadata["_meta"] = self.get_metadata()
+            build = get_src_build().find_one({"_id": self.new.target_collection.name})
+            self.metadata["build_config"] = build.get("build_config")
+        await self.diff_content_hashed(old_db_col_names, new_db_col_names, batch_size, diff_folder, exclude)
+        to_json_file(self.metadata, open(self.metadata_filename, "w"), indent=True)
+        await super().diff_cols(
+            old_db_col_names, new_db_col_names, batch_size,
+            [step for step in steps if step not in ("mapping", "content")], mode, exclude,
+        )
+        return self.metadata["diff"]["stats"]
+
+    async def diff_content_hashed(self, old_db_col_names, new_db_col_names, batch_size, diff_folder, exclude):
+        """
+        Same as BaseDiffer.diff_cols "content" step,
+        with diff workers comparing hashes.
+        """
+        content_new = create_backend(new_db_col_names, follow_ref=True)
+        content_old = create_backend(old_db_col_names, follow_ref=True)
+        diff_stats = self.metadata["diff"]["stats"]
+        selfcontained = "selfcontained" in self.diff_type
+        self.register_status("diffing", transient=True, init=True, job={"step": "diff-content"})
+
+        def diffed(f):
+            res = f.result()
+            for key in ("add", "update", "delete"):
+                diff_stats[key] += res[key]
+            if res.get("diff_file"):
+                self.metadata["diff"]["files"].append(res["diff_file"])
+            self.logger.info("(Updated: %s, Added: %s, Deleted: %s)", res["update"], res["add"], res["delete"])
+
+        cnt = 0
+        jobs = []
+        pinfo = self.get_pinfo()
+        pinfo["source"] = "%s vs %s" % (content_new.target_name, content_old.target_name)
+        pinfo["step"] = "content: new vs old (hashes)"
+        for id_list_new in mongo.id_feeder(content_new, batch_size=batch_size):
+            cnt += 1
+            pinfo["description"] = "batch #%s" % cnt
+            job = await self.job_manager.defer_to_process(
+                pinfo,
+                partial(
+                    diff_worker_hashed_new_vs_old,
+                    id_list_new, old_db_col_names, new_db_col_names, cnt, diff_folder, exclude, selfcontained,
+                ),
+            )
+            job.add_done_callback(diffed)
+            jobs.append(job)
+        await asyncio.gather(*jobs)
+
+        jobs = []
+        pinfo = self.get_pinfo()
+        pinfo["source"] = "%s vs %s" % (content_old.target_name, content_new.target_name)
+        pinfo["step"] = "content: old vs new (hashes)"
+        for id_list_old in mongo.id_feeder(content_old, batch_size=batch_size):
+            cnt += 1
+            pinfo["description"] = "batch #%s" % cnt
+            job = await self.job_manager.defer_to_process(
+                pinfo, partial(diff_worker_hashed_old_vs_new, id_list_old, new_db_col_names, cnt, diff_folder)
+            )
+            job.add_done_callback(diffed)
+            jobs.append(job)
+        await asyncio.gather(*jobs)
+        self.logger.info(
+            "Diffed content from hashes (Updated: %s, Added: %s, Deleted: %s)",
+            diff_stats["update"], diff_stats["add"], diff_stats["delete"],
+        )
+        self.register_status("success", job={"step": "diff-content"})
+
+
+class HashedSelfContainedJsonDiffer(HashedJsonDiffer):
+    diff_type = "jsondiff-selfcontained"
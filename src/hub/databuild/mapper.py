@@ -1,6 +1,49 @@
+import hashlib
+import os
+import shutil
+
 import biothings.hub.databuild.mapper as mapper
+import gridfs
 from biothings.utils.common import loadobj
 
+import config
+from hub.datatransform.idtable import GeneIdTable, StringIdTable, write_atomic
+
+ENTREZ_GENEID_FILE = "entrez_gene__geneid_table.idx"
+ENSEMBL2ENTREZ_FILES = [
+    "ensembl_metazoa_gene__2entrezgene_list.pyobj",
+    "ensembl_protists_gene__2entrezgene_list.pyobj",
+    "ensembl_fungi_gene__2entrezgene_list.pyobj",
+    "ensembl_plant_gene__2entrezgene_list.pyobj",
+    "ensembl_gene__2entrezgene_list.pyobj",
+]
+
+
+def load_table(table_class, name, db, filenames, build):
+    """
+    Return the id table built from these GridFS files. It is built once,
+    calling build(path), in a file of CACHE_FOLDER named after the GridFS
+    files versions, then memory-mapped by every process loading it.
+    """
+    fs = gridfs.GridFS(db)
+    # some files are replaced under the same _id (dump2gridfs), their upload date tells versions apart
+    versions = ",".join(
+        "%s@%s" % (gridout._id, gridout.upload_date.isoformat())
+        for gridout in (fs.get_last_version(filename) for filename in filenames)
+    )
+    path = os.path.join(
+        config.CACHE_FOLDER, "%s_%s.idx" % (name, hashlib.sha1(versions.encode()).hexdigest()))
+    if not os.path.exists(path):
+        os.makedirs(config.CACHE_FOLDER, exist_ok=True)
+        build(path)
+    return table_class.load(path)
+
+
+def download_table(db, filename, path):
+    fs = gridfs.GridFS(db)
+    with write_atomic(path) as table_file:
+        shutil.copyfileobj(fs.get_last_version(filename), table_file)
+
 
 class EntrezRetired2Current(mapper.IDBaseMapper):
 
@@ -10,10 +53,15 @@ class EntrezRetired2Current(mapper.IDBaseMapper):
 
     def load(self):
         if self.map is None:
-            # this is a whole dict containing all entrez _id, wether it's a current or retired one.
-            # it means most of the data has assoction with same _id as key and as value. It consumes memory
-            # but it's a way to know the entrez perimeter (what entrez _ids exist and should be considered
-            self.map = loadobj(("entrez_gene__geneid_d.pyobj", self.db_provider()), mode="gridfs")
+            # all entrez _id, wether it's a current or retired one. current _ids are the
+            # entrez perimeter (what entrez _ids exist and should be considered), they map
+            # to themselves and only their list is stored, see GeneIdTable. The table file
+            # is stored as is in GridFS by the entrez_gene uploader.
+            db = self.db_provider()
+            self.map = load_table(
+                GeneIdTable, "entrez_geneid", db, [ENTREZ_GENEID_FILE],
+                lambda path: download_table(db, ENTREZ_GENEID_FILE, path),
+            )
 
     def process(self, *args, **kwargs):
         raise UserWarning("Don't call me, please")
@@ -32,20 +80,19 @@ class Ensembl2Entrez(mapper.IDBaseMapper):
     def load(self):
         if self.map is None:
             self.retired2current.load()
-            self.map = {}
-
-            for li in [
-                "ensembl_metazoa_gene__2entrezgene_list.pyobj",
-                "ensembl_protists_gene__2entrezgene_list.pyobj",
-                "ensembl_fungi_gene__2entrezgene_list.pyobj",
-                "ensembl_plant_gene__2entrezgene_list.pyobj",
-                "ensembl_gene__2entrezgene_list.pyobj",
-            ]:
-                # filter out those deprecated entrez gene ids
-                for ensembl_id, entrez_id in loadobj((li, self.db_provider()), mode="gridfs"):
-                    entrez_id = int(entrez_id)
-                    if entrez_id in self.retired2current:
-                        self.map[ensembl_id] = self.retired2current.translate(entrez_id)
+            db = self.db_provider()
+            self.map = load_table(
+                StringIdTable, "ensembl2entrez", db, ENSEMBL2ENTREZ_FILES + [ENTREZ_GENEID_FILE],
+                lambda path: StringIdTable.build(self._pairs(db), path),
+            )
+
+    def _pairs(self, db):
+        for li in ENSEMBL2ENTREZ_FILES:
+            # filter out those deprecated entrez gene ids
+            for ensembl_id, entrez_id in loadobj((li, db), mode="gridfs"):
+                entrez_id = int(entrez_id)
+                if entrez_id in self.retired2current:
+                    yield ensembl_id, self.retired2current.translate(entrez_id)
 
 
 class Ensembl2EntrezRoot(mapper.IDBaseMapper):
@@ -59,7 +106,7 @@ class Ensembl2EntrezRoot(mapper.IDBaseMapper):
         self.ensembl2entrez = ensembl2entrez
 
     def load(self):
-        # this mapper strictly use the same mapping dict as its base class
+        # this mapper strictly use the same mapping table as its base class
         if self.map is None:
             self.ensembl2entrez.load()
             self.map = self.ensembl2entrez.map
@@ -72,9 +119,10 @@ class Ensembl2EntrezRoot(mapper.IDBaseMapper):
         Note: it's not really a conversion is this case, it's a filter, we're filtering out
         convertible docs to only keep ensembl docs
         """
+        if self.need_load():
+            self.load()
         for doc in docs:
-            _new = self.translate(doc[key_to_convert], transparent=False)
-            if _new:
+            if self.map.get(doc[key_to_convert]) is not None:
                 continue  # already as entrez_gene
             else:
                 yield doc  # return original
@@ -0,0 +1,347 @@
+"""
+    Adaptive throttling of ES diff syncers.
+
+    Syncing diffs to the prod cluster competes with live traffic: too many
+    sync workers saturate its write thread pool, too few make the sync last
+    all night. Adaptive syncers apply diff files with a number of workers and
+    a bulk batch size decided by a SyncThrottle, from the latency of bulk
+    requests, the bulk requests rejected by the cluster (429 errors) and the
+    latency of the live search queries, all within configured bounds (see
+    SYNC_THROTTLE in config). Diff files rejected by the cluster are applied
+    again later, applying a diff file is idempotent. Throttle decisions are
+    registered with the "sync-content" job.
+"""
+
+import asyncio
+import copy
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial, wraps
+
+from biothings.hub.databuild.syncer import (
+    ESJsonDiffSelfContainedSyncer,
+    ESJsonDiffSyncer,
+    SyncerException,
+    ThrottlerSyncer,
+    sync_es_jsondiff_worker,
+)
+from biothings.utils.es import ESIndexer, get_es
+from elasticsearch.helpers import BulkIndexError
+
+# number of throttle decisions kept in job metrics
+MAX_DECISIONS = 50
+# ESIndexer methods sending one bulk request per call, see timed_bulk_requests
+BULK_METHODS = ("index_bulk", "delete_docs")
+
+
+class SyncThrottle(object):
+    """
+    Number of sync workers and bulk batch size, adjusted after each diff file:
+
+        - rejected bulk requests, or slow live search queries, halve workers
+        - slow bulk requests halve the batch size
+        - otherwise, workers are increased one by one up to their maximum,
+          then the batch size by 25% up to its maximum
+    """
+
+    def __init__(
+        self,
+        max_workers,
+        batch_size,
+        min_workers=1,
+        min_batch_size=500,
+        max_batch_size=None,
+        bulk_latency=5.0,
+        search_latency=100.0,
+        backoff=30,
+        max_retries=10,
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size or batch_size, min_batch_size)
+        self.bulk_latency = bulk_latency  # max seconds per bulk request
+        self.search_latency = search_latency  # max milliseconds per live search query
+        self.backoff = backoff  # seconds to wait after rejections
+        self.max_retries = max_retries  # rejections of a diff file before failing
+        # start half-way, the cluster tells soon enough
+        self.workers = max(self.min_workers, self.max_workers // 2)
+        self.batch_size = max(self.min_batch_size, min(batch_size, self.max_batch_size))
+        self.rejections = 0
+        self.decisions = []
+        self._latencies = []
+        self._rejected = 0
+
+    def record(self, res):
+        """
+        Record the result of a sync worker, see throttled_sync_es_jsondiff_worker.
+        """
+        if res.get("rejected"):
+            self._rejected += 1
+            self.rejections += 1
+        elif res.get("bulk_latency") is not None:
+            self._latencies.append(res["bulk_latency"])
+
+    def adjust(self, search_latency=None):
+        """
+        Decide workers and batch size from the results recorded
+        since the last call, return the decision (or None).
+        """
+        bulk_latency = max(self._latencies) if self._latencies else None
+        reasons = []
+        workers, batch_size = self.workers, self.batch_size
+        if self._rejected:
+            reasons.append("%d rejected" % self._rejected)
+        if search_latency is not None and search_latency > self.search_latency:
+            reasons.append("search latency %.1fms" % search_latency)
+        if reasons:
+            workers = max(self.min_workers, workers // 2)
+        if bulk_latency is not None and bulk_latency > self.bulk_latency:
+            reasons.append("bulk latency %.1fs" % bulk_latency)
+            batch_size = max(self.min_batch_size, batch_size // 2)
+        if not reasons and bulk_latency is not None:
+            if workers < self.max_workers:
+                workers += 1
+            else:
+                batch_size = min(self.max_batch_size, int(batch_size * 1.25))
+        self._latencies = []
+        self._rejected = 0
+        if (workers, batch_size) == (self.workers, self.batch_size):
+            return None
+        decision = {
+            "at": datetime.now().astimezone(),
+            "workers": workers,
+            "batch_size": batch_size,
+            "bulk_latency": bulk_latency,
+            "search_latency": search_latency,
+            "reasons": reasons,
+        }
+        self.workers, self.batch_size = workers, batch_size
+        self.decisions.append(decision)
+        return decision
+
+    def metrics(self):
+        return {
+            "workers": self.workers,
+            "batch_size": self.batch_size,
+            "rejections": self.rejections,
+            "decisions": self.decisions[-MAX_DECISIONS:],
+        }
+
+
+def is_rejection(exc):
+    """
+    Whether an ES error is a rejected request (429, es_rejected_execution_exception).
+    """
+    if isinstance(exc, BulkIndexError):
+        return any(info.get("status") == 429 for error in exc.errors for info in error.values())
+    status = getattr(getattr(exc, "meta", None), "status", None) or getattr(exc, "status_code", None)
+    return status == 429 or "es_rejected_execution_exception" in str(exc)
+
+
+@contextmanager
+def timed_bulk_requests():
+    """
+    Record the duration of the ES bulk requests sent meanwhile, as a list of
+    seconds. Sync workers create their own indexer, so the ESIndexer methods
+    are wrapped on the class, only in the worker process running the sync.
+    """
+    timings = []
+
+    def timed(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings.append(time.time() - started)
+
+        return wrapper
+
+    methods = {name: ESIndexer.__dict__[name] for name in BULK_METHODS}
+    for name, method in methods.items():
+        setattr(ESIndexer, name, timed(method))
+    try:
+        yield timings
+    finally:
+        for name, method in methods.items():
+            setattr(ESIndexer, name, method)
+
+
+def throttled_sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size, cnt, *args, **kwargs):
+    """
+    sync_es_jsondiff_worker, also returning the mean time of its bulk
+    requests, or only {"rejected": 1} if the cluster rejected one. Loading
+    the diff file and documents to index isn't part of the bulk latency.
+    """
+    with timed_bulk_requests() as timings:
+        try:
+            res = sync_es_jsondiff_worker(diff_file, es_config, new_db_col_names, batch_size, cnt, *args, **kwargs)
+        except Exception as e:
+            if is_rejection(e):
+                return {"rejected": 1}
+            raise
+    res["bulk_latency"] = sum(timings) / len(timings) if timings else None
+    return res
+
+
+def search_stats(es_host):
+    """
+    Return the total (number, milliseconds) of search queries of the cluster.
+    """
+    stats = get_es(es_host).nodes.stats(metric="indices", index_metric="search")
+    searches = [node["indices"]["search"] for node in stats["nodes"].values()]
+    return sum(s["query_total"] for s in searches), sum(s["query_time_in_millis"] for s in searches)
+
+
+class AdaptiveThrottlerSyncer(ThrottlerSyncer):
+    """
+    ThrottlerSyncer, still capping the number of sync jobs of all
+    running syncs to max_sync_workers, with an adaptive number
+    of workers and batch size for each sync, see SyncThrottle.
+    """
+
+    def __init__(self, max_sync_workers, throttle_settings=None, *args, **kwargs):
+        super(AdaptiveThrottlerSyncer, self).__init__(max_sync_workers, *args, **kwargs)
+        self.throttle_settings = throttle_settings or {}
+        self.throttle = None
+        self._search_stats = None
+
+    async def search_latency(self, es_host):
+        """
+        Mean latency (ms) of the live search queries since the last call.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            stats = await loop.run_in_executor(None, partial(search_stats, es_host))
+        except Exception as e:
+            self.logger.warning("Can't get search stats from '%s': %s", es_host, e)
+            return None
+        previous, self._search_stats = self._search_stats, stats
+        if previous is None or stats[0] <= previous[0]:
+            return None
+        return (stats[1] - previous[1]) / (stats[0] - previous[0])
+
+    async def sync_cols(
+        self,
+        diff_folder,
+        batch_size=10000,
+        mode=None,
+        force=False,
+        target_backend=None,
+        steps=("mapping", "content", "meta", "post"),
+        debug=False,
+    ):
+        """
+        Same as BaseSyncer.sync_cols, with a throttled "content" step.
+        """
+        if isinstance(steps, str):
+            steps = [steps]
+        kwargs = {"batch_size": batch_size, "mode": mode, "force": force, "target_backend": target_backend}
+        summary = {}
+        if "mapping" in steps:
+            summary.update(await super().sync_cols(diff_folder, steps=["mapping"], debug=debug, **kwargs))
+        if "content" in steps:
+            summary.update(await self.sync_content(diff_folder, batch_size, force, target_backend, debug))
+        other_steps = [step for step in steps if step not in ("mapping", "content")]
+        if other_steps:
+            summary.update(await super().sync_cols(diff_folder, steps=other_steps, debug=debug, **kwargs))
+        return summary
+
+    async def sync_content(self, diff_folder, batch_size, force, target_backend, debug):
+        self.target_backend = target_backend
+        self.load_metadata(diff_folder)
+        selfcontained = "selfcontained" in self._meta["diff"]["type"]
+        old_db_col_names = self.get_target_backend()
+        new_db_col_names = self._meta["new"]["backend"]
+        self.setup_log(new_db_col_names)
+        self.throttle = SyncThrottle(self.max_sync_workers, batch_size, **self.throttle_settings)
+        self._search_stats = None
+        await self.search_latency(old_db_col_names[0])
+
+        pinfo = self.get_pinfo()
+        self.synced_cols = "%s -> %s" % (old_db_col_names, new_db_col_names)
+        pinfo["source"] = self.synced_cols
+        pinfo["step"] = "content"
+        diff_files = deque(
+            (cnt, e["name"], e.get("worker_args", {})) for cnt, e in enumerate(self._meta["diff"]["files"], start=1)
+        )
+        total = len(diff_files)
+        retries = {}
+        summary = {}
+        self.logger.info("Syncing %s to %s using diff files in '%s'", old_db_col_names, new_db_col_names, diff_folder)
+        self.register_status("syncing", transient=True, init=True, job={"step": "sync-content"})
+        # deepcopy to make sure we don't embed "self" with unpickleable stuff
+        meta = copy.deepcopy(self._meta)
+        running = {}
+        try:
+            while diff_files or running:
+                while diff_files and len(running) < self.throttle.workers:
+                    cnt, name, worker_args = diff_files.popleft()
+                    pinfo["description"] = "file %s (%s/%s)" % (name, cnt, total)
+                    job = await self.job_manager.defer_to_process(
+                        pinfo,
+                        partial(
+                            throttled_sync_es_jsondiff_worker,
+                            os.path.join(diff_folder, name),
+                            old_db_col_names,
+                            new_db_col_names,
+                            min(worker_args.get("batch_size") or batch_size, self.throttle.batch_size),
+                            cnt,
+                            force,
+                            selfcontained,
+                            meta,
+                            debug,
+                        ),
+                    )
+                    running[job] = (cnt, name, worker_args)
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                rejected = False
+                for job in done:
+                    diff_file = running.pop(job)
+                    res = job.result()
+                    self.throttle.record(res)
+                    if res.get("rejected"):
+                        retries[diff_file[0]] = retries.get(diff_file[0], 0) + 1
+                        if retries[diff_file[0]] > self.throttle.max_retries:
+                            raise SyncerException("Diff file '%s' rejected too many times" % diff_file[1])
+                        self.logger.warning("Diff file '%s' rejected by the cluster, will retry", diff_file[1])
+                        diff_files.append(diff_file)
+                        rejected = True
+                        continue
+                    res.pop("bulk_latency", None)
+                    for k in res:
+                        summary[k] = summary.get(k, 0) + res[k]
+                decision = self.throttle.adjust(await self.search_latency(old_db_col_names[0]))
+                if decision:
+                    self.logger.info(
+                        "Sync throttle: %s workers, batch size %s (%s)",
+                        decision["workers"],
+                        decision["batch_size"],
+                        ", ".join(decision["reasons"]) or "cluster keeps up",
+                    )
+                    self.register_status("syncing", transient=True, job={"throttle": self.throttle.metrics()})
+                if rejected:
+                    await asyncio.sleep(self.throttle.backoff)
+        except Exception as e:
+            self.register_status("failed", job={"err": repr(e), "throttle": self.throttle.metrics()})
+            self.logger.error(
+                "Failed to sync collection from %s to %s using diff files in '%s': %s"
+                % (old_db_col_names, new_db_col_names, diff_folder, e),
+                extra={"notify": True},
+            )
+            raise
+        self.register_status("success", job={"step": "sync-content", "throttle": self.throttle.metrics()}, sync=summary)
+        return summary
+
+
+class AdaptiveThrottledESJsonDiffSyncer(AdaptiveThrottlerSyncer, ESJsonDiffSyncer):
+    pass
+
+
+class AdaptiveThrottledESJsonDiffSelfContainedSyncer(AdaptiveThrottlerSyncer, ESJsonDiffSelfContainedSyncer):
+    pass
@@ -1,7 +1,50 @@
-from biothings.hub.dataindex.indexer import Indexer
+from biothings.hub.dataindex.indexer import Indexer, IndexerException
+from elasticsearch import AsyncElasticsearch
+
+from config import TAXONOMY
+from shared.intervals import CHROMOSOMES, POSITION_BITS, RANGE_FIELDS
+
+# index the nested genomic positions again as flattened ranges, see shared.intervals
+FLATTEN_POSITIONS_SCRIPT = """
+for (def entry : params.fields.entrySet()) {
+    def positions = ctx[entry.getKey()];
+    if (positions == null) { continue; }
+    if (!(positions instanceof List)) { positions = [positions]; }
+    def ranges = [];
+    for (def pos : positions) {
+        if (!(pos instanceof Map) || pos.chr == null || pos.start == null || pos.end == null) { continue; }
+        def code = params.chromosomes[pos.chr.toString().toLowerCase()];
+        if (code == null) { continue; }
+        long offset = ((Number) code).longValue() << params.bits;
+        long start = ((Number) pos.start).longValue();
+        long end = ((Number) pos.end).longValue();
+        ranges.add(['gte': offset + Math.min(start, end), 'lte': offset + Math.max(start, end)]);
+    }
+    if (!ranges.isEmpty()) { ctx[entry.getValue()] = ranges; }
+}
+"""
+
+# send model organism documents to their own index
+ROUTE_SPECIES_SCRIPT = """
+def index = params.indices[String.valueOf(ctx.taxid)];
+if (index != null) { ctx._index = index; }
+"""
 
 
 class GeneIndexer(Indexer):
+    """
+    Documents go through an ingest pipeline, the default pipeline of
+    the index, adding flattened genomic positions for interval queries.
+
+    Optionally, with "species_indices" enabled in the indexer environment,
+    documents of each model organism in TAXONOMY are indexed in their own
+    "<index>_<species>" index, and all others in "<index>_other".
+    "<index>" is then an alias of all of them, whose write index,
+    "<index>_other", routes incoming documents with the ingest pipeline.
+
+    Partial updates and deletions sent to the alias only reach
+    "<index>_other", use full releases with this layout.
+    """
 
     def __init__(self, build_doc, indexer_env, index_name):
         super().__init__(build_doc, indexer_env, index_name)
@@ -19,3 +62,106 @@ class GeneIndexer(Indexer):
             "tokenizer": "refseq_tokenizer",
             "type": "custom"
         }
+
+        # flattened genomic positions, searchable but not returned
+        self.range_fields = {
+            field: range_field for field, range_field in RANGE_FIELDS.items()
+            if field in self.es_index_mappings["properties"]
+        }
+        for range_field in self.range_fields.values():
+            self.es_index_mappings["properties"][range_field] = {"type": "long_range"}
+        if self.range_fields:
+            self.es_index_mappings["_source"] = {"excludes": list(self.range_fields.values())}
+
+        # taxid -> index name, empty when the layout is not enabled
+        self.species_indices = {}
+        if indexer_env.get("species_indices"):
+            self.species_indices = {
+                taxonomy["tax_id"]: f"{self.es_index_name}_{species}"
+                for species, taxonomy in TAXONOMY.items()
+            }
+        self.es_other_index = f"{self.es_index_name}_other"
+        self.es_pipeline_name = f"{self.es_index_name}_pipeline"
+        self.es_index_settings["default_pipeline"] = self.es_pipeline_name
+
+    async def put_pipeline(self, client):
+        processors = [{
+            "script": {
+                "lang": "painless",
+                "params": {"fields": self.range_fields, "chromosomes": CHROMOSOMES, "bits": POSITION_BITS},
+                "source": FLATTEN_POSITIONS_SCRIPT,
+            }
+        }]
+        if self.species_indices:
+            processors.append({
+                "script": {
+                    "lang": "painless",
+                    "params": {"indices": self.species_indices},
+                    "source": ROUTE_SPECIES_SCRIPT,
+                }
+            })
+        response = await client.ingest.put_pipeline(
+            id=self.es_pipeline_name,
+            description=f"Prepare the documents of '{self.es_index_name}'.",
+            processors=processors,
+        )
+        self.logger.info(("Pipeline", self.es_pipeline_name, response))
+
+    async def pre_index(self, *args, mode, **kwargs):
+        client = AsyncElasticsearch(**self.es_client_args)
+        try:
+            await self.put_pipeline(client)
+            if not self.species_indices:
+                return await super().pre_index(*args, mode=mode, **kwargs)
+            return await self._pre_index_species(client, mode)
+        finally:
+            await client.close()
+
+    async def _pre_index_species(self, client, mode):
+        indices = [*self.species_indices.values(), self.es_other_index]
+
+        if mode in ("index", None):
+            for index in (self.es_index_name, *indices):
+                if await client.indices.exists(index=index):
+                    raise IndexerException(
+                        "Index '%s' already exists, (use mode='purge' to "
+                        "auto-delete it or mode='resume' to add more documents)" % index)
+        elif mode == "resume":
+            for index in indices:
+                if not (await client.indices.exists(index=index)):
+                    raise IndexerException("'%s' does not exist." % index)
+            self.logger.info(("Exists", indices))
+            return
+        elif mode == "purge":
+            if not (await client.indices.exists_alias(name=self.es_index_name)):
+                indices_to_delete = [self.es_index_name, *indices]  # a regular index layout
+            else:
+                indices_to_delete = indices
+            response = await client.indices.delete(
+                index=",".join(indices_to_delete), ignore_unavailable=True)
+            self.logger.info(("Deleted", indices, response))
+        else:  # "merge" needs mget, unavailable on a multi-index alias
+            raise ValueError("Invalid mode for a species index layout: %s" % mode)
+
+        settings = await self.es_index_settings.finalize(client)
+        mappings = await self.es_index_mappings.finalize(client)
+        for index in indices:
+            body = {"settings": {"index": dict(settings["index"])}, "mappings": mappings}
+            if index != self.es_other_index:
+                # documents already went through the pipeline of the write index
+                del body["settings"]["index"]["default_pipeline"]
+            response = await client.indices.create(index=index, body=body)
+            self.logger.info(("Created", index, response))
+
+        await client.indices.update_aliases(actions=[
+            {"add": {"index": index, "alias": self.es_index_name,
+                     "is_write_index": index == self.es_other_index}}
+            for index in indices
+        ])
+        self.logger.info(("Aliased", self.es_index_name, indices))
+        return {
+            "__REPLACE__": True,
+            "host": self.es_client_args.get("hosts"),  # for frontend display
+            "environment": self.env_name,  # used in snapshot module.
+            "species_indices": self.species_indices,
+        }
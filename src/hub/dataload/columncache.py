@@ -0,0 +1,154 @@
+"""
+    Columnar parse cache of NCBI tab files.
+
+    Large NCBI files, like gene_info.gz and gene_history.gz, are read by
+    several parsers (entrez, homologene, ensembl mapping...). Each file is
+    decompressed and split once, every column written to its own file of
+    pickled chunks of values, in a folder named after the file checksum:
+
+        <datafile>.columns/<md5>/<column index>
+
+    Parsers then read only the columns they need. Rows come back like
+    tabfile_feeder ones (header line skipped), except that only the
+    requested columns are filled, others are None, so that filters
+    and column indexes written for full rows still apply.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+from biothings.utils.dataload import list2dict, listitems, tabfile_feeder
+
+# values of a column pickled at once
+CHUNK_ROWS = 100000
+
+_checksums = {}  # (path, size, mtime) -> md5
+
+
+def checksum(datafile):
+    stat = os.stat(datafile)
+    key = (os.path.abspath(datafile), stat.st_size, stat.st_mtime)
+    if key not in _checksums:
+        md5 = hashlib.md5()
+        with open(datafile, "rb") as in_f:
+            for block in iter(lambda: in_f.read(1 << 20), b""):
+                md5.update(block)
+        _checksums[key] = md5.hexdigest()
+    return _checksums[key]
+
+
+def build_columns(datafile):
+    """
+    Return the cache folder of a tab file, built if missing.
+    Folders are built aside and renamed, concurrent builders don't
+    see partial caches, the first one completed is kept.
+    """
+    root = datafile + ".columns"
+    folder = os.path.join(root, checksum(datafile))
+    if os.path.exists(folder):
+        return folder
+    os.makedirs(root, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(dir=root, prefix=".tmp")
+    try:
+        outs = []
+        chunk = []
+
+        def flush():
+            for out_f, values in zip(outs, zip(*chunk)):
+                pickle.dump(values, out_f, protocol=pickle.HIGHEST_PROTOCOL)
+            chunk.clear()
+
+        try:
+            for ld in tabfile_feeder(datafile, header=1):
+                if not outs:
+                    outs = [open(os.path.join(tmp_folder, str(col)), "wb") for col in range(len(ld))]
+                if len(ld) != len(outs):
+                    raise ValueError("Unexpected column number: got %d, should be %d" % (len(ld), len(outs)))
+                chunk.append(ld)
+                if len(chunk) >= CHUNK_ROWS:
+                    flush()
+            flush()
+        finally:
+            for out_f in outs:
+                out_f.close()
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            if not os.path.exists(folder):
+                raise
+    finally:
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+    return folder
+
+
+def _read_column(path):
+    with open(path, "rb") as in_f:
+        while True:
+            try:
+                values = pickle.load(in_f)
+            except EOFError:
+                return
+            yield from values
+
+
+def column_feeder(datafile, cols, includefn=None):
+    """
+    Like tabfile_feeder, a generator for each row of the file,
+    with only 'cols' columns read from the cache.
+    """
+    folder = build_columns(datafile)
+    width = max(cols) + 1
+    columns = [_read_column(os.path.join(folder, str(col))) for col in cols]
+    for values in zip(*columns):
+        ld = [None] * width
+        for col, value in zip(cols, values):
+            ld[col] = value
+        if not includefn or includefn(ld):
+            yield ld
+
+
+def _read_cols(cols, filter_cols):
+    cols = (cols,) if isinstance(cols, int) else cols
+    return sorted(set(cols) | set(filter_cols))
+
+
+def tab2list(datafile, cols, includefn=None, filter_cols=()):
+    """
+    Like biothings.utils.dataload.tab2list, 'filter_cols' are
+    the other columns used by includefn.
+    """
+    feeder = column_feeder(datafile, _read_cols(cols, filter_cols), includefn)
+    if isinstance(cols, int):
+        return [ld[cols] for ld in feeder]
+    return [listitems(ld, *cols) for ld in feeder]
+
+
+def tab2dict(datafile, cols, key, alwayslist=False, includefn=None, filter_cols=()):
+    """
+    Like biothings.utils.dataload.tab2dict, 'filter_cols' are
+    the other columns used by includefn.
+    """
+    feeder = column_feeder(datafile, _read_cols(cols, filter_cols), includefn)
+    return list2dict([listitems(ld, *cols) for ld in feeder], key, alwayslist=alwayslist)
+
+
+def tab2dict_iter(datafile, cols, key, alwayslist=False, includefn=None, filter_cols=()):
+    """
+    Like biothings.utils.dataload.tab2dict_iter, 'filter_cols' are
+    the other columns used by includefn.
+    """
+    bulk = []
+    current_key = None
+    for ld in column_feeder(datafile, _read_cols(cols, filter_cols), includefn):
+        li = listitems(ld, *cols)
+        if bulk and li[key] != current_key:
+            yield list2dict(bulk, key, alwayslist=alwayslist)
+            bulk = []
+        bulk.append(li)
+        current_key = li[key]
+    if bulk:
+        yield list2dict(bulk, key, alwayslist=alwayslist)
@@ -0,0 +1,20 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def parallel_map(func, iterable, workers):
+    """
+    Yield func(item) for each item, in order, computed by 'workers' processes,
+    with at most twice as many items in flight (read but not yielded yet).
+    """
+    if workers <= 1:
+        yield from map(func, iterable)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
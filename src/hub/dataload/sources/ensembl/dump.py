@@ -9,6 +9,8 @@ from biothings.hub.dataload.dumper import DumperException, HTTPDumper
 from biothings.utils.common import is_int, safewfile
 from biothings.utils.dataload import tab2list
 
+from .parser import EnsemblParser, build_ensembl2entrez_table
+
 config_for_app(config)
 
 
@@ -125,6 +127,15 @@ class GenericBioMart(HTTPDumper):
         finally:
             ftp_conn.close()
 
+    # override BaseDumper
+    def post_dump(self, *args, **kwargs):
+        # one ensembl -> entrez table per release, shared by all the uploaders
+        self.logger.info("Building ensembl to entrez mapping in %s", self.new_data_folder)
+        build_ensembl2entrez_table(self.src_name, self.new_data_folder)
+        # and read the BioMart files once for all of them, see scanner
+        self.logger.info("Scanning BioMart files in %s", self.new_data_folder)
+        EnsemblParser(self.src_name, self.new_data_folder).scan()
+
     # helper for self.create_todump_list()
     def _get_latest_mart_version(self):
         ftp = FTP(self.__class__.ENSEMBL_FTP_HOST)
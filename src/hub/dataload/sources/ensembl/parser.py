@@ -5,12 +5,17 @@ from multiprocessing import Lock
 
 from biothings.utils.common import SubStr
 from biothings.utils.dataload import (dict_attrmerge, dict_nodup, list2dict,
-                                      normalized_value, tab2dict,
-                                      tab2dict_iter, tab2list, value_convert)
+                                      tab2dict, tab2dict_iter, tab2list,
+                                      value_convert)
 from biothings.utils.loggers import get_logger
 
+from hub.datatransform.idtable import StringIdListTable
+
 extra_mapping_lock = Lock()
 
+# ensembl gene id -> entrez gene ids of a release, see build_ensembl2entrez_table
+ENSEMBL2ENTREZ_FILE = "gene_ensembl__2entrez.idx"
+
 ERR_THRESHOLD = 1000
 
 # fn to skip lines with LRG records.'''
@@ -18,39 +23,97 @@ def _not_LRG(ld):
     return not ld[1].startswith("LRG_")
 
 
-def map_id(hdocs, mapdict):
-    res = []
-    skip_count = 0
-    for k, v in hdocs.items():
-        entrez_ids = mapdict.get(k)
-        if entrez_ids:
-            for eid in entrez_ids:
-                d = {"_id": eid}
-                d.update(v)
-                res.append(d)
-        else:
-            if k.isdigit():
-                if skip_count < ERR_THRESHOLD:
-                    skip_count += 1
-                    continue
-                else:
+def build_ensembl2entrez_table(src_name, data_folder):
+    """
+    Build the ensembl to entrez gene ids table of the release in data_folder,
+    BioMart xrefs overridden by our custom mapping, in ENSEMBL2ENTREZ_FILE.
+    Built once by the dumper, uploaders only memory-map it, see load_ensembl2entrez_table.
+    """
+    custom_mapping_file = os.path.join(data_folder, 'gene_ensembl__gene__extra.txt')
+    if not os.path.exists(custom_mapping_file) or os.stat(custom_mapping_file).st_size == 0:
+        from . import ensembl_ncbi_mapping
+        ensembl_ncbi_mapping.main(src_name, confirm=False, data_folder=data_folder)
+    extra = tab2dict(custom_mapping_file, (0, 1), 0, alwayslist=True)
+    datafile = os.path.join(data_folder, 'gene_ensembl__xref_entrezgene__dm.txt')
+    ensembl2entrez = tab2dict(
+        datafile, (1, 2), 0, includefn=_not_LRG, alwayslist=True)
+    # replace with our custom mapping
+    ensembl2entrez.update(extra)
+    StringIdListTable.build({
+        ensembl_id: [int(entrez_id) for entrez_id in entrez_ids if entrez_id.isdigit()]
+        for ensembl_id, entrez_ids in ensembl2entrez.items()
+    }, os.path.join(data_folder, ENSEMBL2ENTREZ_FILE))
+
+
+def load_ensembl2entrez_table(src_name, data_folder):
+    """
+    Return the ensembl to entrez gene ids table of the release in data_folder,
+    memory-mapped read-only, building it if the dumper did not.
+    """
+    path = os.path.join(data_folder, ENSEMBL2ENTREZ_FILE)
+    if not os.path.exists(path):
+        with extra_mapping_lock:
+            if not os.path.exists(path):
+                build_ensembl2entrez_table(src_name, data_folder)
+    return StringIdListTable.load(path)
+
+
+class EnsemblIdRemapper(object):
+    """
+    Stream documents keyed by ensembl gene ids as documents with entrez gene
+    _ids. Ensembl ids without entrez gene ids are kept as _id (passthrough),
+    all-digit ones are skipped, up to ERR_THRESHOLD of them. Counts of each
+    case, over all the documents remapped, are kept in 'counts'.
+    """
+
+    def __init__(self, mapdict):
+        self.mapdict = mapdict
+        self.counts = {"remapped": 0, "passthrough": 0, "skipped_numeric": 0}
+
+    def remap(self, hdocs):
+        """
+        Yield the documents of a {ensembl_id: doc} dict. Documents are not
+        copied, but when an ensembl id has several entrez gene ids, each
+        other entrez gene id then gets its own (deep) copy of the document.
+        """
+        for k, v in hdocs.items():
+            entrez_ids = self.mapdict.get(k)
+            if entrez_ids:
+                self.counts["remapped"] += 1
+                for eid in entrez_ids[1:]:
+                    d = copy.deepcopy(v)
+                    d["_id"] = str(eid)
+                    yield d
+                v["_id"] = str(entrez_ids[0])
+                yield v
+            elif k.isdigit():
+                self.counts["skipped_numeric"] += 1
+                if self.counts["skipped_numeric"] > ERR_THRESHOLD:
                     raise ValueError('Too many ensembl ids are entirely numeric')
-            d = {"_id": k}
-            d.update(v)
-            res.append(d)
+            else:
+                self.counts["passthrough"] += 1
+                v["_id"] = k
+                yield v
 
-    return res
+    def remap_iter(self, hdocs_iter):
+        for hdocs in hdocs_iter:
+            yield from self.remap(hdocs)
+
+    def log_counts(self, logger, name):
+        logger.info(
+            "%s: %d ensembl ids remapped to entrez gene ids, %d kept, %d all-digit skipped",
+            name, self.counts["remapped"], self.counts["passthrough"], self.counts["skipped_numeric"])
 
 
 class EnsemblParser(object):
     def __init__(self, src_name, data_folder, load_ensembl2entrez=True):
+        self.src_name = src_name
         self.data_folder = data_folder
         self.ensembl2entrez_li = None
         self.ensembl_main = None
+        self.ensembl2entrez = None
         if load_ensembl2entrez:
-            self._load_ensembl2entrez_li(src_name)
-            self.ensembl2entrez = list2dict(
-                self.ensembl2entrez_li, 0, alwayslist=True)
+            self.ensembl2entrez = load_ensembl2entrez_table(src_name, data_folder)
         self.logger, self.logfile = get_logger("parse_%s" % src_name)
 
 
@@ -86,207 +149,102 @@ class EnsemblParser(object):
 
     def _load_ensembl2entrez_li(self, src_name):
         """gene_ensembl__xref_entrezgene__dm"""
-        CUSTOM_MAPPING_FILE = os.path.join(
-            self.data_folder, 'gene_ensembl__gene__extra.txt')
-        global extra_mapping_lock
-        try:
-            print("Trying to acquire extra mapping lock")
-            extra_mapping_lock.acquire()
-            print("Lock acquired")
-            if not os.path.exists(CUSTOM_MAPPING_FILE) or os.stat(CUSTOM_MAPPING_FILE).st_size == 0:
-                print("Missing extra mapping file, now generating")
-                from . import ensembl_ncbi_mapping
-                ensembl_ncbi_mapping.main(src_name, confirm=False)
-        finally:
-            print("Releasing lock")
-            extra_mapping_lock.release()
-        extra = tab2dict(CUSTOM_MAPPING_FILE, (0, 1), 0, alwayslist=True)
-        datafile = os.path.join(
-            self.data_folder, 'gene_ensembl__xref_entrezgene__dm.txt')
+        ensembl2entrez = load_ensembl2entrez_table(src_name, self.data_folder)
         # [(ensembl_gid, entrez_gid),...]
-        ensembl2entrez = tab2dict(
-            datafile, (1, 2), 0, includefn=_not_LRG, alwayslist=True)
-        # replace with our custom mapping
-        ##adjusted = {}
-        for k in extra:
-            # if k in ensembl2entrez:
-            ##    adjusted[k] = {"ensembl2entrez":ensembl2entrez[k],"extra":extra[k]}
-            ensembl2entrez[k] = extra[k]
-        ##import pickle
-        # pickle.dump(adjusted,open("/tmp/adjusted","wb"))
-        # back to list of tuples
-        ensembl2entrez_li = []
-        for ensembl_id, entrez_ids in ensembl2entrez.items():
-            for entrez_id in entrez_ids:
-                ensembl2entrez_li.append((ensembl_id, entrez_id))
-        self.ensembl2entrez_li = ensembl2entrez_li
+        self.ensembl2entrez_li = [
+            (ensembl_id, str(entrez_id))
+            for ensembl_id, entrez_ids in ensembl2entrez.items()
+            for entrez_id in entrez_ids
+        ]
+
+    def scan(self):
+        """
+        Read the BioMart files once, spooling the documents
+        of ensembl_gene, ensembl_genomic_pos and ensembl_acc.
+        """
+        from .scanner import scan_biomart
+        scan_biomart(self)
+
+    def _load_spooled(self, name):
+        from .scanner import Spool, spool_path
+        path = spool_path(self.data_folder, name)
+        if not os.path.exists(path):
+            if self.ensembl2entrez is None:
+                self.ensembl2entrez = load_ensembl2entrez_table(self.src_name, self.data_folder)
+            # not spooled by the dumper (older releases)
+            with extra_mapping_lock:
+                if not os.path.exists(path):
+                    self.scan()
+        yield from Spool.read(path)
 
     def load_ensembl_main(self):
         """loading ensembl gene to symbol+name mapping"""
-        def _fn(x):
-            import logging
-            out = {'taxid': int(x[0])}
-            if x[1].strip() not in ['', '\\N']:
-                out['symbol'] = x[1].strip()
-            if x[2].strip() not in ['', '\\N']:
-                _name = SubStr(x[2].strip(), '', ' [Source:').strip()
-                if _name:
-                    out['name'] = _name
-            return out
-
-        skip_count = 0
-        datafile = os.path.join(
-            self.data_folder, 'gene_ensembl__gene__main.txt')
-        for datadict in tab2dict_iter(datafile, (0, 1, 2, 7, 8), 1, includefn=_not_LRG):
-            datadict = value_convert(datadict, _fn)
-            for id, doc in datadict.items():
-                if id.isdigit():
-                    if skip_count < ERR_THRESHOLD:
-                        skip_count += 1
-                    else:
-                        raise ValueError('Too many ensembl ids are entirely numeric')
-                    self.logger.warning(
-                        "Document Skipped: All-digit id {}".format(id))
-                    continue
-                doc['_id'] = id
-                yield doc
-
-        #ensembl2name = value_convert(ensembl2name, _fn)
-        # return ensembl2name
-
-        #em2name = self._load_ensembl2name()
-        #em2taxid = self._load_ensembl_2taxid()
-        # assert set(em2name) == set(em2taxid)   # should have the same ensembl ids
-
-        # merge them together
-        #ensembl_main = em2name
-        # for k in ensembl_main:
-        #    ensembl_main[k].update({'taxid': em2taxid[k]})
-        # return ensembl_main
+        return self._load_spooled("main")
 
     def load_ensembl2acc(self):
         """
         loading ensembl to transcripts/proteins data
         """
-        # Loading all ensembl GeneIDs, TranscriptIDs and ProteinIDs
-        datafile = os.path.join(
-            self.data_folder, 'gene_ensembl__translation__main.txt')
-        genefile = os.path.join(
-            self.data_folder, 'gene_ensembl__gene__main.txt')
-
-        def _fn(x, eid):
-            out = {'gene': eid, 'translation': []}
-
-            def mapping(transcript_id, protein_id):
-                trid = transcript_id and transcript_id != '\\N' and transcript_id or None
-                pid = protein_id and protein_id != '\\N' and protein_id or None
-                if trid and pid:
-                    out['translation'].append({"rna": trid, "protein": pid})
-
-            if isinstance(x, list):
-                transcript_li = []
-                protein_li = []
-                for _x in x:
-                    if _x[0] and _x[0] != '\\N':
-                        transcript_li.append(_x[0])
-                    if _x[1] and _x[1] != '\\N':
-                        protein_li.append(_x[1])
-                    mapping(_x[0], _x[1])
-
-                if transcript_li:
-                    out['transcript'] = normalized_value(transcript_li)
-                if protein_li:
-                    out['protein'] = normalized_value(protein_li)
-            else:
-                if x[0] and x[0] != '\\N':
-                    out['transcript'] = x[0]
-                if x[1] and x[1] != '\\N':
-                    out['protein'] = x[1]
-                mapping(x[0], x[1])
-
-            return out
-
-        ensembl2acc = tab2dict(datafile, (1, 2, 3), 0, includefn=_not_LRG)
-        typeofgene = tab2dict(genefile, (1, 8), 0, includefn=_not_LRG)
-        # for datadict in tab2dict_iter(datafile, (1, 2, 3), 0, includefn=_not_LRG):
-        #    for k in datadict:
-        #        datadict[k] = {'ensembl': _fn(datadict[k], k), '__aslistofdict__' : 'ensembl'}
-        #    for doc in map_id(datadict,self.ensembl2entrez):
-        #        yield doc
-
-        for k in ensembl2acc:
-            ensembl2acc[k] = {'ensembl': _fn(ensembl2acc[k], k)}
-            if k in typeofgene:
-                ensembl2acc[k]['ensembl']['type_of_gene'] = typeofgene[k]
-
-        return self.convert2entrez(ensembl2acc)
+        return self._load_spooled("acc")
 
     def load_ensembl2pos(self):
-        datafile = os.path.join(
-            self.data_folder, 'gene_ensembl__gene__main.txt')
-        # Twice 1 because first is the dict key, the second because we need gene id within genomic_pos
-        ensembl2pos = dict_nodup(
-            tab2dict(datafile, (1, 1, 3, 4, 5, 6), 0, includefn=_not_LRG))
-        ensembl2pos = value_convert(ensembl2pos, lambda x: {
-                                    'ensemblgene': x[0], 'chr': x[3], 'start': int(x[1]), 'end': int(x[2]), 'strand': int(x[4])})
-        ensembl2pos = value_convert(ensembl2pos, lambda x: {
-                                    'genomic_pos': x}, traverse_list=False)
-        for datadict in tab2dict_iter(datafile, (1, 1, 3, 4, 5, 6), 0, includefn=_not_LRG):
-            datadict = dict_nodup(datadict)
-            datadict = value_convert(datadict, lambda x: {'ensemblgene': x[0], 'chr': x[3], 'start': int(
-                x[1]), 'end': int(x[2]), 'strand': int(x[4])})
-            datadict = value_convert(datadict, lambda x: {
-                                     'genomic_pos': x, '__aslistofdict__': 'genomic_pos'}, traverse_list=False)
-            for doc in map_id(datadict, self.ensembl2entrez):
-                yield doc
+        return self._load_spooled("genomic_pos")
+
+    def _remap(self, name, bulks):
+        remapper = EnsemblIdRemapper(self.ensembl2entrez)
+        yield from remapper.remap_iter(bulks)
+        remapper.log_counts(self.logger, name)
 
     def load_ensembl2prosite(self):
         # Prosite
         datafile = os.path.join(
             self.data_folder, 'gene_ensembl__prot_profile__dm.txt')
-        for datadict in tab2dict_iter(datafile, (1, 4), 0):
-            datadict = dict_nodup(datadict)
-            datadict = value_convert(datadict, lambda x: {
-                                     'prosite': x}, traverse_list=False)
-            for doc in map_id(datadict, self.ensembl2entrez):
-                yield doc
+
+        def bulks():
+            for datadict in tab2dict_iter(datafile, (1, 4), 0):
+                datadict = dict_nodup(datadict)
+                yield value_convert(datadict, lambda x: {
+                                    'prosite': x}, traverse_list=False)
+        return self._remap("prosite", bulks())
 
     def load_ensembl2interpro(self):
         # Interpro
         datafile = os.path.join(
             self.data_folder, 'gene_ensembl__prot_interpro__dm.txt')
-        for datadict in tab2dict_iter(datafile, (1, 4, 5, 6), 0):
-            datadict = dict_nodup(datadict)
-            # optimize with on call/convert
-            datadict = value_convert(datadict, lambda x: {
-                                     'id': x[0], 'short_desc': x[1], 'desc': x[2]})
-            # __aslistofdict__ : merge to 'interpro' as list of dict, not merging keys as list
-            # (these are merging instructions for later called merge_struct)
-            # 'interpro' : {'a': 1, 'b': 2} and 'interpro' : {'a': 3, 'b': 4} should result in:
-            # => 'interpro' : [{'a': 1, 'b': 2},{'a': 3, 'b': 4}]
-            # or not:
-            # => 'interpro' : {'a': [1,3], 'b': [2,4]}
-            datadict = value_convert(datadict, lambda x: {
-                                     'interpro': x, '__aslistofdict__': 'interpro'}, traverse_list=False)
-            for doc in map_id(datadict, self.ensembl2entrez):
-                yield doc
+
+        def bulks():
+            for datadict in tab2dict_iter(datafile, (1, 4, 5, 6), 0):
+                datadict = dict_nodup(datadict)
+                # optimize with on call/convert
+                datadict = value_convert(datadict, lambda x: {
+                                         'id': x[0], 'short_desc': x[1], 'desc': x[2]})
+                # __aslistofdict__ : merge to 'interpro' as list of dict, not merging keys as list
+                # (these are merging instructions for later called merge_struct)
+                # 'interpro' : {'a': 1, 'b': 2} and 'interpro' : {'a': 3, 'b': 4} should result in:
+                # => 'interpro' : [{'a': 1, 'b': 2},{'a': 3, 'b': 4}]
+                # or not:
+                # => 'interpro' : {'a': [1,3], 'b': [2,4]}
+                yield value_convert(datadict, lambda x: {
+                                    'interpro': x, '__aslistofdict__': 'interpro'}, traverse_list=False)
+        return self._remap("interpro", bulks())
 
     def load_ensembl2pfam(self):
-        # Prosite
+        # Pfam
         datafile = os.path.join(
             self.data_folder, 'gene_ensembl__prot_pfam__dm.txt')
-        for datadict in tab2dict_iter(datafile, (1, 4), 0):
-            datadict = dict_nodup(datadict)
-            datadict = value_convert(datadict, lambda x: {
-                                     'pfam': x}, traverse_list=False)
-            for doc in map_id(datadict, self.ensembl2entrez):
-                yield doc
+
+        def bulks():
+            for datadict in tab2dict_iter(datafile, (1, 4), 0):
+                datadict = dict_nodup(datadict)
+                yield value_convert(datadict, lambda x: {
+                                    'pfam': x}, traverse_list=False)
+        return self._remap("pfam", bulks())
 
     #TODO: not used
     def convert2entrez(self, ensembl2x):
         '''convert a dict with ensembl gene ids as the keys to matching entrezgene ids as the keys.'''
         if not self.ensembl2entrez_li:
-            self._load_ensembl2entrez_li()
+            self._load_ensembl2entrez_li(self.src_name)
 
         if not self.ensembl_main:
             self.ensembl_main = self.load_ensembl_main()
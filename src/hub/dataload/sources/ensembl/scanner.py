@@ -0,0 +1,293 @@
+"""
+    Single pass reader of the BioMart files.
+
+    Several uploaders parse the same BioMart file, ensembl_gene,
+    ensembl_genomic_pos and ensembl_acc all read gene_ensembl__gene__main.txt.
+    A BioMartScanner reads each file once and sends the rows of each gene,
+    as tab2dict_iter bulks, to all the consumers registered for that file.
+
+    Consumers turn the bulks into documents, spooled to one file per
+    uploader in the release data folder, as runs of documents sorted
+    by _id. Uploaders then only read their spool back, see EnsemblParser.
+"""
+
+import os
+import pickle
+from collections import defaultdict
+
+from biothings.utils.common import SubStr
+from biothings.utils.dataload import (dict_nodup, list2dict, listitems,
+                                      normalized_value, tabfile_feeder,
+                                      value_convert)
+
+from .parser import ERR_THRESHOLD, EnsemblIdRemapper, _not_LRG
+
+
+def spool_path(data_folder, name):
+    return os.path.join(data_folder, "gene_ensembl__%s.spool" % name)
+
+
+class Spool(object):
+    """
+    Documents written as runs of pickled lists, sorted by _id.
+    The file is only visible once complete.
+    """
+    RUN_SIZE = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.run = []
+        self.out_f = open(path + ".tmp", "wb")
+
+    def write(self, docs):
+        self.run.extend(docs)
+        if len(self.run) >= self.RUN_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.run:
+            self.run.sort(key=lambda doc: doc["_id"])
+            pickle.dump(self.run, self.out_f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.run = []
+
+    def close(self):
+        self.flush()
+        self.out_f.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as in_f:
+            while True:
+                try:
+                    run = pickle.load(in_f)
+                except EOFError:
+                    return
+                yield from run
+
+
+class Consumer(object):
+    """
+    Receive bulks of rows of a BioMart file, subset to 'cols' and keyed
+    by 'key' like tab2dict_iter, and spool the documents they make to
+    the 'name' spool. Those without a name (None) do not spool anything.
+    """
+    name = None
+    filename = None
+    cols = ()
+    key = 0
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.spool = None
+        if self.name:
+            self.spool = Spool(spool_path(parser.data_folder, self.name))
+
+    def feed(self, rows):
+        datadict = list2dict([listitems(row, *self.cols) for row in rows], self.key)
+        docs = self.consume(datadict)
+        if self.spool:
+            self.spool.write(docs)
+
+    def consume(self, datadict):
+        """
+        Return the documents of a tab2dict_iter bulk.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        if self.spool:
+            self.spool.close()
+
+
+class MainConsumer(Consumer):
+    """ensembl gene to taxid, symbol and name"""
+    name = "main"
+    filename = "gene_ensembl__gene__main.txt"
+    cols = (0, 1, 2, 7, 8)
+    key = 1
+
+    def __init__(self, parser):
+        super(MainConsumer, self).__init__(parser)
+        self.skip_count = 0
+
+    @staticmethod
+    def _fn(x):
+        out = {'taxid': int(x[0])}
+        if x[1].strip() not in ['', '\\N']:
+            out['symbol'] = x[1].strip()
+        if x[2].strip() not in ['', '\\N']:
+            _name = SubStr(x[2].strip(), '', ' [Source:').strip()
+            if _name:
+                out['name'] = _name
+        return out
+
+    def consume(self, datadict):
+        docs = []
+        for id, doc in value_convert(datadict, self._fn).items():
+            if id.isdigit():
+                if self.skip_count < ERR_THRESHOLD:
+                    self.skip_count += 1
+                else:
+                    raise ValueError('Too many ensembl ids are entirely numeric')
+                self.parser.logger.warning(
+                    "Document Skipped: All-digit id {}".format(id))
+                continue
+            doc['_id'] = id
+            docs.append(doc)
+        return docs
+
+
+class GenomicPosConsumer(Consumer):
+    """ensembl gene positions, converted to entrez gene ids"""
+    name = "genomic_pos"
+    filename = "gene_ensembl__gene__main.txt"
+    # twice 1 because first is the dict key, the second because we need gene id within genomic_pos
+    cols = (1, 1, 3, 4, 5, 6)
+    key = 0
+
+    def __init__(self, parser):
+        super(GenomicPosConsumer, self).__init__(parser)
+        self.remapper = EnsemblIdRemapper(parser.ensembl2entrez)
+
+    def consume(self, datadict):
+        datadict = dict_nodup(datadict)
+        datadict = value_convert(datadict, lambda x: {'ensemblgene': x[0], 'chr': x[3], 'start': int(
+            x[1]), 'end': int(x[2]), 'strand': int(x[4])})
+        datadict = value_convert(datadict, lambda x: {
+                                 'genomic_pos': x, '__aslistofdict__': 'genomic_pos'}, traverse_list=False)
+        return self.remapper.remap(datadict)
+
+    def close(self):
+        self.remapper.log_counts(self.parser.logger, self.name)
+        super(GenomicPosConsumer, self).close()
+
+
+class TypeOfGeneConsumer(Consumer):
+    """ensembl gene to type of gene, kept in memory for AccConsumer"""
+    filename = "gene_ensembl__gene__main.txt"
+    cols = (1, 8)
+    key = 0
+
+    def __init__(self, parser):
+        super(TypeOfGeneConsumer, self).__init__(parser)
+        self.typeofgene = {}
+
+    def consume(self, datadict):
+        self.typeofgene.update(datadict)
+        return ()
+
+
+class AccConsumer(Consumer):
+    """
+    ensembl gene to transcripts/proteins, documents are grouped by entrez
+    gene ids (see EnsemblParser.convert2entrez), only spooled on close.
+    """
+    name = "acc"
+    filename = "gene_ensembl__translation__main.txt"
+    cols = (1, 2, 3)
+    key = 0
+
+    def __init__(self, parser, typeofgene):
+        super(AccConsumer, self).__init__(parser)
+        self.typeofgene = typeofgene
+        self.ensembl2acc = defaultdict(list)
+
+    @staticmethod
+    def _fn(x, eid):
+        out = {'gene': eid, 'translation': []}
+
+        def mapping(transcript_id, protein_id):
+            trid = transcript_id and transcript_id != '\\N' and transcript_id or None
+            pid = protein_id and protein_id != '\\N' and protein_id or None
+            if trid and pid:
+                out['translation'].append({"rna": trid, "protein": pid})
+
+        if isinstance(x, list):
+            transcript_li = []
+            protein_li = []
+            for _x in x:
+                if _x[0] and _x[0] != '\\N':
+                    transcript_li.append(_x[0])
+                if _x[1] and _x[1] != '\\N':
+                    protein_li.append(_x[1])
+                mapping(_x[0], _x[1])
+
+            if transcript_li:
+                out['transcript'] = normalized_value(transcript_li)
+            if protein_li:
+                out['protein'] = normalized_value(protein_li)
+        else:
+            if x[0] and x[0] != '\\N':
+                out['transcript'] = x[0]
+            if x[1] and x[1] != '\\N':
+                out['protein'] = x[1]
+            mapping(x[0], x[1])
+
+        return out
+
+    def consume(self, datadict):
+        for k, x in datadict.items():
+            self.ensembl2acc[k].extend(x if isinstance(x, list) else [x])
+        return ()
+
+    def close(self):
+        ensembl2acc = {}
+        for k, x in self.ensembl2acc.items():
+            ensembl2acc[k] = {'ensembl': self._fn(x if len(x) > 1 else x[0], k)}
+            if k in self.typeofgene.typeofgene:
+                ensembl2acc[k]['ensembl']['type_of_gene'] = self.typeofgene.typeofgene[k]
+        for _id, doc in self.parser.convert2entrez(ensembl2acc).items():
+            doc["_id"] = _id
+            self.spool.write([doc])
+        super(AccConsumer, self).close()
+
+
+class BioMartScanner(object):
+
+    # gene id column, rows of a gene are adjacent
+    GENE_COLUMN = 1
+
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        self.consumers = defaultdict(list)  # filename -> consumers, in order
+
+    def register(self, consumer):
+        self.consumers[consumer.filename].append(consumer)
+        return consumer
+
+    def _genes(self, datafile):
+        """
+        Yield the rows of each gene, LRG records excluded.
+        """
+        rows = []
+        for row in tabfile_feeder(datafile, includefn=_not_LRG):
+            if rows and row[self.GENE_COLUMN] != rows[0][self.GENE_COLUMN]:
+                yield rows
+                rows = []
+            rows.append(row)
+        if rows:
+            yield rows
+
+    def scan(self):
+        for filename, consumers in self.consumers.items():
+            datafile = os.path.join(self.data_folder, filename)
+            for rows in self._genes(datafile):
+                for consumer in consumers:
+                    consumer.feed(rows)
+        for consumers in self.consumers.values():
+            for consumer in consumers:
+                consumer.close()
+
+
+def scan_biomart(parser):
+    """
+    Read the BioMart files of the parser data folder once,
+    and spool the documents of all the uploaders.
+    """
+    scanner = BioMartScanner(parser.data_folder)
+    scanner.register(MainConsumer(parser))
+    scanner.register(GenomicPosConsumer(parser))
+    typeofgene = scanner.register(TypeOfGeneConsumer(parser))
+    scanner.register(AccConsumer(parser, typeofgene))
+    scanner.scan()
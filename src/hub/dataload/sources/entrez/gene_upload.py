@@ -1,7 +1,7 @@
 import biothings.hub.dataload.uploader as uploader
-from biothings.utils.common import dump2gridfs
+import gridfs
 
-from .parser import GeneInfoParser, get_geneid_d
+from .parser import GeneInfoParser, get_geneid_table
 
 
 class EntrezGeneUploader(uploader.MergerSourceUploader):
@@ -16,13 +16,20 @@ class EntrezGeneUploader(uploader.MergerSourceUploader):
         genedoc_d = self.parser.load()
         return genedoc_d
 
-    def get_geneid_d(self, *args, **kwargs):
-        return get_geneid_d(self.data_folder, *args, **kwargs)
+    def get_geneid_table(self, *args, **kwargs):
+        return get_geneid_table(self.data_folder, *args, **kwargs)
 
     def post_update_data(self, *args, **kwargs):
-        self.logger.info('Uploading "geneid_d" to GridFS...')
-        geneid_d = self.get_geneid_d(load_cache=False, save_cache=False)
-        dump2gridfs(geneid_d, self.name + "__geneid_d.pyobj", self.db)
+        # the table file itself, mapped as is by the build mappers
+        self.logger.info('Uploading "geneid" table to GridFS...')
+        geneid_table = self.get_geneid_table()
+        filename = self.name + "__geneid_table.idx"
+        fs = gridfs.GridFS(self.db)
+        # new version first, mappers always find one (see get_last_version)
+        with open(geneid_table.path, "rb") as table_file:
+            file_id = fs.put(table_file, filename=filename)
+        for gridout in fs.find({"filename": filename, "_id": {"$ne": file_id}}):
+            fs.delete(gridout._id)
         for field in [
             "MGI",
             "HGNC",
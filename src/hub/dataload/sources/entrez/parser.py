@@ -1,18 +1,41 @@
 import datetime
+import heapq
+import os
 import os.path
+import tempfile
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 
-from biothings.utils.common import dump, file_newer, loadobj
+from biothings.utils.common import file_newer, iter_n
 from biothings.utils.dataload import (
     dict_convert,
     dict_to_list,
+    listitems,
     normalized_value,
     tab2dict,
     tab2dict_iter,
-    tab2list,
+    tabfile_feeder,
     value_convert,
 )
 from config import TAXONOMY
 
+from hub.dataload import columncache
+from hub.dataload.parallel import parallel_map
+from hub.datatransform.idtable import GeneIdTable
+
+# gene2accession.gz and gene2refseq.gz rows are grouped by GeneID with an
+# external sort, see GeneRowsSorter. Rows sorted in memory at once (bounds
+# the memory used), and where sorted runs are spilled (None: data folder)
+SORT_RUN_ROWS = 1000000
+SORT_SPILL_FOLDER = None
+# genes are converted to documents by chunks, across CONVERT_WORKERS processes
+CONVERT_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+CONVERT_CHUNK_GENES = 10000
+
+# current/retired gene ids table of all species, see get_geneid_table
+GENEID_TABLE_FILE = "geneid_table.idx"
+
 
 class EntrezParserBase(object):
     def __init__(self, data_folder):
@@ -40,13 +63,17 @@ class EntrezParserBase(object):
         raise NotImplementedError
 
 
-def get_geneid_d(data_folder, species_li=None, load_cache=True, save_cache=True, only_for={}):
-    """return a dictionary of current/retired geneid to current geneid mapping.
+def get_geneid_table(data_folder, species_li=None, save_cache=True, only_for={}):
+    """return a GeneIdTable of current/retired geneid to current geneid mapping.
     This is useful, when other annotations were mapped to geneids may
     contain retired gene ids.
 
     if species_li is None, genes from all species are loaded.
 
+    The table of all species and genes is cached in the data folder,
+    as GENEID_TABLE_FILE, and memory-mapped. Tables restricted to some
+    species or genes ('only_for') are only kept in memory.
+
     Note that all ids are int type.
     """
     if species_li:
@@ -54,111 +81,158 @@ def get_geneid_d(data_folder, species_li=None, load_cache=True, save_cache=True,
     else:
         taxid_set = None
 
-    orig_cwd = os.getcwd()
-    os.chdir(data_folder)
-
-    # check cache file
-    _cache_file = "geneid_d.pyobj"
-    if (
-        load_cache
-        and os.path.exists(_cache_file)
-        and file_newer(_cache_file, "gene_info.gz")
-        and file_newer(_cache_file, "gene_history.gz")
-    ):
-        _taxid_set, out_d = loadobj(_cache_file)
-        assert _taxid_set == taxid_set
-        os.chdir(orig_cwd)
-        return out_d
-
-    DATAFILE = os.path.join(data_folder, "gene_info.gz")
+    gene_info_file = os.path.join(data_folder, "gene_info.gz")
+    gene_history_file = os.path.join(data_folder, "gene_history.gz")
+    cache_file = None
+    if save_cache and not species_li and not only_for:
+        cache_file = os.path.join(data_folder, GENEID_TABLE_FILE)
+        if (
+            os.path.exists(cache_file)
+            and file_newer(cache_file, gene_info_file)
+            and file_newer(cache_file, gene_history_file)
+        ):
+            return GeneIdTable.load(cache_file)
+
     if species_li:
         species_filter = lambda ld: int(ld[0]) in taxid_set and (only_for and ld[1] in only_for)
     elif only_for:
         species_filter = lambda ld: only_for and ld[1] in only_for
     else:
         species_filter = None
-    geneid_li = set(tab2list(DATAFILE, 1, includefn=species_filter))
-
-    DATAFILE = os.path.join(data_folder, "gene_history.gz")
+    geneid_li = set(columncache.tab2list(gene_info_file, 1, includefn=species_filter, filter_cols=(0,)))
 
     if species_li:
         _includefn = lambda ld: int(ld[0]) in taxid_set and ld[1] in geneid_li
     else:
         _includefn = lambda ld: ld[1] in geneid_li  # include all species
-    retired2gene = tab2dict(DATAFILE, (1, 2), 1, alwayslist=0, includefn=_includefn)
+    retired2gene = columncache.tab2list(gene_history_file, (2, 1), includefn=_includefn, filter_cols=(0,))
     # includefn above makes sure taxid is for species_li and filters out those
     # mapped_to geneid exists in gene_info list
 
-    # convert key/value to int
-    out_d = dict_convert(retired2gene, keyfn=int, valuefn=int)
-    # TODO: this fills memory with key==value ...
-    for g in geneid_li:
-        _g = int(g)
-        out_d[_g] = _g
-
-    if save_cache:
-        if species_li:
-            dump((taxid_set, out_d), _cache_file)
-        else:
-            dump((None, out_d), _cache_file)
+    # current ids are only stored once, not mapped to themselves
+    return GeneIdTable.build_ids(
+        (int(g) for g in geneid_li),
+        ((int(retired), int(g)) for retired, g in retired2gene),
+        cache_file,
+    )
 
-    os.chdir(orig_cwd)
-    return out_d
 
+class GeneRowsSorter(object):
+    """
+    Group rows by their first column, a gene id, whatever their order:
+    rows are sorted by runs of 'run_rows', spilled to 'spill_folder' and
+    merged, so that each gene comes as exactly one group. Rows of a gene
+    keep their input order.
+    """
 
-class Gene2AccessionParserBase(EntrezParserBase):
-    DATAFILE = "to_be_specified"
-    fieldname = "to_be_specified"
+    def __init__(self, spill_folder, run_rows=SORT_RUN_ROWS):
+        self.spill_folder = spill_folder
+        self.run_rows = run_rows
+        self.rows = []
+        self.runs = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.run_rows:
+            self._spill()
+
+    def _spill(self):
+        self.rows.sort(key=itemgetter(0))
+        fd, run = tempfile.mkstemp(prefix="gene_rows_", suffix=".run", dir=self.spill_folder)
+        self.runs.append(run)
+        with open(fd, "w") as run_f:
+            for row in self.rows:
+                run_f.write("\t".join(row) + "\n")
+        self.rows = []
+
+    @staticmethod
+    def _read_run(run):
+        with open(run) as run_f:
+            for line in run_f:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    def groups(self):
+        """
+        Yield (gene_id, rows) for each gene, rows without the gene id,
+        once all rows are added.
+        """
+        try:
+            if self.runs:
+                self._spill()
+                rows = heapq.merge(*(self._read_run(run) for run in self.runs), key=itemgetter(0))
+            else:
+                # small enough, sorted in memory only
+                self.rows.sort(key=itemgetter(0))
+                rows = self.rows
+            for gene_id, group in groupby(rows, key=itemgetter(0)):
+                yield gene_id, [row[1:] for row in group]
+        finally:
+            for run in self.runs:
+                os.remove(run)
+            self.runs = []
+            self.rows = []
+
+
+def _accession_docs(fieldname, groups):
+    """
+    Return the documents of a chunk of (gene_id, [(rna, protein, genomic), ...])
+    groups, see Gene2AccessionParserBase.load.
+    """
 
-    def format(self, doc):
-        gid, acc = list(doc.items())[0]
+    def _ff(d):
+        out = {"rna": [], "protein": [], "genomic": [], "translation": []}
+        for rna, prot, dna in d:
+            if rna == "-":
+                rna = None
+            if prot == "-":
+                prot = None
+            if dna == "-":
+                dna = None
+            if rna is not None:
+                out["rna"].append(rna)
+            if prot is not None:
+                out["protein"].append(prot)
+            if dna is not None:
+                out["genomic"].append(dna)
+            if rna and prot:
+                out["translation"].append({"rna": rna, "protein": prot})
+        # remove dup
+        for k in out:
+            out[k] = normalized_value(out[k])
+        # remove empty rna/protein/genomic field
+        _out = {}
+        for k, v in out.items():
+            if v:
+                _out[k] = v
+        if _out:
+            _out = {fieldname: _out}
+        return _out
+
+    docs = []
+    for gid, rows in groups:
         d = {"_id": gid}
-        d.update(acc)
-        return d
+        d.update(_ff(rows))
+        docs.append(d)
+    return docs
 
-    def load(self, aslist=False):
-        gene2acc = tab2dict_iter(self.datafile, (1, 3, 5, 7), 0, alwayslist=1, includefn=self.species_filter)
 
-        def _ff(d):
-            out = {"rna": [], "protein": [], "genomic": [], "translation": []}
-            for rna, prot, dna in d:
-                if rna == "-":
-                    rna = None
-                if prot == "-":
-                    prot = None
-                if dna == "-":
-                    dna = None
-                if rna is not None:
-                    out["rna"].append(rna)
-                if prot is not None:
-                    out["protein"].append(prot)
-                if dna is not None:
-                    out["genomic"].append(dna)
-                if rna and prot:
-                    out["translation"].append({"rna": rna, "protein": prot})
-            # remove dup
-            for k in out:
-                out[k] = normalized_value(out[k])
-            # remove empty rna/protein/genomic field
-            _out = {}
-            for k, v in out.items():
-                if v:
-                    _out[k] = v
-            if _out:
-                _out = {self.fieldname: _out}
-            return _out
-
-        # gene/2acc = dict_convert(gene2acc, valuefn=_ff)
-        cnt = 0
-        for gd in gene2acc:
-            convd = self.format(dict_convert(gd, valuefn=_ff))
-            yield convd
-            cnt += 1
+class Gene2AccessionParserBase(EntrezParserBase):
+    DATAFILE = "to_be_specified"
+    fieldname = "to_be_specified"
 
-        if aslist:
-            return dict_to_list(gene2acc)
-        else:
-            return gene2acc
+    def load(self, aslist=False, spill_folder=SORT_SPILL_FOLDER, workers=CONVERT_WORKERS):
+        """
+        Yield one document per gene. Input rows don't need to be clustered
+        by GeneID, they're grouped with a GeneRowsSorter, spilling sorted
+        runs to 'spill_folder' (data folder by default), and converted
+        to documents by chunks of genes, across 'workers' processes.
+        """
+        sorter = GeneRowsSorter(spill_folder or self.data_folder)
+        for ld in tabfile_feeder(self.datafile, includefn=self.species_filter):
+            sorter.add(listitems(ld, 1, 3, 5, 7))
+        chunks = iter_n(sorter.groups(), CONVERT_CHUNK_GENES)
+        for docs in parallel_map(partial(_accession_docs, self.fieldname), chunks, workers):
+            yield from docs
 
 
 class GeneInfoParser(EntrezParserBase):
@@ -186,7 +260,7 @@ class GeneInfoParser(EntrezParserBase):
         te (tab is used as a separator, pound sign - start of a comment)
 
         """
-        gene_d = tab2dict_iter(
+        gene_d = columncache.tab2dict_iter(
             self.datafile, (0, 1, 2, 3, 4, 5, 7, 8, 9, 10, 13, 14), key=1, alwayslist=0, includefn=self.species_filter
         )
 
@@ -291,12 +365,12 @@ class Gene2UnigeneParser(EntrezParserBase):
     def load(self, aslist=False):
         uni_d = tab2dict(self.datafile, (0, 1), 0, alwayslist=0)
         DATAFILE = os.path.join(self.data_folder, "gene_history.gz")
-        retired2gene = tab2dict(DATAFILE, (1, 2), 1, alwayslist=0, includefn=lambda ld: ld[1] != "-")
+        retired2gene = columncache.tab2dict(DATAFILE, (1, 2), 1, alwayslist=0, includefn=lambda ld: ld[1] != "-")
         for id in list(uni_d.keys()):
             uni_d[retired2gene.get(id, id)] = uni_d[id]
-        geneid_d = get_geneid_d(self.data_folder, self.species_li, load_cache=False, save_cache=False, only_for=uni_d)
+        geneid_table = get_geneid_table(self.data_folder, self.species_li, save_cache=False, only_for=uni_d)
         gene2unigene = tab2dict_iter(
-            self.datafile, (0, 1), 0, alwayslist=0, includefn=lambda ld: int(ld[0]) in geneid_d
+            self.datafile, (0, 1), 0, alwayslist=0, includefn=lambda ld: int(ld[0]) in geneid_table
         )
         cnt = 0
         for doc in gene2unigene:
@@ -364,7 +438,9 @@ class Gene2RetiredParser(EntrezParserBase):
             _includefn = lambda ld: int(ld[0]) in self.taxid_set and ld[1] != "-"
         else:
             _includefn = lambda ld: ld[1] != "-"
-        gene2retired = tab2dict(self.datafile, (1, 2), 0, alwayslist=1, includefn=_includefn)
+        gene2retired = columncache.tab2dict(
+            self.datafile, (1, 2), 0, alwayslist=1, includefn=_includefn, filter_cols=(0,)
+        )
         gene2retired = dict_convert(gene2retired, valuefn=lambda x: normalized_value([int(xx) for xx in x]))
 
         gene_d = {}
@@ -1,7 +1,7 @@
 import os.path
 import time
 from biothings.utils.common import timesofar
-from biothings.utils.dataload import tab2dict, tabfile_feeder, list2dict
+from biothings.utils.dataload import tab2dict, tabfile_feeder
 
 import logging
 logging = logging.getLogger("exac_upload")
@@ -96,14 +96,12 @@ def load_broadinstitute_exac(data_folder):
     ensembl_doc = get_src_dump().find_one({"_id":"ensembl"}) or {}
     ensembl_dir = ensembl_doc.get('download', {}).get("data_folder")
     assert ensembl_dir, "Can't find Ensembl data directory (used for id conversion)"
-    ensembl_parser = EnsemblParser('ensembl', ensembl_dir)
-    ensembl_parser._load_ensembl2entrez_li('ensembl')
-    ensembl2entrez = list2dict(ensembl_parser.ensembl2entrez_li, 0, alwayslist=True)
+    ensembl2entrez = EnsemblParser('ensembl', ensembl_dir).ensembl2entrez
     for line in tabfile_feeder(os.path.join(ensembl_dir,"gene_ensembl__translation__main.txt")):
         _,ensid,transid,_ = line
         if transid in exacs:
             data = exacs.pop(transid) # pop so no-match means no data in the end
-            for entrezid in ensembl2entrez.get(ensid,[ensid]):
-                exacs[entrezid] = data
+            for entrezid in ensembl2entrez.get(ensid) or [ensid]:
+                exacs[str(entrezid)] = data
 
     return exacs
@@ -2,12 +2,14 @@ import os.path
 from config import TAXONOMY
 from biothings.utils.dataload import tab2dict
 
+from hub.dataload import columncache
+
 try:
-    from ..entrez.parser import EntrezParserBase, get_geneid_d
+    from ..entrez.parser import EntrezParserBase, get_geneid_table
 except (ValueError, ImportError):
     # capture "ValueError: Attempted relative import beyond top-level package"
     # or other ImportError
-    from hub.dataload.sources.entrez.parser import EntrezParserBase, get_geneid_d
+    from hub.dataload.sources.entrez.parser import EntrezParserBase, get_geneid_table
 
 
 class HomologeneParser(EntrezParserBase):
@@ -37,7 +39,7 @@ class HomologeneParser(EntrezParserBase):
         assert entrez_dir, "Can't find Entrez data directory"
         DATAFILE = os.path.join(entrez_dir, 'gene_history.gz')
         assert os.path.exists(DATAFILE), "gene_history.gz is missing (entrez_dir: %s)" % entrez_dir
-        retired2gene = tab2dict(
+        retired2gene = columncache.tab2dict(
             DATAFILE,
             (1, 2), 1, alwayslist=0,
             includefn=lambda ld: ld[1] != '-'
@@ -49,19 +51,19 @@ class HomologeneParser(EntrezParserBase):
             homologene_d = {}
             doc_li = []
             print()
-            geneid_d = get_geneid_d(entrez_dir, self.species_li, load_cache=False,
-                                    save_cache=False, only_for=homo_d)
+            geneid_table = get_geneid_table(entrez_dir, self.species_li,
+                                            save_cache=False, only_for=homo_d)
 
             for line in df:
                 ld = line.strip().split('\t')
                 hm_id, tax_id, geneid = [int(x) for x in ld[:3]]
-                if (self.taxid_set is None or tax_id in self.taxid_set) and geneid in geneid_d:
+                if (self.taxid_set is None or tax_id in self.taxid_set) and geneid in geneid_table:
                     # for selected species only
                     # and also ignore those geneid does not match any
                     # existing gene doc
                     # in case of orignal geneid is retired, replaced with the
                     # new one, if available.
-                    geneid = geneid_d[geneid]
+                    geneid = geneid_table[geneid]
                     genes = homologene_d.get(hm_id, [])
                     genes.append((tax_id, geneid))
                     homologene_d[hm_id] = genes
@@ -1,11 +1,14 @@
 import asyncio
 import glob
+import heapq
 import os
 import os.path
 import sys
 import time
 from datetime import datetime
 from functools import partial
+from itertools import groupby
+from operator import itemgetter
 
 import biothings
 
@@ -14,13 +17,16 @@ import config
 biothings.config_for_app(config)
 
 from biothings.hub.dataload.dumper import FTPDumper
-from biothings.utils.common import dump
 
 from config import DATA_ARCHIVE_ROOT
 from config import logger as logging
 
 from .parse_refseq_gbff import GBFFParser
 
+# sorted partial outputs of each gbff file, merged by parse_gbff
+SUMMARY_PART = ".gene2summary.part"
+EC_PART = ".gene2ec.part"
+
 
 class RefseqDumper(FTPDumper):
 
@@ -90,7 +96,6 @@ class RefseqDumper(FTPDumper):
         return task
 
     async def parse_gbff(self, gbff_files, job_manager):
-        out_d = {}
         jobs = []
         got_error = False
         for infile in gbff_files:
@@ -103,15 +108,12 @@ class RefseqDumper(FTPDumper):
             )
 
             def parsed(res, fn):
-                nonlocal out_d
+                nonlocal got_error
                 try:
-                    out_li = res.result()
-                    self.logger.info("%d records parsed from %s" % (len(out_li), fn))
-                    species = os.path.basename(fn).split(".")[0]
-                    out_d.setdefault(species, []).extend(out_li)
+                    cnt = res.result()
+                    self.logger.info("%d records parsed from %s" % (cnt, fn))
                 except Exception as e:
                     self.logger.error("Failed parsing gbff file '%s': %s" % (fn, e))
-                    nonlocal got_error
                     got_error = e
 
             job.add_done_callback(partial(parsed, fn=infile))
@@ -123,63 +125,87 @@ class RefseqDumper(FTPDumper):
             await asyncio.gather(*jobs)
             if got_error:
                 raise got_error
-            # if we get here, result is ready to be dumped
-            outfile = os.path.join(self.new_data_folder, "rna.gbff.parsed.pyobj")
-            self.logger.info("Dump gbff parsed data to '%s'" % outfile)
-            dump(out_d, outfile, compress="lzma")
-            # output gene2summary text file
+            # if we get here, each file has its sorted partial outputs, merge them
             self.logger.info("Generate gene2summary")
             sumout = os.path.join(self.new_data_folder, "gene2summary_all.txt")
-            output_gene2summary(out_d, sumout)
+            merge_gene2summary([infile + SUMMARY_PART for infile in gbff_files], sumout)
             assert os.path.getsize(sumout) > 0
-            # output gene2ec text file
             self.logger.info("Generate gene2ec")
             ecout = os.path.join(self.new_data_folder, "gene2ec_all.txt")
-            output_gene2ec(out_d, ecout)
+            merge_gene2ec([infile + EC_PART for infile in gbff_files], ecout)
             assert os.path.getsize(ecout) > 0
+            for infile in gbff_files:
+                os.remove(infile + SUMMARY_PART)
+                os.remove(infile + EC_PART)
 
 
 def parser_worker(infile):
+    """
+    Parse a gbff file and write its sorted partial gene2summary and
+    gene2ec outputs next to it. Return the number of records parsed.
+    """
     gb = GBFFParser(infile)
-    return gb.parse()
+    out_li = gb.parse()
+    output_gene2summary(out_li, infile + SUMMARY_PART)
+    output_gene2ec(out_li, infile + EC_PART)
+    return len(out_li)
 
 
-def output_gene2summary(out_d, outfile):
+def output_gene2summary(out_li, outfile):
     """Output tab delimited file for gene summary, with two column
     gene summary
     (no header line)
     """
-    out_f = open(outfile, "w")
-    for species in out_d:
-        out_li = []
-        for rec in out_d[species]:
-            geneid = rec[0]
-            summary = rec[1]
-            if summary:
-                out_li.append((geneid, summary))
-
-        for geneid, summary in sorted(set(out_li)):
+    out_li = set((geneid, summary) for geneid, summary, _ in out_li if summary)
+    with open(outfile, "w") as out_f:
+        for geneid, summary in sorted(out_li):
             out_f.write("%s\t%s\n" % (geneid, summary))
-    out_f.close()
 
 
-def output_gene2ec(out_d, outfile):
+def output_gene2ec(out_li, outfile):
     """Output tab delimited file for gene EC numbers, with two column
     gene ec_number
     (multiple ec_numbers are comma-seperated)
     (no header line)
     """
-    out_f = open(outfile, "w")
-    for species in out_d:
-        dd = {}
-        for rec in out_d[species]:
-            geneid = rec[0]
-            ec_list = rec[2]
-            if ec_list:
-                if geneid in dd:
-                    dd[geneid].extend(ec_list)
-                else:
-                    dd[geneid] = ec_list
+    dd = {}
+    for geneid, _, ec_list in out_li:
+        if ec_list:
+            dd.setdefault(geneid, set()).update(ec_list)
+    with open(outfile, "w") as out_f:
         for geneid in sorted(dd.keys()):
-            out_f.write("%s\t%s\n" % (geneid, ",".join(sorted(set(dd[geneid])))))
-    out_f.close()
+            out_f.write("%s\t%s\n" % (geneid, ",".join(sorted(dd[geneid]))))
+
+
+def _read_part(partfile):
+    with open(partfile) as in_f:
+        for line in in_f:
+            geneid, value = line.rstrip("\n").split("\t", 1)
+            yield int(geneid), value
+
+
+def merge_gene2summary(partfiles, outfile):
+    """
+    k-way merge of sorted partial gene2summary files,
+    see output_gene2summary, into outfile.
+    """
+    parts = [_read_part(partfile) for partfile in partfiles]
+    with open(outfile, "w") as out_f:
+        # identical lines found in several files are written once
+        for (geneid, summary), _ in groupby(heapq.merge(*parts)):
+            out_f.write("%s\t%s\n" % (geneid, summary))
+
+
+def merge_gene2ec(partfiles, outfile):
+    """
+    k-way merge of sorted partial gene2ec files, see output_gene2ec,
+    into outfile, EC numbers of a gene found in several files are merged.
+    """
+    parts = [_read_part(partfile) for partfile in partfiles]
+    with open(outfile, "w") as out_f:
+        for geneid, rows in groupby(heapq.merge(*parts), key=itemgetter(0)):
+            ec_set = set()
+            for _, ec in rows:
+                ec_set.update(ec.split(","))
+            out_f.write("%s\t%s\n" % (geneid, ",".join(sorted(ec_set))))
+
@@ -12,21 +12,218 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
 import sys
-import os.path
-import glob
 import time
-import logging
-from Bio import SeqIO
 
 from biothings.utils.common import SubStr, anyfile
 
+# GenBank flat file layout, as read by Bio.GenBank.Scanner.GenBankScanner
+RECORD_START = 'LOCUS       '
+HEADER_INDENT = 12
+QUALIFIER_INDENT = 21
+FEATURE_START_MARKERS = ('FEATURES             Location/Qualifiers', 'FEATURES')
+SEQUENCE_HEADERS = ('CONTIG', 'ORIGIN', 'BASE COUNT', 'WGS', 'TSA', 'TLS')
+STRUCTURED_COMMENT_START = re.compile(r'([^#]+)-START##$')
+
+
+def get_summary(comment):
+    '''Return summary string if available, return '' otherwise.'''
+    summary = ''
+    if comment:
+        if comment.find('Summary:') != -1:
+            summary = SubStr(comment, 'Summary: ',).replace('\n', ' ')
+            for end_str in [# '[provided by RefSeq].',
+                            #'[provided by ',
+                            #'[supplied by ',
+                            '##',
+                            # '[RGD',
+                            'COMPLETENESS:',
+                            'Sequence Note:',
+                            'Transcript Variant:',
+                            'CCDS Note:',
+                            'Publication Note:',
+                            ' '*10]:
+                if summary.find(end_str) != -1:
+                    summary = SubStr(summary, end_string=end_str)
+            summary = summary.strip()
+    return summary
+
+
+def get_geneid(db_xref):
+    '''Return geneid as integer from gene db_xref qualifiers, None if not found.'''
+    geneid = None
+    if db_xref:
+        x = [x for x in db_xref if x.startswith('GeneID:')]
+        if len(x) == 1:
+            geneid = int(SubStr(x[0], 'GeneID:'))
+    return geneid
+
+
 class GBFFParser():
+    '''
+    Line-oriented GBFF scanner, only the COMMENT header and the qualifiers
+    of gene and CDS features are parsed, other features and sequences
+    are skipped. It extracts the same data as BiopythonGBFFParser.
+    '''
+    def __init__(self, infile):
+        self.infile = infile
+        self.in_f = anyfile(self.infile)
+
+    def parse(self):
+        out_li = []
+        for rec_id, comment, features in self.records():
+            genes = features['gene']
+            assert len(genes) == 1, '#: {}, id: {}'.format(len(genes), rec_id)
+            geneid = get_geneid(genes[0].get('db_xref'))
+            if geneid:
+                summary = get_summary(comment)
+                ec_list = []
+                if features['CDS']:
+                    assert len(features['CDS']) == 1, geneid
+                    ec_list = features['CDS'][0].get('EC_number', [])
+                if summary or ec_list:
+                    out_li.append((geneid, summary, ec_list))
+        return out_li
+
+    def records(self):
+        '''
+        Yield (id, comment, features) of each record, features is a dict
+        of the "gene" and "CDS" features qualifiers, see _qualifiers.
+        '''
+        lines = iter(self.in_f)
+        for line in lines:
+            if line.startswith(RECORD_START):
+                yield self._record(line, lines)
+
+    def _record(self, locus, lines):
+        # header, up to the features table
+        header = []
+        line = ''
+        for line in lines:
+            line = line.rstrip()
+            if line in FEATURE_START_MARKERS or line[:HEADER_INDENT].rstrip() in SEQUENCE_HEADERS:
+                break
+            if line == '//':
+                raise ValueError("Premature end of sequence data marker '//' found")
+            if line:
+                header.append(line)
+        rec_id = locus[HEADER_INDENT:].split()[0]
+        for header_line in header:
+            if header_line.startswith('VERSION ') and header_line[HEADER_INDENT:].split():
+                rec_id = header_line[HEADER_INDENT:].split()[0]
+                break
+
+        # features, up to the sequence
+        features = {'gene': [], 'CDS': []}
+        if line in FEATURE_START_MARKERS:
+            line = next(lines, '')
+            feature_lines = None
+            while True:
+                if not line:
+                    raise ValueError('Premature end of line during features table')
+                if line[:HEADER_INDENT].rstrip() in SEQUENCE_HEADERS:
+                    break
+                if line[:QUALIFIER_INDENT] == ' ' * QUALIFIER_INDENT or not line.strip():
+                    if feature_lines is not None:
+                        feature_lines.append(line[QUALIFIER_INDENT:].strip())
+                elif line[2:QUALIFIER_INDENT].strip():
+                    if line.rstrip() == '//':
+                        raise ValueError("Premature end of features table, marker '//' found")
+                    key = line[2:QUALIFIER_INDENT].strip()
+                    # only keep the lines of the features we want
+                    feature_lines = [line[QUALIFIER_INDENT:].rstrip()] if key in features else None
+                    if feature_lines is not None:
+                        features[key].append(feature_lines)
+                line = next(lines, '')
+        features = {key: [self._qualifiers(f) for f in li] for key, li in features.items()}
+
+        # skip the sequence
+        while line and line.rstrip() != '//':
+            line = next(lines, '')
+
+        return rec_id, self._comment(header), features
+
+    @staticmethod
+    def _comment(header):
+        '''
+        Return the COMMENT of a record, structured comments excluded.
+        '''
+        comment = []
+        i = 0
+        while i < len(header):
+            line = header[i]
+            i += 1
+            if line[:HEADER_INDENT].strip() != 'COMMENT':
+                continue
+            data = line[HEADER_INDENT:]
+            structured = STRUCTURED_COMMENT_START.search(data) is not None
+            if not structured:
+                comment.append(data)
+            while i < len(header) and header[i][:HEADER_INDENT] == ' ' * HEADER_INDENT:
+                data = header[i][HEADER_INDENT:]
+                i += 1
+                if '-START##' in data:
+                    structured = STRUCTURED_COMMENT_START.search(data) is not None
+                    if not structured:
+                        comment.append(data)
+                elif structured and ('::' in data or '-END##' not in data):
+                    continue
+                elif '-END##' in data:
+                    structured = False
+                else:
+                    comment.append(data)
+        return '\n'.join(comment)
+
+    @staticmethod
+    def _qualifiers(feature_lines):
+        '''
+        Return the {key: [value, ...]} qualifiers of a feature,
+        values unquoted and unescaped.
+        '''
+        qualifiers = []
+        iterator = (x for x in feature_lines[1:] if x)  # after the location
+        for line in iterator:
+            if line[0] == '/':
+                i = line.find('=')
+                if i == -1:
+                    qualifiers.append((line[1:], None))
+                    continue
+                key, value = line[1:i], line[i + 1:]
+                if value.startswith(' ') and value.lstrip().startswith('"'):
+                    value = value.lstrip()
+                if value and value != '"' and value[0] == '"':
+                    value_list = [value]
+                    while value_list[-1][-1] != '"':
+                        value_list.append(next(iterator))
+                    value = '\n'.join(value_list)
+                qualifiers.append((key, value))
+            elif qualifiers and qualifiers[-1][1] is not None:
+                # unquoted continuation
+                qualifiers[-1] = (qualifiers[-1][0], qualifiers[-1][1] + '\n' + line)
+        res = {}
+        for key, value in qualifiers:
+            if value is None:
+                res.setdefault(key, [''])
+                continue
+            value = value.replace('\n', ' ')
+            if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+                value = value[1:-1]
+            res.setdefault(key, []).append(value.replace('""', '"'))
+        return res
+
+
+class BiopythonGBFFParser():
+    '''
+    Reference GBFF parser, building Bio.SeqIO records,
+    only used to benchmark GBFFParser (requires biopython).
+    '''
     def __init__(self, infile):
         self.infile = infile
         self.in_f = anyfile(self.infile)
 
     def parse(self):
+        from Bio import SeqIO
         out_li = []
         for rec in SeqIO.parse(self.in_f, 'genbank'):
             geneid = self.get_geneid(rec)
@@ -39,7 +236,6 @@ class GBFFParser():
 
     def get_geneid(self, rec):
         '''Return geneid as integer, None if not found.'''
-        geneid = None
         gene_feature = [x for x in rec.features if x.type == 'gene']
         # NCBI has now fixed this issue (https://twitter.com/kdpru/status/474673626730741761)
         # if len(gene_feature) == 0 and rec.id == 'NR_001526.1':
@@ -47,35 +243,11 @@ class GBFFParser():
         #     return '252949'         # a temp fix for this wrong rec from NCBI
         assert len(gene_feature) == 1, '#: {}, id: {}'.format(len(gene_feature), rec.id)
         gene_feature = gene_feature[0]
-        db_xref = gene_feature.qualifiers.get('db_xref', None)
-        if db_xref:
-            x = [x for x in db_xref if x.startswith('GeneID:')]
-            if len(x) == 1:
-                geneid = int(SubStr(x[0], 'GeneID:'))
-        return geneid
+        return get_geneid(gene_feature.qualifiers.get('db_xref', None))
 
     def get_summary(self, rec):
         '''Return summary string if available, return '' otherwise.'''
-        summary = ''
-        comment = rec.annotations.get('comment', None)
-        if comment:
-            if comment.find('Summary:') != -1:
-                summary = SubStr(comment, 'Summary: ',).replace('\n', ' ')
-                for end_str in [# '[provided by RefSeq].',
-                                #'[provided by ',
-                                #'[supplied by ',
-                                '##',
-                                # '[RGD',
-                                'COMPLETENESS:',
-                                'Sequence Note:',
-                                'Transcript Variant:',
-                                'CCDS Note:',
-                                'Publication Note:',
-                                ' '*10]:
-                    if summary.find(end_str) != -1:
-                        summary = SubStr(summary, end_string=end_str)
-                summary = summary.strip()
-        return summary
+        return get_summary(rec.annotations.get('comment', None))
 
     def get_ec_numbers(self, rec):
         '''Return a list of EC numbers if available, return [] if not found.'''
@@ -89,3 +261,23 @@ class GBFFParser():
 #            ec_list = [SubStr(x, 'EC_number="', '"') for x in ec_qualifiers]
         return ec_list
 
+
+def benchmark(gbff_files):
+    '''
+    Compare GBFFParser to BiopythonGBFFParser on some gbff files:
+        python parse_refseq_gbff.py human.1.rna.gbff.gz [...]
+    '''
+    for infile in gbff_files:
+        timings = {}
+        for parser_class in (GBFFParser, BiopythonGBFFParser):
+            t0 = time.time()
+            out_li = parser_class(infile).parse()
+            timings[parser_class.__name__] = (time.time() - t0, out_li)
+        fast, reference = timings['GBFFParser'], timings['BiopythonGBFFParser']
+        print('%s: %d records, %.2fs vs %.2fs with biopython (x%.1f), identical: %s' % (
+            infile, len(fast[1]), fast[0], reference[0],
+            reference[0] / (fast[0] or 1e-9), fast[1] == reference[1]))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
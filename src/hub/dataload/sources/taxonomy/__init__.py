@@ -0,0 +1 @@
+from .dump import TaxonomyDumper
@@ -0,0 +1,63 @@
+import os
+import os.path
+import tarfile
+from datetime import datetime
+
+import biothings, config
+biothings.config_for_app(config)
+
+from config import DATA_ARCHIVE_ROOT
+from biothings.hub.dataload.dumper import FTPDumper
+
+from shared.taxonomy import TaxonomyIndex
+
+
+class TaxonomyDumper(FTPDumper):
+    """
+    Download NCBI taxonomy dump and build the compact taxonomy index
+    used by the web API to expand 'include_tax_tree' queries locally
+    (see config_web.INCLUDE_TAX_TREE_FILE).
+    """
+
+    SRC_NAME = "taxonomy"
+    SRC_ROOT_FOLDER = os.path.join(DATA_ARCHIVE_ROOT, SRC_NAME)
+    FTP_HOST = 'ftp.ncbi.nih.gov'
+    CWD_DIR = '/pub/taxonomy'
+    AUTO_UPLOAD = False  # only data is needed
+
+    SCHEDULE = "0 6 * * 6"
+
+    INDEX_FILE = "taxonomy_index.bin"
+
+    def get_newest_info(self):
+        res = self.client.sendcmd("MDTM taxdump.tar.gz")
+        code, remote_lastmodified = res.split()
+        self.release = datetime.strptime(remote_lastmodified, '%Y%m%d%H%M%S').strftime("%Y%m%d")
+
+    def new_release_available(self):
+        current_release = self.src_doc.get("download", {}).get("release")
+        if not current_release or self.release > current_release:
+            self.logger.info("New release '%s' found" % self.release)
+            return True
+        else:
+            self.logger.debug("No new release found")
+            return False
+
+    def create_todump_list(self, force=False, **kwargs):
+        self.get_newest_info()
+        for fn in ['taxdump.tar.gz']:
+            local_file = os.path.join(self.new_data_folder, fn)
+            if force or not os.path.exists(local_file) or self.remote_is_better(fn, local_file) or self.new_release_available():
+                self.to_dump.append({"remote": fn, "local": local_file})
+
+    def post_dump(self, *args, **kwargs):
+        self.logger.info("Extracting nodes.dmp in %s", self.new_data_folder)
+        with tarfile.open(os.path.join(self.new_data_folder, "taxdump.tar.gz")) as tar:
+            tar.extract("nodes.dmp", self.new_data_folder)
+        nodes_file = os.path.join(self.new_data_folder, "nodes.dmp")
+        index_file = os.path.join(self.new_data_folder, self.INDEX_FILE)
+        self.logger.info("Building taxonomy index '%s'", index_file)
+        TaxonomyIndex.build(nodes_file, index_file)
+        index = TaxonomyIndex.load(index_file)
+        assert index.size > 0 and 9606 in index, "Invalid taxonomy index '%s'" % index_file
+        self.logger.info("Taxonomy index built with %d nodes", index.size)
@@ -76,11 +76,11 @@ class UniprotPDBDumper(UniprotDependentDumper):
     SRC_NAME = "uniprot_pdb"
     SRC_ROOT_FOLDER = os.path.join(DATA_ARCHIVE_ROOT, SRC_NAME)
     SCHEDULE = "0 11 * * *"
-    UNIPROT_FILE = "gene2pdb.pyobj"
+    UNIPROT_FILE = "gene2pdb.ndjson"
 
 
 class UniprotPIRDumper(UniprotDependentDumper):
     SRC_NAME = "uniprot_pir"
     SRC_ROOT_FOLDER = os.path.join(DATA_ARCHIVE_ROOT, SRC_NAME)
     SCHEDULE = "0 11 * * *"
-    UNIPROT_FILE = "gene2pir.pyobj"
+    UNIPROT_FILE = "gene2pir.ndjson"
@@ -1,10 +1,31 @@
+import csv
+import heapq
+import os
 import os.path
-from biothings.utils.common import dump, loadobj
-from biothings.utils.dataload import dupline_seperator, tabfile_feeder, list2dict, value_convert
+from itertools import groupby, islice
+
+from biothings.utils.common import anyfile
+from biothings.utils.dataload import dupline_seperator, list2dict, value_convert
+from biothings.utils.serializer import load_json, to_json
+
+from hub.dataload.parallel import parallel_map
 
 # REF: ftp://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/idmapping/README
 VALID_COLUMN_NO = 22
 
+# idmapping_selected.tab.gz is decompressed by one process, and
+# parsed by chunks of lines across PARSER_WORKERS processes
+PARSER_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+CHUNK_LINES = 100000
+
+# PDB and PIR records, by gene id, see GeneRecordsWriter
+PDB_RECORDS_FILE = 'gene2pdb.ndjson'
+PIR_RECORDS_FILE = 'gene2pir.ndjson'
+# (gene_id, value) pairs sorted in memory at once
+RUN_PAIRS = 1000000
+# ranges of a records file uploaded in parallel
+UPLOAD_JOBS = 4
+
 
 def get_uniprot_section(uniprotkb_id):
     """
@@ -39,89 +60,73 @@ def _dict_convert(uniprot_li):
     return {'uniprot': _dict}
 
 
-def load_all(data_folder):
-    """
-    Load "uniprot" using yield, while building "PDB" and "PIR" data dict while reading data file.
-    These dicts are then dumped (pickled) and stored later
-    """
-
-    def cvt_fn(pdb_id):
-        return pdb_id.split(':')[0]
+def _pdb_id(pdb_id):
+    return pdb_id.split(':')[0]
 
-    def merge(xli, transcode=False):
-        xli2 = []
-        uniprot_acc, section, entrez_id, ensembl_id = xli
-        if entrez_id:
-            xli2.append((uniprot_acc, section, entrez_id))
-        elif ensembl_id:
-            if not transcode:
-                raise KeyError(ensembl_id)
-            try:
-                entrez_id = ensembl2geneid[ensembl_id]
-                # if ensembl_id can be mapped to entrez_id
-                for _eid in entrez_id:
-                    xli2.append((uniprot_acc, section, _eid))
-            except KeyError:
-                xli2.append((uniprot_acc, section, ensembl_id))
-        return xli2
-
-    def transform(xli2):
-        gene2uniprot = list2dict(list(set(xli2)), 2, alwayslist=True)
-        gene2uniprot = value_convert(gene2uniprot, _dict_convert, traverse_list=False)
-
-        docs = []
-        for gid, uniprot in gene2uniprot.items():
-            doc = {"_id": gid}
-            doc.update(uniprot)
-            docs.append(doc)
-        return docs
-
-    def merge_x(xli, gene2x, transcode=False, cvt_fn=None, k=None):  # TODO why k is not used?
-        xli2 = []
-        entrez_id, ensembl_id, x_value = xli
-
-        if not x_value:
-            return
-
-        if cvt_fn:
-            x_value = cvt_fn(x_value)
-
-        if entrez_id:
-            xli2.append((entrez_id, x_value))
-        elif ensembl_id:
-            if not transcode:
-                raise KeyError(ensembl_id)
-            try:
-                entrez_id = x_ensembl2geneid[ensembl_id]
-                # if ensembl_id can be mapped to entrez_id
-                for _eid in entrez_id:
-                    xli2.append((_eid, x_value))
-            except KeyError:
-                xli2.append((ensembl_id, x_value))
-        for x in xli2:
-            gene2x.setdefault(x[0], []).append(x[1])
-
-    uniprot_datafile = os.path.join(data_folder, 'idmapping_selected.tab.gz')
 
-    # cache for uniprot
-    ensembl2geneid = {}
-    # cache for PDB and PIR
-    x_ensembl2geneid = {}
-
-    remains = []
-    pdb_remains = []
-    pir_remains = []
-
-    # once filled, will be dumped for later storage
-    gene2pdb = {}
-    gene2pir = {}
+def _merge(xli, ensembl2geneid=None):
+    """
+    Return the (uniprot_acc, section, gene_id) of a UniProt row. Rows with only
+    an ensembl id raise a KeyError, unless ensembl2geneid resolves them.
+    """
+    xli2 = []
+    uniprot_acc, section, entrez_id, ensembl_id = xli
+    if entrez_id:
+        xli2.append((uniprot_acc, section, entrez_id))
+    elif ensembl_id:
+        if ensembl2geneid is None:
+            raise KeyError(ensembl_id)
+        # if ensembl_id can be mapped to entrez_id
+        for _eid in ensembl2geneid.get(ensembl_id, [ensembl_id]):
+            xli2.append((uniprot_acc, section, _eid))
+    return xli2
+
+
+def _merge_x(xli, x_ensembl2geneid=None, cvt_fn=None):
+    """
+    Return the (gene_id, value) of a PDB or PIR row, see _merge.
+    """
+    entrez_id, ensembl_id, x_value = xli
+    if not x_value:
+        return []
+    if cvt_fn:
+        x_value = cvt_fn(x_value)
+    if entrez_id:
+        return [(entrez_id, x_value)]
+    if ensembl_id:
+        if x_ensembl2geneid is None:
+            raise KeyError(ensembl_id)
+        return [(_eid, x_value) for _eid in x_ensembl2geneid.get(ensembl_id, [ensembl_id])]
+    return []
+
+
+def _transform(xli2):
+    gene2uniprot = list2dict(list(set(xli2)), 2, alwayslist=True)
+    gene2uniprot = value_convert(gene2uniprot, _dict_convert, traverse_list=False)
+
+    docs = []
+    for gid, uniprot in gene2uniprot.items():
+        doc = {"_id": gid}
+        doc.update(uniprot)
+        docs.append(doc)
+    return docs
+
+
+def _parse_chunk(lines):
+    """
+    Parse lines of idmapping_selected.tab.gz, return a dict of lists:
+        docs: UniProt documents of rows with an entrez gene id
+        ensembl2geneid, x_ensembl2geneid: (ensembl_id, entrez_id) pairs
+        pdb, pir: (gene_id, value) pairs
+        uniprot_remains, pdb_remains, pir_remains: rows with only an ensembl id
+    """
+    res = {key: [] for key in (
+        "docs", "ensembl2geneid", "x_ensembl2geneid", "pdb", "pir",
+        "uniprot_remains", "pdb_remains", "pir_remains")}
 
-    # store all PDB & PIR data while looping, the whole will be stored later
-    for ld in tabfile_feeder(uniprot_datafile, header=1, assert_column_no=VALID_COLUMN_NO):
-        # Uniprot data will be stored as we read line by line
-        xlis = []
-        pdbxlis = []
-        pirxlis = []
+    for ld in csv.reader(lines, delimiter="\t"):
+        if len(ld) != VALID_COLUMN_NO:
+            raise ValueError("Unexpected column number: got {}, should be {}".format(len(ld), VALID_COLUMN_NO))
 
         # raw lines for each sources
         uniprotld = [ld[0], ld[1], ld[2], ld[18]]
@@ -131,22 +136,10 @@ def load_all(data_folder):
         # UniProt
         # GeneID and EnsemblID columns may have duplicates
         for value in dupline_seperator(dupline=uniprotld, dup_idx=[2, 3], dup_sep='; '):
-            value = list(value)
-            value[1] = get_uniprot_section(value[1])
-            value = tuple(value)
-            xlis.append(value)
-        # PDB
-        for value in dupline_seperator(dupline=pdbld, dup_sep='; '):
-            pdbxlis.append(value)
-
-        # PIR
-        for value in dupline_seperator(dupline=pirld, dup_sep='; '):
-            pirxlis.append(value)
-
-        for xli in xlis:
+            xli = (value[0], get_uniprot_section(value[1]), value[2], value[3])
             # feed mapping
             if xli[2] != '' and xli[3] != '':
-                ensembl2geneid.setdefault(xli[3], []).append(xli[2])
+                res["ensembl2geneid"].append((xli[3], xli[2]))
             try:
                 # postpone ensemblid->entrezid resolution while parsing uniprot as the
                 # full transcodification dict is only correct at the end.
@@ -157,87 +150,175 @@ def load_all(data_folder):
                 #
                 #     UniprotID-B should be associated to both EntrezID-A and EntrezID-B,
                 #     but we need to read up to line 3 to do so
-                xli2 = merge(xli, transcode=False)
-                if not xli2:
-                    continue
-                docs = transform(xli2)
-                for doc in docs:
-                    yield doc
+                xli2 = _merge(xli)
+                if xli2:
+                    res["docs"].extend(_transform(xli2))
             except KeyError:
-                remains.append(xli)
-
-        for xli in pdbxlis:
-            if xli[0] != '' and xli[1] != '':
-                x_ensembl2geneid.setdefault(xli[1], []).append(xli[0])
-            try:
-                merge_x(xli, gene2pdb, transcode=False, cvt_fn=cvt_fn, k="pdb")
-            except KeyError:
-                pdb_remains.append(xli)
-
-        for xli in pirxlis:
-            if xli[0] != '' and xli[1] != '':
-                x_ensembl2geneid.setdefault(xli[1], []).append(xli[0])
-            try:
-                merge_x(xli, gene2pir, transcode=False)
-            except KeyError:
-                pir_remains.append(xli)
+                res["uniprot_remains"].append(xli)
+
+        for key, x_ld, cvt_fn in (("pdb", pdbld, _pdb_id), ("pir", pirld, None)):
+            for xli in dupline_seperator(dupline=x_ld, dup_sep='; '):
+                if xli[0] != '' and xli[1] != '':
+                    res["x_ensembl2geneid"].append((xli[1], xli[0]))
+                try:
+                    res[key].extend(_merge_x(xli, cvt_fn=cvt_fn))
+                except KeyError:
+                    res[key + "_remains"].append(xli)
+
+    return res
+
+
+def _chunks(datafile):
+    in_f = anyfile(datafile)
+    try:
+        next(in_f)  # header
+        while True:
+            lines = list(islice(in_f, CHUNK_LINES))
+            if not lines:
+                return
+            yield lines
+    finally:
+        in_f.close()
+
+
+class GeneRecordsWriter(object):
+    """
+    Write (gene_id, value) pairs, added in any order, as a records file:
+    one {"_id": gene_id, <key>: value(s)} JSON document per line, sorted
+    by gene id, values of a gene deduplicated and sorted.
 
-    # now transcode with what we have
-    for remain in remains:
-        try:
-            xli2 = merge(remain, transcode=True)
-            if not xli2:
-                continue
-            docs = transform(xli2)
-            for doc in docs:
-                yield doc
-        except KeyError:
-            pass
-
-    for remain in pdb_remains:
-        try:
-            merge_x(remain, gene2pdb, transcode=True, cvt_fn=cvt_fn)
-        except KeyError:
-            pass
+    Pairs are sorted by runs of RUN_PAIRS, spilled next to the records
+    file, and merged on close. The records file is replaced atomically.
+    """
 
-    for remain in pir_remains:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.pairs = []
+        self.runs = []
+
+    def add(self, gene_id, value):
+        self.pairs.append((gene_id, value))
+        if len(self.pairs) >= RUN_PAIRS:
+            self._spill()
+
+    def _spill(self):
+        run = "%s.run%d" % (self.path, len(self.runs))
+        with open(run, "w") as run_f:
+            for gene_id, value in sorted(self.pairs):
+                run_f.write(gene_id + "\t" + value + "\n")
+        self.runs.append(run)
+        self.pairs = []
+
+    @staticmethod
+    def _read_run(run):
+        with open(run) as run_f:
+            for line in run_f:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    def close(self):
+        self._spill()
         try:
-            merge_x(remain, gene2pir, transcode=True)
-        except KeyError:
-            pass
-
-    # PDB
-    def normalize(value, keyname):
-        uniq = sorted(set(value))
-        if len(uniq) > 1:
-            return {keyname: uniq}
-        else:
-            return {keyname: uniq[0]}
-
-    def normalize_pdb(value):
-        return normalize(value, "pdb")
-
-    def normalize_pir(value):
-        return normalize(value, "pir")
-
-    # PDB
-    gene2pdb = value_convert(gene2pdb, normalize_pdb, traverse_list=False)
-    pdb_dumpfile = os.path.join(data_folder, 'gene2pdb.pyobj')
-    dump(gene2pdb, pdb_dumpfile)
+            pairs = heapq.merge(*(self._read_run(run) for run in self.runs))
+            with open(self.path + ".tmp", "wb") as out_f:
+                for gene_id, group in groupby(pairs, key=lambda pair: pair[0]):
+                    uniq = sorted(set(value for _, value in group))
+                    record = {"_id": gene_id, self.key: uniq if len(uniq) > 1 else uniq[0]}
+                    out_f.write(to_json(record, return_bytes=True) + b"\n")
+            os.replace(self.path + ".tmp", self.path)
+        finally:
+            for run in self.runs:
+                os.remove(run)
+
+
+def record_ranges(datafile, parts=UPLOAD_JOBS):
+    """
+    Return 'parts' (start, end) byte ranges covering a records file.
+    """
+    size = os.path.getsize(datafile)
+    step = -(-size // parts) or 1
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
 
-    # PIR
-    gene2pir = value_convert(gene2pir, normalize_pir, traverse_list=False)
-    pir_dumpfile = os.path.join(data_folder, 'gene2pir.pyobj')
-    dump(gene2pir, pir_dumpfile)
 
+def load_records(datafile, start=0, end=None):
+    """
+    Yield the documents of a records file, those whose
+    line starts in the [start, end) byte range.
+    """
+    with open(datafile, "rb") as in_f:
+        if start:
+            # skip the record started before
+            in_f.seek(start - 1)
+            in_f.readline()
+        while end is None or in_f.tell() < end:
+            line = in_f.readline()
+            if not line:
+                break
+            yield load_json(line)
+
+
+def load_all(data_folder, workers=PARSER_WORKERS):
+    """
+    Load "uniprot" using yield, while writing "PDB" and "PIR" records files
+    (see GeneRecordsWriter) while reading data file, these are stored later.
 
-def load_pdb(data_folder):
-    pdb_dumpfile = os.path.join(data_folder, 'gene2pdb.pyobj')
-    data = loadobj(pdb_dumpfile)
-    return data
+    Rows with only an ensembl gene id can only be resolved to entrez gene ids
+    once the whole file is read, they're spilled to a temporary file, read
+    back in a second pass.
+    """
+    uniprot_datafile = os.path.join(data_folder, 'idmapping_selected.tab.gz')
+    remains_file = os.path.join(data_folder, 'idmapping_selected.remains.tmp')
 
+    # cache for uniprot
+    ensembl2geneid = {}
+    # cache for PDB and PIR
+    x_ensembl2geneid = {}
 
-def load_pir(data_folder):
-    pir_dumpfile = os.path.join(data_folder, 'gene2pir.pyobj')
-    data = loadobj(pir_dumpfile)
-    return data
+    # once closed, will be stored later
+    gene2x = {
+        "pdb": GeneRecordsWriter(os.path.join(data_folder, PDB_RECORDS_FILE), "pdb"),
+        "pir": GeneRecordsWriter(os.path.join(data_folder, PIR_RECORDS_FILE), "pir"),
+    }
+
+    try:
+        with open(remains_file, "w") as remains_f:
+            for res in parallel_map(_parse_chunk, _chunks(uniprot_datafile), workers):
+                # Uniprot data will be stored as we read
+                yield from res.pop("docs")
+                for ensembl_id, entrez_id in res.pop("ensembl2geneid"):
+                    ensembl2geneid.setdefault(ensembl_id, []).append(entrez_id)
+                for ensembl_id, entrez_id in res.pop("x_ensembl2geneid"):
+                    x_ensembl2geneid.setdefault(ensembl_id, []).append(entrez_id)
+                for key in ("uniprot", "pdb", "pir"):
+                    for xli in res.pop(key + "_remains"):
+                        remains_f.write(key + "\t" + "\t".join(xli) + "\n")
+                for key in ("pdb", "pir"):
+                    for gene_id, x_value in res.pop(key):
+                        gene2x[key].add(gene_id, x_value)
+
+        # now transcode with what we have
+        with open(remains_file) as remains_f:
+            for line in remains_f:
+                key, *xli = line.rstrip("\n").split("\t")
+                if key == "uniprot":
+                    xli2 = _merge(xli, ensembl2geneid)
+                    if xli2:
+                        yield from _transform(xli2)
+                else:
+                    cvt_fn = _pdb_id if key == "pdb" else None
+                    for gene_id, x_value in _merge_x(xli, x_ensembl2geneid, cvt_fn):
+                        gene2x[key].add(gene_id, x_value)
+    finally:
+        if os.path.exists(remains_file):
+            os.remove(remains_file)
+
+    gene2x["pdb"].close()
+    gene2x["pir"].close()
+
+
+def load_pdb(data_folder, start=0, end=None):
+    return load_records(os.path.join(data_folder, PDB_RECORDS_FILE), start, end)
+
+
+def load_pir(data_folder, start=0, end=None):
+    return load_records(os.path.join(data_folder, PIR_RECORDS_FILE), start, end)
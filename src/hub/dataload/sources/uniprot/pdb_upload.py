@@ -1,13 +1,20 @@
+import os
+
 import biothings.hub.dataload.uploader as uploader
-from .parser import load_pdb
+from .parser import PDB_RECORDS_FILE, load_pdb, record_ranges
 
 
-class UniprotPDBUploader(uploader.MergerSourceUploader):
+class UniprotPDBUploader(uploader.MergerSourceUploader, uploader.ParallelizedSourceUploader):
 
     name = "uniprot_pdb"
 
-    def load_data(self, data_folder):
-        return load_pdb(data_folder)
+    def jobs(self):
+        # records are sorted by gene id, ranges of the file are uploaded in parallel
+        datafile = os.path.join(self.data_folder, PDB_RECORDS_FILE)
+        return [(self.data_folder, start, end) for start, end in record_ranges(datafile)]
+
+    def load_data(self, data_folder, start=0, end=None):
+        return load_pdb(data_folder, start, end)
 
     @classmethod
     def get_mapping(klass):
@@ -1,13 +1,20 @@
+import os
+
 import biothings.hub.dataload.uploader as uploader
-from .parser import load_pir
+from .parser import PIR_RECORDS_FILE, load_pir, record_ranges
 
 
-class UniprotPIRUploader(uploader.MergerSourceUploader):
+class UniprotPIRUploader(uploader.MergerSourceUploader, uploader.ParallelizedSourceUploader):
 
     name = "uniprot_pir"
 
-    def load_data(self, data_folder):
-        return load_pir(data_folder)
+    def jobs(self):
+        # records are sorted by gene id, ranges of the file are uploaded in parallel
+        datafile = os.path.join(self.data_folder, PIR_RECORDS_FILE)
+        return [(self.data_folder, start, end) for start, end in record_ranges(datafile)]
+
+    def load_data(self, data_folder, start=0, end=None):
+        return load_pir(data_folder, start, end)
 
     @classmethod
     def get_mapping(klass):
@@ -0,0 +1,300 @@
+"""
+    Compact, read-only identifier tables.
+
+    Large id mappings used while uploading and merging (retired to
+    current entrez gene ids, ensembl to entrez gene ids) are stored as
+    flat binary files of arrays instead of python dicts. The files are
+    memory-mapped, so that a table is loaded once in the pages cache and
+    shared by all the processes using it, with almost no python objects:
+
+        header      magic (8 bytes), version, array lengths (int64)
+        arrays      one after the other, see ARRAYS
+"""
+
+import io
+import mmap
+import os
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+__all__ = ["GeneIdTable", "StringIdTable", "StringIdListTable"]
+
+
+@contextmanager
+def write_atomic(path):
+    """
+    Open a binary file to write, which replaces 'path' once closed. Each
+    writer gets its own temporary file, so processes building the same
+    file at the same time never see (or replace) a partial file.
+    """
+    folder, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder or ".", prefix=name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_f:
+            yield out_f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _IdTable:
+
+    MAGIC = b""
+    VERSION = 1
+    ARRAYS = ()  # (name, typecode)
+
+    def __init__(self, buffer):
+        self.path = None
+        self._buffer = buffer  # keep the mmap alive
+        view = memoryview(buffer)
+        if bytes(view[:8]) != self.MAGIC:
+            raise ValueError("Not a %s file." % type(self).__name__)
+        header = view[8: 16 + 8 * len(self.ARRAYS)].cast("q")
+        if header[0] != self.VERSION:
+            raise ValueError("Unsupported %s version %d." % (type(self).__name__, header[0]))
+        start = 16 + 8 * len(self.ARRAYS)
+        for (name, typecode), length in zip(self.ARRAYS, header[1:]):
+            size = length * array(typecode).itemsize
+            setattr(self, name, view[start: start + size].cast(typecode))
+            start += size
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as table_file:
+            table = cls(mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ))
+        table.path = path
+        return table
+
+    def __reduce__(self):
+        # sent to worker processes as a path, mapped again there
+        return type(self).load, (self.path,)
+
+    @classmethod
+    def _write(cls, arrays, table_file):
+        header = array("q", [cls.VERSION, *(len(arr) for arr in arrays)])
+        table_file.write(cls.MAGIC)
+        table_file.write(header.tobytes())
+        for arr in arrays:
+            table_file.write(arr if isinstance(arr, bytes) else arr.tobytes())
+
+    @classmethod
+    def dump(cls, arrays, path):
+        """
+        Write the arrays, in ARRAYS order, to a table file.
+        The file is replaced atomically, concurrent readers
+        keep reading the previous file until they reload.
+        """
+        with write_atomic(path) as table_file:
+            cls._write(arrays, table_file)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Return an in-memory table of the arrays, for small tables
+        not worth a file. They can't be sent to other processes.
+        """
+        table_file = io.BytesIO()
+        cls._write(arrays, table_file)
+        return cls(table_file.getvalue())
+
+    def items(self):
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class GeneIdTable(_IdTable):
+    """
+    Current and retired (integer) gene ids, to current gene ids.
+
+    Current ids map to themselves, only their sorted list is stored.
+    Retired ids are stored sorted, with their replacements alongside.
+    """
+
+    MAGIC = b"MGGENEID"
+    ARRAYS = (("current", "q"), ("retired", "q"), ("replacements", "q"))
+
+    @classmethod
+    def build_ids(cls, current, retired, path=None):
+        """
+        Return the table of 'current' gene ids and (retired, current)
+        pairs, both in any order. It's written to a table file and mapped
+        if a path is given, only kept in memory otherwise. Like the
+        gene_history rows once loaded in a dict, the last pair of a
+        retired id wins.
+        """
+        arrays = cls._arrays(current, retired)
+        if path is None:
+            return cls.from_arrays(arrays)
+        cls.dump(arrays, path)
+        return cls.load(path)
+
+    @classmethod
+    def _arrays(cls, current, retired):
+        current = array("q", sorted(set(current)))
+        # current ids listed as retired still map to themselves
+        retired = dict(retired)  # last pair wins
+        retired = sorted((key, value) for key, value in retired.items() if cls._find(current, key) is None)
+        return (
+            current,
+            array("q", (key for key, _ in retired)),
+            array("q", (value for _, value in retired)),
+        )
+
+    @staticmethod
+    def _find(ids, _id):
+        index = bisect_left(ids, _id)
+        return index if index < len(ids) and ids[index] == _id else None
+
+    def get(self, _id, default=None):
+        try:
+            _id = int(_id)
+        except (TypeError, ValueError):
+            return default
+        if self._find(self.current, _id) is not None:
+            return _id
+        index = self._find(self.retired, _id)
+        return default if index is None else self.replacements[index]
+
+    def resolve(self, ids, default=None):
+        """
+        Translate many gene ids at once, return the list
+        of current gene ids, 'default' for unknown ones.
+        """
+        return [self.get(_id, default) for _id in ids]
+
+    def contains(self, ids):
+        """
+        Return, for each of many gene ids, whether it's
+        a current or retired gene id of the table.
+        """
+        return [value is not None for value in self.resolve(ids)]
+
+    def items(self):
+        for _id in self.current:
+            yield _id, _id
+        yield from zip(self.retired, self.replacements)
+
+    def __len__(self):
+        return len(self.current) + len(self.retired)
+
+
+class StringIdTable(_IdTable):
+    """
+    String ids (like ensembl gene ids) to integer ids (like entrez gene ids).
+
+    Keys are laid out in one bytes blob, an open-addressing hash table
+    (crc32, linear probing, at most half full) points to their position.
+    """
+
+    MAGIC = b"MGSTRIDS"
+    ARRAYS = (("slots", "i"), ("offsets", "q"), ("values", "q"), ("keys", "B"))
+
+    @classmethod
+    def build(cls, pairs, path):
+        """
+        Write a table file from (key, value) pairs, the last value of a key wins.
+        """
+        mapping = {}
+        for key, value in pairs:
+            mapping[key] = value
+        slots, offsets, keys = cls._hash_keys(list(mapping))
+        cls.dump((slots, offsets, array("q", mapping.values()), keys), path)
+
+    @staticmethod
+    def _hash_keys(keys):
+        """
+        Return the (slots, offsets, blob) arrays of a sequence of keys.
+        """
+        blob, offsets = bytearray(), array("q", [0])
+        nslots = max(2 * len(keys), 2)
+        slots = array("i", bytes(array("i").itemsize * nslots))
+        for entry, key in enumerate(keys, start=1):
+            key = key.encode()
+            blob += key
+            offsets.append(len(blob))
+            slot = zlib.crc32(key) % nslots
+            while slots[slot]:
+                slot = (slot + 1) % nslots
+            slots[slot] = entry  # 0 is an empty slot
+        return slots, offsets, bytes(blob)
+
+    def _entry(self, key):
+        """
+        Return the position of the key in the table, or None.
+        """
+        if not isinstance(key, str):
+            return None
+        key = key.encode()
+        nslots = len(self.slots)
+        slot = zlib.crc32(key) % nslots
+        while True:
+            entry = self.slots[slot]
+            if not entry:
+                return None
+            if self.keys[self.offsets[entry - 1]: self.offsets[entry]] == key:
+                return entry - 1
+            slot = (slot + 1) % nslots
+
+    def _key(self, entry):
+        return bytes(self.keys[self.offsets[entry]: self.offsets[entry + 1]]).decode()
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        return default if entry is None else self.values[entry]
+
+    def items(self):
+        for entry, value in enumerate(self.values):
+            yield self._key(entry), value
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class StringIdListTable(StringIdTable):
+    """
+    String ids to lists of integer ids, like ensembl
+    gene ids to all their matching entrez gene ids.
+    """
+
+    MAGIC = b"MGSTRLST"
+    ARRAYS = (("slots", "i"), ("offsets", "q"), ("value_offsets", "q"), ("values", "q"), ("keys", "B"))
+
+    @classmethod
+    def build(cls, mapping, path):
+        """
+        Write a table file from a {key: [value, ...]} dict.
+        """
+        slots, offsets, keys = cls._hash_keys(list(mapping))
+        values, value_offsets = array("q"), array("q", [0])
+        for key_values in mapping.values():
+            values.extend(key_values)
+            value_offsets.append(len(values))
+        cls.dump((slots, offsets, value_offsets, values, keys), path)
+
+    def get(self, key, default=None):
+        """
+        Return the tuple of values of the key.
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return default
+        return tuple(self.values[self.value_offsets[entry]: self.value_offsets[entry + 1]])
+
+    def items(self):
+        for entry in range(len(self)):
+            yield self._key(entry), tuple(self.values[self.value_offsets[entry]: self.value_offsets[entry + 1]])
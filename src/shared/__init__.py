@@ -0,0 +1,6 @@
+"""
+    Data formats shared by the hub and the web API.
+
+    The hub builds what the web API reads, both import from here
+    so that neither depends on the other (nor on its dependencies).
+"""
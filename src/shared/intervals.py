@@ -0,0 +1,38 @@
+"""
+    Flattened genomic positions for interval queries.
+
+    Interval queries like "chr1:151,073,054-151,383,976" match the
+    nested genomic_pos fields, nested queries are expensive. The hub
+    indexer also indexes each position as a non-nested long_range,
+    the chromosome encoded in the high 32 bits of the coordinates,
+    so that an interval query is a single range query on a BKD tree.
+
+    Only chromosomes listed here are encoded, intervals on any other
+    chromosome (scaffolds, contigs...) still use the nested fields.
+"""
+
+# nested positions field -> flattened range field
+RANGE_FIELDS = {
+    "genomic_pos": "genomic_pos_range",
+    "genomic_pos_hg19": "genomic_pos_hg19_range",
+    "genomic_pos_mm9": "genomic_pos_mm9_range",
+}
+
+# lowercase chromosome name -> code, codes must never change,
+# append new names with new codes, and rebuild the index.
+CHROMOSOMES = {str(num): num for num in range(1, 101)}
+CHROMOSOMES.update((name, 101 + num) for num, name in enumerate((
+    "x", "y", "w", "z", "mt", "m", "pt", "un",
+    "2l", "2r", "3l", "3r",  # fruitfly
+    "i", "ii", "iii", "iv", "v", "vi", "vii", "viii", "ix", "xi", "xii",
+    "xiii", "xiv", "xv", "xvi",  # yeast, nematode
+)))
+
+POSITION_BITS = 32  # coordinates up to 4Gb
+
+
+def encode(code, pos):
+    """
+    Return a chromosome position as a flattened coordinate.
+    """
+    return (code << POSITION_BITS) + pos
@@ -0,0 +1,138 @@
+"""
+    Compact taxonomy tree, built by the hub from the NCBI taxonomy
+    dump and read by the web API to expand 'include_tax_tree' queries.
+"""
+
+import mmap
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+
+def load_tax_tree(path):
+    """
+    Read a taxonomy tree file, either NCBI 'nodes.dmp' or a
+    tab-delimited file with one 'taxid<TAB>parent_taxid' per line,
+    and return a {parent_taxid: [child_taxid, ...]} dict.
+    """
+    children = defaultdict(list)
+    with open(path) as tree_file:
+        for line in tree_file:
+            fields = line.split("\t|\t") if "\t|\t" in line else line.split("\t")
+            if len(fields) < 2 or not fields[0].strip().isdigit():
+                continue  # header or blank line
+            taxid, parent = int(fields[0]), int(fields[1].strip("\t|\n "))
+            if taxid != parent:  # NCBI root node is its own parent
+                children[parent].append(taxid)
+    return dict(children)
+
+
+class TaxonomyIndex:
+    """
+    Compact, read-only taxonomy tree answering "all descendants of X".
+
+    Nodes are stored in depth-first (Euler tour) order, so the subtree
+    of a node is the contiguous slice [position, subtree_end) of that
+    order. The index is a flat binary file of int64 arrays, memory-mapped
+    so that it is loaded once and shared by the pages cache:
+
+        header        magic, version, number of nodes (n)
+        taxids        n sorted taxids
+        positions     n dfs positions, one for each sorted taxid
+        dfs_taxids    n taxids in dfs order
+        subtree_end   n exclusive subtree ends, in dfs order
+        parents       n parent taxids, in dfs order (root is its own parent)
+    """
+
+    MAGIC = b"MGTAXIDX"
+    VERSION = 1
+    ARRAYS = ("taxids", "positions", "dfs_taxids", "subtree_end", "parents")
+
+    def __init__(self, buffer):
+        self._buffer = buffer  # keep the mmap alive
+        view = memoryview(buffer)
+        if bytes(view[:8]) != self.MAGIC:
+            raise ValueError("Not a taxonomy index.")
+        header = view[8:24].cast("q")
+        if header[0] != self.VERSION:
+            raise ValueError(f"Unsupported taxonomy index version {header[0]}.")
+        self.size = size = header[1]
+        for num, name in enumerate(self.ARRAYS):
+            start = 24 + num * size * 8
+            setattr(self, name, view[start: start + size * 8].cast("q"))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map a binary index file, or build the index in
+        memory when 'path' is a text taxonomy tree file.
+        """
+        with open(path, "rb") as index_file:
+            if index_file.read(len(cls.MAGIC)) != cls.MAGIC:
+                return cls(cls.serialize(load_tax_tree(path)))
+            return cls(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def build(cls, tree_file, index_file):
+        """
+        Build a binary index file from a nodes.dmp-like taxonomy tree file.
+        """
+        with open(index_file, "wb") as out_f:
+            out_f.write(cls.serialize(load_tax_tree(tree_file)))
+
+    @classmethod
+    def serialize(cls, children):
+        """
+        Lay out a {parent_taxid: [child_taxid, ...]} tree in dfs order.
+        """
+        parents = {child: parent for parent, kids in children.items() for child in kids}
+        roots = sorted(set(children) - set(parents))
+
+        dfs_taxids, dfs_parents, subtree_end = array("q"), array("q"), array("q")
+        for root in roots:
+            # iterative dfs, a node is popped when entering it, then
+            # again with its dfs position once its subtree is complete
+            stack = [(root, root, None)]
+            while stack:
+                taxid, parent, position = stack.pop()
+                if position is not None:
+                    subtree_end[position] = len(dfs_taxids)
+                    continue
+                stack.append((taxid, parent, len(dfs_taxids)))
+                dfs_taxids.append(taxid)
+                dfs_parents.append(parent)
+                subtree_end.append(0)
+                stack.extend((child, taxid, None) for child in reversed(children.get(taxid, ())))
+
+        order = sorted(range(len(dfs_taxids)), key=dfs_taxids.__getitem__)
+        taxids = array("q", (dfs_taxids[pos] for pos in order))
+        positions = array("q", order)
+
+        header = array("q", (cls.VERSION, len(dfs_taxids)))
+        return b"".join(
+            (cls.MAGIC, header.tobytes(), taxids.tobytes(), positions.tobytes(),
+             dfs_taxids.tobytes(), subtree_end.tobytes(), dfs_parents.tobytes())
+        )
+
+    def _position(self, taxid):
+        index = bisect_left(self.taxids, taxid)
+        if index < self.size and self.taxids[index] == taxid:
+            return self.positions[index]
+        return None
+
+    def __contains__(self, taxid):
+        return self._position(int(taxid)) is not None
+
+    def parent(self, taxid):
+        position = self._position(int(taxid))
+        return None if position is None else self.parents[position]
+
+    def descendants(self, taxid):
+        """
+        Return the taxid itself and all its descendants,
+        as an int64 memoryview, or an empty sequence if unknown.
+        """
+        position = self._position(int(taxid))
+        if position is None:
+            return ()
+        return self.dfs_taxids[position: self.subtree_end[position]]
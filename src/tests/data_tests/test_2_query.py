@@ -1,3 +1,5 @@
+import json
+
 import pytest
 from biothings.tests.web import BiothingsDataTest
 
@@ -172,6 +174,25 @@ class TestQueryGET(BiothingsDataTest):
         res2 = self.request("query?q=lytic%20enzyme&species=1386").json()
         assert res2["total"] == 0
 
+    def test_256_export_ndjson(self):
+        res = self.request("query?q=cdk2&species=human,mouse&fields=symbol").json()
+        res2 = self.request("query?q=cdk2&species=human,mouse&fields=symbol&format=ndjson")
+        lines = res2.text.splitlines()
+        assert len(lines) == res["total"]
+        for line in lines:
+            doc = json.loads(line)
+            assert "_id" in doc
+            assert "symbol" in doc
+
+    def test_257_export_tsv(self):
+        res = self.request("query?q=symbol:cdk2&species=human&fields=symbol,genomic_pos.chr&format=tsv")
+        rows = [row.split("\t") for row in res.text.splitlines()]
+        assert rows[0] == ["_id", "symbol", "genomic_pos.chr"]
+        assert ["1017", "CDK2", "12"] in rows[1:]
+
+    def test_258_export_tsv_fields_all(self):
+        self.request("query?q=cdk2&fields=all&format=tsv", expect=400)
+
     def test_260_order(self):
         url = "gene/695?fields=homologene"
         res = self.request(url).json()
@@ -0,0 +1,57 @@
+import importlib.util
+import os
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_GBFF = os.path.join(HERE, "test_data", "refseq_sample.rna.gbff")
+
+
+def load_parser_module():
+    # loaded from its file, the refseq package imports the hub config
+    path = os.path.join(HERE, os.pardir, os.pardir, "hub", "dataload", "sources", "refseq", "parse_refseq_gbff.py")
+    spec = importlib.util.spec_from_file_location("parse_refseq_gbff", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+parse_refseq_gbff = load_parser_module()
+
+
+def test_gbff_parser():
+    # NR_000002 has no CDS, NM_000004 neither summary nor EC number
+    assert parse_refseq_gbff.GBFFParser(SAMPLE_GBFF).parse() == [
+        (
+            1017,
+            "This gene encodes a sample kinase. The encoded protein phosphorylates sample substrates, "
+            "and its activity is regulated by sample cyclins. [provided by RefSeq, Jul 2008].",
+            ["2.7.11.22", "2.7.11.23"],
+        ),
+        (100000002, "This gene produces a sample long non-coding RNA. [provided by RefSeq, Mar 2015].", []),
+        (300003, "", ["1.14.13.-"]),
+    ]
+
+
+def test_gbff_parser_records():
+    records = {rec_id: (comment, features) for rec_id, comment, features in
+               parse_refseq_gbff.GBFFParser(SAMPLE_GBFF).records()}
+    assert list(records) == ["NM_000001.2", "NR_000002.1", "XM_000003.1", "NM_000004.1"]
+    # structured comments are left out of the comment
+    comment, features = records["NM_000001.2"]
+    assert "Evidence-Data" not in comment
+    assert comment.endswith("transcript.\nCOMPLETENESS: full length.")
+    # multi-line quoted qualifiers are joined, escaped quotes unescaped
+    assert features["CDS"][0]["note"] == [
+        "isoform 1 is encoded by transcript variant 1; cell division protein kinase 2; "
+        'p33 protein kinase; a "sample" kinase'
+    ]
+    assert records["NR_000002.1"][1]["CDS"] == []
+
+
+def test_gbff_parser_same_as_biopython():
+    pytest.importorskip("Bio")
+    assert (
+        parse_refseq_gbff.GBFFParser(SAMPLE_GBFF).parse()
+        == parse_refseq_gbff.BiopythonGBFFParser(SAMPLE_GBFF).parse()
+    )
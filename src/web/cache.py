@@ -0,0 +1,197 @@
+"""
+    Response cache for the query and annotation endpoints.
+
+    Responses are cached in an in-process LRU and, optionally, in a
+    shared backend (Redis) so that all web workers benefit from them.
+    Cache keys include the build_version of the index, all entries of
+    a previous build are dropped as soon as a new build is published.
+"""
+
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+from biothings.utils import serializer
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    A small LRU cache whose entries also expire after 'ttl' seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return None
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCacheBackend:
+    """
+    Shared cache backend, requires the optional "redis" package.
+    """
+
+    def __init__(self, url, ttl=3600):
+        import redis.asyncio  # optional dependency
+
+        self.client = redis.asyncio.from_url(url)
+        self.ttl = ttl
+
+    async def get(self, key):
+        value = await self.client.get(key)
+        return None if value is None else serializer.load_json(value)
+
+    async def set(self, key, value):
+        await self.client.set(key, serializer.to_json(value), ex=self.ttl)
+
+
+class ResponseCache:
+    """
+    Two-tier response cache, keyed on the normalized request
+    arguments and the build_version of the queried index.
+    """
+
+    # requests never cached, their responses are not deterministic
+    UNCACHED_ARGS = ("fetch_all", "scroll_id", "raw", "rawquery")
+    # arguments only affecting the serialization of the response
+    IGNORED_ARGS = ("format",)
+
+    def __init__(self, maxsize=10000, ttl=3600, backend=None, version_check_interval=60):
+        self.local = TTLCache(maxsize, ttl)
+        self.backend = backend
+        self.version_check_interval = version_check_interval
+        self.build_versions = {}  # biothing_type -> (build_version, last checked)
+        self.stats = {"hit": 0, "shared_hit": 0, "miss": 0, "uncached": 0, "invalidation": 0}
+
+    @classmethod
+    def from_config(cls, config):
+        backend = None
+        if config.RESPONSE_CACHE_REDIS:
+            backend = RedisCacheBackend(config.RESPONSE_CACHE_REDIS, config.RESPONSE_CACHE_TTL)
+        return cls(
+            config.RESPONSE_CACHE_SIZE,
+            config.RESPONSE_CACHE_TTL,
+            backend=backend,
+            version_check_interval=config.RESPONSE_CACHE_VERSION_CHECK,
+        )
+
+    async def build_version(self, metadata, biothing_type):
+        """
+        Return the current build_version of the biothing_type index,
+        reading the index metadata again at most every few seconds.
+        """
+        version, checked = self.build_versions.get(biothing_type, (None, 0))
+        if time.monotonic() - checked > self.version_check_interval:
+            try:
+                await metadata.refresh(biothing_type)
+            except Exception as exc:  # keep serving with the known version
+                logger.warning("Cannot refresh metadata: %s", exc)
+            current = metadata.get_metadata(biothing_type).get("build_version")
+            if version is not None and current != version:
+                logger.info("New build '%s' (was '%s'), clearing response cache.", current, version)
+                self.local.clear()
+                self.stats["invalidation"] += 1
+            version = current
+            self.build_versions[biothing_type] = (version, time.monotonic())
+        return version
+
+    def key(self, method, build_version, args):
+        if not build_version or any(args.get(arg) for arg in self.UNCACHED_ARGS) or args.get("q") == "__any__":
+            return None
+        normalized = {k: v for k, v in args.items() if k not in self.IGNORED_ARGS}
+        normalized = serializer.to_json(
+            {"method": method, "args": normalized}, sort_keys=True, return_bytes=True)
+        return f"mygene:{build_version}:{hashlib.sha1(normalized).hexdigest()}"
+
+    async def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["hit"] += 1
+            return value
+        if self.backend:
+            try:
+                value = await self.backend.get(key)
+            except Exception as exc:
+                logger.warning("Shared response cache unavailable: %s", exc)
+            if value is not None:
+                self.stats["shared_hit"] += 1
+                self.local.set(key, value)
+                return value
+        self.stats["miss"] += 1
+        return None
+
+    async def set(self, key, value):
+        self.local.set(key, value)
+        if self.backend:
+            try:
+                await self.backend.set(key, value)
+            except Exception as exc:
+                logger.warning("Shared response cache unavailable: %s", exc)
+
+    def metrics(self):
+        lookups = self.stats["hit"] + self.stats["shared_hit"] + self.stats["miss"]
+        return dict(
+            self.stats,
+            size=len(self.local),
+            hit_ratio=round((self.stats["hit"] + self.stats["shared_hit"]) / lookups, 4) if lookups else None,
+        )
+
+
+class CachedQueryPipeline:
+    """
+    Wrap a request handler's query pipeline, serving
+    'search' and 'fetch' responses from a ResponseCache.
+    """
+
+    def __init__(self, pipeline, cache, handler):
+        self.pipeline = pipeline
+        self.cache = cache
+        self.handler = handler
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    async def search(self, **args):
+        return await self._cached("search", args)
+
+    async def fetch(self, **args):
+        return await self._cached("fetch", args)
+
+    async def _cached(self, method, args):
+        version = await self.cache.build_version(self.handler.metadata, args.get("biothing_type"))
+        key = self.cache.key(method, version, args)
+        if key is None:
+            self.cache.stats["uncached"] += 1
+            return await getattr(self.pipeline, method)(**args)
+
+        response = await self.cache.get(key)
+        self.handler.set_header("X-Cache", "HIT" if response is not None else "MISS")
+        if response is None:
+            response = await getattr(self.pipeline, method)(**args)
+            await self.cache.set(key, response)
+        return response
@@ -0,0 +1,75 @@
+"""
+    Streaming exports of query results, format=ndjson or format=tsv.
+
+    All the matches of a query are read page by page with search_after
+    in an Elasticsearch point in time, each page is formatted and
+    flushed to the client before the next one is requested, so that
+    the memory used does not depend on the number of matches.
+"""
+
+from biothings.utils import serializer
+from biothings.utils.common import dotdict
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson; charset=UTF-8",
+    "tsv": "text/tab-separated-values; charset=UTF-8",
+}
+EXPORT_PAGE_SIZE = 1000
+EXPORT_KEEP_ALIVE = "1m"  # point in time expiration, between two pages
+
+# pagination is handled here, the other ones do not apply to exports
+IGNORED_OPTIONS = ("size", "from", "fetch_all", "scroll_id", "aggs", "explain")
+
+
+async def export_hits(pipeline, **options):
+    """
+    Yield pages of formatted hits matching the query,
+    'options' are the query handler arguments.
+    """
+    options = dotdict({key: value for key, value in options.items() if key not in IGNORED_OPTIONS})
+    backend, client = pipeline.backend, pipeline.backend.client
+    index = backend.adjust_index(backend.indices[options.biothing_type], None, **options)
+
+    search = pipeline.builder.build(options.pop("q", None), **options)
+    if not options.sort:  # index order, no scoring
+        search = search.sort("_shard_doc")
+
+    pit_id = (await client.open_point_in_time(index=index, keep_alive=EXPORT_KEEP_ALIVE))["id"]
+    search_after = None
+    try:
+        while True:
+            page = search.extra(size=EXPORT_PAGE_SIZE, pit={"id": pit_id, "keep_alive": EXPORT_KEEP_ALIVE})
+            if search_after:
+                page = page.extra(search_after=search_after)
+            response = await client.search(**page.to_dict())
+            hits = response["hits"]["hits"]
+            if not hits:
+                return
+            pit_id = response.get("pit_id", pit_id)
+            search_after = hits[-1]["sort"]
+            yield pipeline.formatter.transform(response, **options)["hits"]
+            if len(hits) < EXPORT_PAGE_SIZE:
+                return
+    finally:
+        await client.close_point_in_time(id=pit_id)
+
+
+def to_ndjson(hits):
+    return b"".join(serializer.to_json(hit, return_bytes=True) + b"\n" for hit in hits)
+
+
+def to_tsv(hits, fields):
+    """
+    Render dotfield flattened hits as tab-separated
+    rows, list values are separated by commas.
+    """
+    rows = []
+    for hit in hits:
+        values = []
+        for field in fields:
+            value = hit.get(field, "")
+            if isinstance(value, list):
+                value = ",".join(str(item) for item in value)
+            values.append(str(value).replace("\t", " ").replace("\n", " "))
+        rows.append("\t".join(values))
+    return "".join(row + "\n" for row in rows).encode()
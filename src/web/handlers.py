@@ -1,33 +1,97 @@
+from biothings.web.handlers import BiothingHandler, MetadataSourceHandler, QueryHandler
+from biothings.web.handlers.query import capture_exceptions
+from tornado.web import HTTPError
 
-import requests
+from .cache import CachedQueryPipeline, ResponseCache
+from .export import EXPORT_FORMATS, export_hits, to_ndjson, to_tsv
+from .taxonomy import TaxonomyTreeExpander
 
-from biothings.web.handlers import MetadataSourceHandler, QueryHandler
 
+class ResponseCacheMixin:
+    """
+    Serve pipeline responses from the response cache, see web.cache.
+    """
 
-class MygeneQueryHandler(QueryHandler):
+    # one per web worker process, shared by all handlers, created on first use
+    response_cache = None
 
-    async def get(self, *args, **kwargs):
+    def prepare(self):
+        super().prepare()
+        config = self.biothings.config
+        if config.RESPONSE_CACHE_SIZE:
+            if ResponseCacheMixin.response_cache is None:
+                ResponseCacheMixin.response_cache = ResponseCache.from_config(config)
+            self.pipeline = CachedQueryPipeline(self.pipeline, self.response_cache, self)
 
-        if self.args.include_tax_tree and 'all' not in self.args.species:
 
-            res = requests.post(
-                self.settings['biothings'].INCLUDE_TAX_TREE_REDIRECT_ENDPOINT,
-                data={
-                    "ids": ','.join([str(sid) for sid in self.args.species]),
-                    "expand_species": 'True'
-                },
-                headers={
-                    'user-agent': (
-                        'Python-requests_'
-                        'mygene.info/'
-                        '{} (gzip)'
-                    ).format(requests.__version__)
-                })
+class MygeneAnnotationHandler(ResponseCacheMixin, BiothingHandler):
+    pass
+
 
-            if res.status_code == requests.codes.ok:
-                self.args.species = [str(x) for x in res.json()]
+class MygeneQueryHandler(ResponseCacheMixin, QueryHandler):
 
-        await super().get(self, *args, **kwargs)
+    # one per web worker process, created on first use
+    tax_tree = None
+
+    async def get(self, *args, **kwargs):
+
+        if self.args.include_tax_tree and 'all' not in self.args.species:
+
+            if MygeneQueryHandler.tax_tree is None:
+                MygeneQueryHandler.tax_tree = TaxonomyTreeExpander.from_config(self.biothings.config)
+
+            self.args.species = await self.tax_tree.expand(self.args.species)
+
+        self.args.species_index = self._species_index()
+        if self.format in EXPORT_FORMATS:
+            await self.export()
+        else:
+            await super().get(self, *args, **kwargs)
+
+    async def post(self, *args, **kwargs):
+        self.args.species_index = self._species_index()
+        await super().post(*args, **kwargs)
+
+    @capture_exceptions
+    async def export(self):
+        """
+        Stream all the matching documents, one per line, see web.export.
+        """
+        if self.format == "tsv":
+            fields = [field for field in self.args._source or () if not field.startswith("-")]
+            if not fields or "all" in fields:
+                raise HTTPError(400, reason="format=tsv requires a list of fields.")
+            fields = ["_id", *fields]
+            self.args.dotfield = True
+
+        self.clear_header("Cache-Control")
+        self.set_header("Content-Type", EXPORT_FORMATS[self.format])
+        if self.format == "tsv":
+            self.write(to_tsv([{field: field for field in fields}], fields))  # header
+
+        async for hits in export_hits(self.pipeline, **self.args):
+            self.write(to_tsv(hits, fields) if self.format == "tsv" else to_ndjson(hits))
+            await self.flush()  # wait for the client to read the page
+        self.finish()
+
+    def _species_index(self):
+        """
+        Return the indices to search when all the requested
+        species are model organisms indexed on their own,
+        or None to search the default index.
+        """
+        config = self.biothings.config
+        species = self.args.species
+        if not config.ES_SPECIES_INDEX or not species or 'all' in species:
+            return None
+
+        names = {d['tax_id']: name for name, d in config.TAXONOMY.items()}
+        if not all(taxid in names for taxid in species):
+            return None
+        return ",".join(
+            config.ES_SPECIES_INDEX.format(species=names[taxid])
+            for taxid in sorted(set(species))
+        )
 
 
 class MygeneSourceHandler(MetadataSourceHandler):
@@ -64,6 +128,9 @@ class MygeneSourceHandler(MetadataSourceHandler):
 
     def extras(self, _meta):
 
+        if self.args.dev and ResponseCacheMixin.response_cache:
+            _meta['response_cache'] = ResponseCacheMixin.response_cache.metrics()
+
         _meta['taxonomy'] = {}
         _meta['genome_assembly'] = {}
 
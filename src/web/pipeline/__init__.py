@@ -1 +1,3 @@
+from .batch import MygeneQueryPipeline
 from .build import MygeneQueryBuilder
+from .engine import MygeneQueryBackend
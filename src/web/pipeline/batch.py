@@ -0,0 +1,150 @@
+"""
+    Batch lookups of gene identifiers.
+
+    POST /query is mostly used to map long lists of identifiers on the
+    default exact-keyword scopes (_id, entrezgene, ensembl.gene, retired).
+    Instead of one multi_match query per term in a multisearch, terms
+    are partitioned by identifier shape, each partition is looked up
+    with a single terms query, and the hits are demultiplexed back to
+    their query terms, keeping the multisearch response semantics.
+"""
+
+import copy
+import re
+from collections import defaultdict
+
+from biothings.utils.common import dotdict
+from biothings.web.query import AsyncESQueryPipeline
+from biothings.web.query.pipeline import capturesESExceptions
+from elasticsearch.dsl import Q, Search
+
+# scopes that can be looked up with a terms query
+EXACT_SCOPES = ("_id", "entrezgene", "ensembl.gene", "retired")
+
+# identifier shape -> the exact scopes it can match
+ID_SHAPES = (
+    (re.compile(r"^\d+$"), ("_id", "entrezgene", "retired")),
+    (re.compile(r"^ENS[A-Z]*G\d{11}$", re.I), ("_id", "ensembl.gene")),
+)
+
+# requests using any of these options take the regular multisearch path
+UNSUPPORTED_OPTIONS = ("sort", "from", "explain", "analyzer", "aggs", "raw", "rawquery", "userquery")
+
+# keyword and numeric fields read back to tell which term matched a hit
+DEMUX_FIELDS = ("entrezgene", "ensembl.gene", "retired")
+
+MAX_BATCH_SIZE = 10000  # index.max_result_window
+
+
+def partition(q, scopes):
+    """
+    Group the query terms by the scopes they can match, return
+    ({scopes: [(position, term), ...]}, [leftover position, ...]).
+    """
+    partitions, leftovers = defaultdict(list), []
+    for position, term in enumerate(q):
+        term = str(term)
+        for pattern, fields in ID_SHAPES:
+            if pattern.match(term):
+                fields = tuple(field for field in fields if field in scopes)
+                if fields:
+                    partitions[fields].append((position, term))
+                    break
+        else:
+            leftovers.append(position)
+    return partitions, leftovers
+
+
+def matches(_id, values, term, fields):
+    """
+    Tell if a terms query hit, with these docvalues, matches this
+    query term, the same way a multi_match query on these fields would.
+    """
+    for field in fields:
+        if field == "_id":
+            if _id == term:
+                return True
+        elif field == "retired":
+            if int(term) in values.get(field, ()):
+                return True
+        elif term.lower() in values.get(field, ()):  # lowercase normalized keywords
+            return True
+    return False
+
+
+class MygeneQueryPipeline(AsyncESQueryPipeline):
+
+    @capturesESExceptions
+    async def search(self, q, **options):
+        if isinstance(q, list) and self._supports_batch(options):
+            return await self._batch_search(q, options)
+        return await super().search(q, **options)
+
+    @staticmethod
+    def _supports_batch(options):
+        scopes = options.get("scopes")
+        return (
+            bool(scopes)
+            and all(isinstance(scope, str) and scope in EXACT_SCOPES for scope in scopes)
+            and not any(options.get(option) for option in UNSUPPORTED_OPTIONS)
+        )
+
+    async def _batch_search(self, q, options):
+        size = options.get("size") or 10  # per query term
+        partitions, leftovers = partition(q, options["scopes"])
+        responses = [None] * len(q)
+
+        for fields, terms in partitions.items():
+            hits = await self._lookup(fields, [term for _, term in terms], size, options)
+            if hits is None:  # too many matches, let the multisearch paginate
+                leftovers.extend(position for position, _ in terms)
+                continue
+            hits = [(hit, hit.pop("fields", {})) for hit in hits]
+            used = set()
+            for position, term in terms:
+                term_hits = []
+                for hit, values in hits:
+                    if matches(hit["_id"], values, term, fields):
+                        # formatting modifies hits, copy the ones matching several terms
+                        term_hits.append(copy.deepcopy(hit) if id(hit) in used else hit)
+                        used.add(id(hit))
+                term_hits.sort(key=lambda hit: hit["_score"], reverse=True)
+                responses[position] = {
+                    "hits": {
+                        "total": {"value": len(term_hits), "relation": "eq"},
+                        "max_score": term_hits[0]["_score"] if term_hits else None,
+                        "hits": term_hits[:size],
+                    }
+                }
+
+        if leftovers:
+            leftovers.sort()
+            query = self.builder.build([q[position] for position in leftovers], **options)
+            for position, response in zip(leftovers, await self.backend.execute(query, **options)):
+                responses[position] = response
+
+        options["templates"] = (dict(query=_q) for _q in q)
+        options["template_miss"] = dict(notfound=True)
+        options["template_hit"] = dict()
+        return self.formatter.transform(responses, **options)
+
+    async def _lookup(self, fields, terms, size, options):
+        """
+        Return all the documents matching the terms on these fields,
+        or None if there are more than the batch can return.
+        """
+        terms = sorted(set(terms))
+        search = Search().query("bool", should=[Q("terms", **{field: terms}) for field in fields])
+        extras = dotdict(options)
+        extras.pop("size", None)
+        search = self.builder.apply_extras(search, extras)
+        search = search.extra(
+            size=min(len(terms) * size, MAX_BATCH_SIZE),
+            docvalue_fields=[field for field in DEMUX_FIELDS if field in fields],
+            track_total_hits=True,
+        )
+        response = await self.backend.execute(
+            search, biothing_type=options.get("biothing_type"), species_index=options.get("species_index"))
+        if response["hits"]["total"] > len(response["hits"]["hits"]):
+            return None
+        return response["hits"]["hits"]
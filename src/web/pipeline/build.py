@@ -1,55 +1,84 @@
 import re
+from functools import lru_cache
 
+from biothings.utils.common import is_int
 from biothings.web.query import ESQueryBuilder, QueryPipelineException
 from elasticsearch.dsl import Search
+from elasticsearch.dsl.function import SF
 
-from .legacy import dismax, interval, wildcard
+from shared.intervals import RANGE_FIELDS
+from .legacy import DISMAX, DISMAX_ENTREZGENE, WILDCARD, interval
+
+# genomic interval query, like "chr1:151,073,054-151,383,976"
+INTERVAL_PATTERN = re.compile(r'chr(?P<chrom>\w+):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)')
+QUERY_STRING_OPERATORS = (':', '~', ' AND ', ' OR ', 'NOT ')
+
+# number of rendered string queries kept for hot terms like "cdk2"
+STRING_QUERY_CACHE_SIZE = 4096
+
+# the same for every query, built once
+SCORE_FUNCTIONS = (
+    SF({"filter": {"term": {"name": "pseudogene"}}, "weight": "0.5"}),  # downgrade
+    SF({"filter": {"term": {"taxid": 9606}}, "weight": "1.55"}),
+    SF({"filter": {"term": {"taxid": 10090}}, "weight": "1.3"}),
+    SF({"filter": {"term": {"taxid": 10116}}, "weight": "1.2"}),
+    # other common species (config_web.TAXONOMY) rank above the long tail on ties
+    SF({"filter": {"terms": {"taxid": [7227, 6239, 7955, 3702, 8364, 9823]}}, "weight": "1.1"}),
+)
+
+
+@lru_cache(maxsize=STRING_QUERY_CACHE_SIZE)
+def string_query(q, flattened=False):
+    """
+    Classify the shape of a query string and render its query from the
+    corresponding prebuilt template. Searches are immutable, every
+    es-dsl operation on them returns a copy, so they can be cached.
+    'flattened' tells interval queries to use the flattened positions.
+    """
+    match = INTERVAL_PATTERN.search(q)
+    if match:  # (chr, gstart, gend)
+        d = match.groupdict()
+        if q.startswith('hg19.'):
+            # support hg19 for human (default is hg38)
+            d['assembly'] = 'hg19'
+        if q.startswith('mm9.'):
+            # support mm9 for mouse (default is mm10)
+            d['assembly'] = 'mm9'
+        return Search().from_dict(interval(**d, flattened=flattened))
+
+    # query_string query
+    if q.startswith('"') and q.endswith('"') or any(map(q.__contains__, QUERY_STRING_OPERATORS)):
+        return Search().query("query_string", query=q, default_operator="AND")
+
+    # wildcard query
+    if '*' in q or '?' in q:
+        return Search().from_dict(WILDCARD.render(q.lower()))
+
+    # default query
+    if is_int(q):
+        return Search().from_dict(DISMAX_ENTREZGENE.render(int(q)))
+    return Search().from_dict(DISMAX.render(q))
 
 
 class MygeneQueryBuilder(ESQueryBuilder):
 
     def default_string_query(self, q, options):
+        return string_query(q, self._has_flattened_positions(options.biothing_type))
 
-        # genomic interval query
-        pattern = r'chr(?P<chrom>\w+):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)'
-        match = re.search(pattern, q)
-        if match:  # (chr, gstart, gend)
-            d = match.groupdict()
-            if q.startswith('hg19.'):
-                # support hg19 for human (default is hg38)
-                d['assembly'] = 'hg19'
-            if q.startswith('mm9.'):
-                # support mm9 for mouse (default is mm10)
-                d['assembly'] = 'mm9'
-            search = Search().from_dict(interval(**d))
-
-        # query_string query
-        elif q.startswith('"') and q.endswith('"') or \
-                any(map(q.__contains__, (':', '~', ' AND ', ' OR ', 'NOT '))):
-            search = Search().query(
-                "query_string", query=q, default_operator="AND")
-
-        # wildcard query
-        elif '*' in q or '?' in q:
-            search = Search().from_dict(wildcard(q))
-        else:  # default query
-            search = Search().from_dict(dismax(q))
-
-        return search
+    def _has_flattened_positions(self, biothing_type):
+        # indices built before the flattened positions only have nested ones
+        if self.metadata is None:
+            return False
+        mappings = self.metadata.biothing_mappings.get(biothing_type) or {}
+        return RANGE_FIELDS["genomic_pos"] in mappings
 
     def apply_extras(self, search, options):
 
         search = Search().query(
             "function_score",
             query=search.query,
-            functions=[
-                {"filter": {"term": {"name": "pseudogene"}}, "weight": "0.5"},  # downgrade
-                {"filter": {"term": {"taxid": 9606}}, "weight": "1.55"},
-                {"filter": {"term": {"taxid": 10090}}, "weight": "1.3"},
-                {"filter": {"term": {"taxid": 10116}}, "weight": "1.2"},
-                # other common species (config_web.TAXONOMY) rank above the long tail on ties
-                {"filter": {"terms": {"taxid": [7227, 6239, 7955, 3702, 8364, 9823]}}, "weight": "1.1"},
-            ], score_mode="first")
+            functions=SCORE_FUNCTIONS,
+            score_mode="first")
 
         if options.entrezonly:
             search = search.filter('exists', field="entrezgene")
@@ -0,0 +1,9 @@
+from biothings.web.query import AsyncESQueryBackend
+
+
+class MygeneQueryBackend(AsyncESQueryBackend):
+
+    def adjust_index(self, original_index, query, **options):
+        # set by the query handler when all the requested
+        # species have their own index, see ES_SPECIES_INDEX
+        return options.get("species_index") or original_index
@@ -4,9 +4,18 @@
 
 from biothings.utils.common import is_int
 
+from shared.intervals import CHROMOSOMES, RANGE_FIELDS, encode
+
 
 def dismax(q):
 
+    if is_int(q):
+        return _dismax_entrezgene(int(q))
+    return _dismax(q)
+
+
+def _dismax(q):
+
     _query = {
         "tie_breaker": 0,
         "boost": 1,
@@ -91,17 +100,25 @@ def dismax(q):
         ],
     }
 
-    if is_int(q):
-        _query["queries"] = [
+    return {"query": {"dis_max": _query}}
+
+
+def _dismax_entrezgene(entrezgene):
+
+    _query = {
+        "tie_breaker": 0,
+        "boost": 1,
+        "queries": [
             {
                 "function_score": {
                     "query": {
-                        "term": {"entrezgene": int(q)},
+                        "term": {"entrezgene": entrezgene},
                     },
                     "weight": 8,
                 }
             }
-        ]
+        ],
+    }
 
     return {"query": {"dis_max": _query}}
 
@@ -109,6 +126,11 @@ def dismax(q):
 def wildcard(q):
     """q should contains either * or ?, but not the first character."""
 
+    return _wildcard(q.lower())
+
+
+def _wildcard(value):
+
     _query = {
         "tie_breaker": 0,
         "boost": 1,
@@ -118,7 +140,7 @@ def wildcard(q):
                     "query": {
                         "wildcard": {
                             "symbol": {
-                                "value": q.lower(),
+                                "value": value,
                             }
                         },
                     },
@@ -129,7 +151,7 @@ def wildcard(q):
                     "query": {
                         "wildcard": {
                             "name": {
-                                "value": q.lower(),
+                                "value": value,
                             }
                         },
                     }
@@ -140,7 +162,7 @@ def wildcard(q):
                     "query": {
                         "wildcard": {
                             "summary": {
-                                "value": q.lower(),
+                                "value": value,
                             }
                         },
                     }
@@ -152,6 +174,49 @@ def wildcard(q):
     return {"query": {"dis_max": _query}}
 
 
+class QueryTemplate:
+    """
+    A query body skeleton built once by calling 'factory' with a
+    placeholder. Rendering substitutes the user term for the placeholder,
+    only copying the containers on the way to it, the rest of the body
+    is shared between renderings and must be treated as immutable.
+    """
+
+    _TERM = object()  # placeholder
+
+    def __init__(self, factory):
+        skeleton = factory(self._TERM)
+        self._render = self._compile(skeleton) or self._constant(skeleton)
+
+    def render(self, value):
+        return self._render(value)
+
+    @classmethod
+    def _compile(cls, node):
+        if node is cls._TERM:
+            return lambda value: value
+        if isinstance(node, dict):
+            items = [(key, cls._compile(val)) for key, val in node.items()]
+            if any(render is not None for _, render in items):
+                items = [(key, render or cls._constant(node[key])) for key, render in items]
+                return lambda value: {key: render(value) for key, render in items}
+        elif isinstance(node, list):
+            renders = [cls._compile(val) for val in node]
+            if any(render is not None for render in renders):
+                renders = [render or cls._constant(val) for val, render in zip(node, renders)]
+                return lambda value: [render(value) for render in renders]
+        return None  # constant, no placeholder below this node
+
+    @staticmethod
+    def _constant(node):
+        return lambda value: node
+
+
+DISMAX = QueryTemplate(_dismax)
+DISMAX_ENTREZGENE = QueryTemplate(_dismax_entrezgene)
+WILDCARD = QueryTemplate(_wildcard)
+
+
 def safe_genome_pos(s):
     """
     safe_genome_pos(1000) = 1000
@@ -166,10 +231,12 @@ def safe_genome_pos(s):
         raise ValueError('invalid type "%s" for "save_genome_pos"' % type(s))
 
 
-def interval(chrom, gstart, gend, assembly=None):
+def interval(chrom, gstart, gend, assembly=None, flattened=False):
     """By default if assembly is None, the lastest assembly is used.
     for some species (e.g. human) we support multiple assemblies,
     exact assembly is passed as well.
+    With 'flattened', query the flattened range fields of the index
+    instead of the nested positions when possible, see shared.intervals.
     """
     gstart = safe_genome_pos(gstart)
     gend = safe_genome_pos(gend)
@@ -183,6 +250,19 @@ def interval(chrom, gstart, gend, assembly=None):
         if assembly == "mm9":
             genomic_pos_field = "genomic_pos_mm9"
 
+    code = CHROMOSOMES.get(chrom.lower())
+    if flattened and code is not None and gstart <= gend:
+        _query = {
+            "range": {
+                RANGE_FIELDS[genomic_pos_field]: {
+                    "gte": encode(code, gstart),
+                    "lte": encode(code, gend),
+                    "relation": "intersects",
+                }
+            }
+        }
+        return dict(query=_query)
+
     _query = {
         "nested": {
             "path": genomic_pos_field,
@@ -0,0 +1,102 @@
+"""
+    Taxonomy tree expansion for the 'include_tax_tree' query parameter.
+
+    Expands a list of taxids to the list of all their descendants,
+    either by asking the remote taxonomy service (t.biothings.io),
+    or, in offline mode, from a local TaxonomyIndex file built by the hub.
+    Expansions are cached and concurrent identical expansions share
+    the same in-flight request.
+"""
+
+import asyncio
+import logging
+from urllib.parse import urlencode
+
+from biothings.utils import serializer
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+from shared.taxonomy import TaxonomyIndex
+
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TaxonomyTreeExpander:
+    """
+    Non-blocking 'include_tax_tree' expansion.
+
+    Remote mode posts the taxids to 'endpoint' using tornado's pooled
+    AsyncHTTPClient. Offline mode, enabled when 'tree_file' is given,
+    reads subtrees from a TaxonomyIndex instead and needs no network.
+    """
+
+    def __init__(self, endpoint, cache_size=1024, cache_ttl=3600, timeout=10, tree_file=None):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._inflight = {}  # key -> asyncio.Future
+        self._index = TaxonomyIndex.load(tree_file) if tree_file else None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.INCLUDE_TAX_TREE_REDIRECT_ENDPOINT,
+            cache_size=config.INCLUDE_TAX_TREE_CACHE_SIZE,
+            cache_ttl=config.INCLUDE_TAX_TREE_CACHE_TTL,
+            timeout=config.INCLUDE_TAX_TREE_TIMEOUT,
+            tree_file=config.INCLUDE_TAX_TREE_FILE,
+        )
+
+    async def expand(self, species):
+        """
+        Return the taxids in 'species' and all their descendants as strings.
+        The (deduplicated) input taxids are returned if the expansion fails.
+        """
+        key = tuple(sorted(set(str(sid) for sid in species)))
+        result = self.cache.get(key)
+        if result is not None:
+            return list(result)
+
+        # another request is already expanding the same species list
+        if key in self._inflight:
+            return list(await asyncio.shield(self._inflight[key]))
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        result = key  # returned as is when the expansion fails
+        try:
+            if self._index is not None:
+                result = self._expand_local(key)
+            else:
+                result = await self._expand_remote(key)
+        except Exception as exc:  # not cached, retried by the next request
+            logger.warning("Cannot expand taxonomy tree for %s: %s", key, exc)
+        else:
+            self.cache.set(key, result)
+        finally:
+            del self._inflight[key]
+            if not future.done():
+                future.set_result(result)
+
+        return list(result)
+
+    def _expand_local(self, key):
+        taxids = set()
+        for sid in key:
+            # unknown taxids are kept as is
+            taxids.update(self._index.descendants(int(sid)) or (int(sid),))
+        return tuple(str(taxid) for taxid in sorted(taxids))
+
+    async def _expand_remote(self, key):
+        try:
+            response = await AsyncHTTPClient().fetch(
+                self.endpoint,
+                method="POST",
+                body=urlencode({"ids": ",".join(key), "expand_species": "True"}),
+                user_agent="mygene.info/tornado",
+                request_timeout=self.timeout,
+            )
+        except HTTPClientError as exc:
+            raise ValueError(f"taxonomy service returned {exc.code}") from exc
+        return tuple(str(taxid) for taxid in serializer.load_json(response.body))